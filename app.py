@@ -1,18 +1,28 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.runtime.memory_uploaded_file_manager import MemoryUploadedFileManager
 import pandas as pd
-import pdfplumber
-import re
 from datetime import datetime
 import time
-import base64
 import hashlib
 import sqlite3
 import os
-import shutil
-from PIL import Image
-import io
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+import uuid
+import functools
+from preview import PreviewCache
+from db import open_database, run_statements, delete_all_invoices
+from reports import rebuild_project_summary, report_version, report_rows, project_month_matrix, REPORT_VALUES
+from storage import BlobStore, collect_garbage, store_stats
+from search import search_invoices, fts_query
+from metrics import Metrics
+from branding import branding_version, load_branding, save_branding
+from uploads import UploadSpool, SpoolFull
+from jobs import JobQueue, JOB_ACTIVE, JOB_LABELS, ProcessPool
+from dedup import dedup_key, find_duplicates, scan_duplicates
+from archive import ARCHIVE_DIR, archive_invoices, attach_archive, list_archives, vacuum_db, remove_archive_files, search_all_periods
+from export import EXPORT_WRITERS, EXPORT_MIME, count_rows, export_bytes, invoice_export_query, pnl_export_query
+from thumbs import backfill_thumbs, thumb_data_uri, thumb_path
+from writer import WriterClient
 
 # ==========================================
 # 1. CẤU HÌNH TRANG & KHỞI TẠO MÔI TRƯỜNG
@@ -22,7 +32,6 @@ st.set_page_config(page_title="Quản Lý Hóa Đơn Pro (Local)", page_icon="
 # --- QUẢN LÝ SESSION STATE ---
 if "logged_in" not in st.session_state: st.session_state.logged_in = False
 if "user_info" not in st.session_state: st.session_state.user_info = None
-if "db_initialized" not in st.session_state: st.session_state.db_initialized = False
 
 # FIX LỖI OUT TÀI KHOẢN: Dùng thư mục ẩn
 UPLOAD_FOLDER = ".uploaded_invoices"
@@ -30,127 +39,229 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 DB_FILE = "invoice_app.db"
+# File upload chờ phân tích/lưu (hàng đợi jobs)
+JOB_SPOOL = ".job_spool"
+UPLOAD_SPOOL = ".upload_spool"
+# Chạy nhiều tiến trình app chung DB: trỏ tới socket của writer.py, mọi lệnh ghi đi qua tiến trình đó
+WRITER_SOCKET = os.environ.get("INVOICE_WRITER_SOCKET")
 
 # ==========================================
 # 2. XỬ LÝ DATABASE (SQLite)
 # ==========================================
-def get_connection():
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-# Hàm cập nhật cấu trúc bảng nếu là DB cũ (Migration)
-def migrate_db_columns():
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        # Thêm cột drive_link nếu chưa có
-        c.execute("ALTER TABLE invoices ADD COLUMN drive_link TEXT")
-    except: pass
-    
-    try:
-        # Thêm cột request_edit (0: ko, 1: có yêu cầu duyệt sửa)
-        c.execute("ALTER TABLE invoices ADD COLUMN request_edit INTEGER DEFAULT 0")
-    except: pass
-    conn.commit()
-    conn.close()
-
-def init_db():
-    conn = get_connection()
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password TEXT, role TEXT, status TEXT)''')
-    # Thêm sẵn drive_link và request_edit vào bảng invoices
-    c.execute('''CREATE TABLE IF NOT EXISTS invoices (
-        id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT, date TEXT, invoice_number TEXT, invoice_symbol TEXT, 
-        seller_name TEXT, buyer_name TEXT, pre_tax_amount REAL, tax_amount REAL, total_amount REAL, 
-        file_name TEXT, status TEXT, edit_count INTEGER, created_at TEXT, memo TEXT, file_path TEXT,
-        drive_link TEXT, request_edit INTEGER DEFAULT 0
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS projects (id INTEGER PRIMARY KEY AUTOINCREMENT, project_name TEXT, created_at TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS project_links (id INTEGER PRIMARY KEY AUTOINCREMENT, project_id INTEGER, invoice_id INTEGER)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS company_info (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, address TEXT, phone TEXT, logo_base64 TEXT)''')
-
-    # Data mặc định
-    c.execute("SELECT * FROM users WHERE username = 'admin'")
-    if not c.fetchone():
-        admin_pw = hashlib.sha256("admin123".encode()).hexdigest()
-        c.execute("INSERT INTO users (username, password, role, status) VALUES (?, ?, ?, ?)", ('admin', admin_pw, 'admin', 'approved'))
-    
-    c.execute("SELECT * FROM company_info WHERE id = 1")
-    if not c.fetchone():
-        c.execute("INSERT INTO company_info (name, address, phone, logo_base64) VALUES (?, ?, ?, ?)", ('Tên Công Ty Của Bạn', 'Địa chỉ...', '090...', ''))
-
-    conn.commit()
-    conn.close()
-
-if not st.session_state.db_initialized:
-    init_db()
-    migrate_db_columns() # Chạy migration để update cột mới
-    st.session_state.db_initialized = True
+# Pool kết nối dùng chung cho mọi session (WAL + busy timeout), lỗi SQL được ném ra thay vì trả None
+# Tạo bảng + migration chạy 1 lần cho mỗi tiến trình khi khởi tạo pool; có writer thì lệnh ghi gửi sang writer
+@st.cache_resource
+def get_db():
+    return open_database(DB_FILE, writer=WriterClient(WRITER_SOCKET) if WRITER_SOCKET else None)
 
 # --- CÁC HÀM HỖ TRỢ ---
 def run_query(query, params=(), fetch_one=False, commit=False):
-    conn = get_connection()
-    c = conn.cursor()
-    try:
-        c.execute(query, params)
-        if commit:
-            conn.commit()
-            return True
-        if fetch_one:
-            return c.fetchone()
-        return c.fetchall()
-    except Exception as e:
-        return None
-    finally:
-        conn.close()
+    count_query()
+    with get_metrics().timer("sql", query):
+        return get_db().execute(query, params, fetch_one=fetch_one, commit=commit)
 
 def hash_pass(password):
     return hashlib.sha256(str.encode(password)).hexdigest()
 
-def save_file_local(uploaded_file, is_converted_pdf=False, pdf_bytes=None):
-    try:
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        if is_converted_pdf:
-            # Nếu là file PDF được convert từ ảnh
-            final_name = f"{ts}_converted_image.pdf"
-            file_path = os.path.join(UPLOAD_FOLDER, final_name)
-            with open(file_path, "wb") as f:
-                f.write(pdf_bytes)
-        else:
-            # File gốc
-            clean_name = re.sub(r'[\\/*?:"<>|]', "", uploaded_file.name)
-            final_name = f"{ts}_{clean_name}"
-            file_path = os.path.join(UPLOAD_FOLDER, final_name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-                
-        return file_path, final_name
-    except: return None, None
+# Kho file theo hash nội dung (dùng chung cho mọi session)
+@st.cache_resource
+def get_blob_store():
+    return BlobStore(UPLOAD_FOLDER)
 
 def format_vnd(amount):
     if amount is None: return "0"
     try: return "{:,.0f}".format(float(amount)).replace(",", ".")
     except: return "0"
 
+# --- THƯƠNG HIỆU CÔNG TY: cache theo version, chỉ đọc lại DB khi admin lưu thông tin mới ---
+# Nhiều tiến trình app: admin sửa ở tiến trình khác thì tiến trình này thấy sau tối đa BRANDING_RECHECK giây
+BRANDING_RECHECK = 30
+
+@st.cache_resource
+def branding_state():
+    return {"version": None, "checked": 0}
+
+@st.cache_data(max_entries=4)
+def load_company_data(version):
+    with get_db().connection() as conn:
+        return load_branding(conn)
+
 def get_company_data():
-    row = run_query("SELECT * FROM company_info WHERE id = 1", fetch_one=True)
-    if row:
-        return {'name': row['name'], 'address': row['address'], 'phone': row['phone'], 'logo_b64_str': row['logo_base64']}
-    return {'name': 'Company', 'address': '...', 'phone': '...', 'logo_b64_str': ''}
+    with get_metrics().timer("app", "get_company_data"):
+        bs = branding_state()
+        if time.time() - bs["checked"] > BRANDING_RECHECK:
+            with get_db().connection() as conn: bs["version"] = branding_version(conn)
+            bs["checked"] = time.time()
+        return load_company_data(bs["version"])
+
+# --- BÁO CÁO TỔNG HỢP: ma trận dự án x tháng cache theo version dữ liệu báo cáo (reports.py) ---
+@st.cache_data(max_entries=4)
+def load_report_matrix(version):
+    with get_db().connection() as conn:
+        return project_month_matrix(report_rows(conn))
+
+# --- XUẤT DỮ LIỆU: số dòng theo bộ lọc (đổi bộ lọc mới đếm lại, dữ liệu mới tính sau tối đa 60s) ---
+@st.cache_data(ttl=60, max_entries=32)
+def export_row_count(query, with_archives):
+    return count_rows(get_db(), query, with_archives)
 
 def update_company_info(name, address, phone, logo_bytes=None):
-    b64_str = base64.b64encode(logo_bytes).decode('utf-8') if logo_bytes else ""
-    if not logo_bytes:
-        old = run_query("SELECT logo_base64 FROM company_info WHERE id = 1", fetch_one=True)
-        if old: b64_str = old['logo_base64']
-    run_query("UPDATE company_info SET name=?, address=?, phone=?, logo_base64=? WHERE id=1", (name, address, phone, b64_str), commit=True)
-    st.cache_data.clear()
+    branding_state().update(version=get_db().write(save_branding, name, address, phone, logo_bytes), checked=time.time())
+
+def show_logo(variant):
+    # Logo thu nhỏ qua st.image: bytes giống nhau giữa các lần rerun -> cùng URL, trình duyệt không tải lại
+    logo = comp['logos'].get(variant)
+    if logo:
+        with st.container(key=f"logo_{variant}"): st.image(logo['data'], width=logo['width'])
+
+# --- CACHE PHÂN TÍCH (khóa = SHA-256 nội dung file, LRU theo last_used) ---
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+# Bản tải về từ app nằm trọn trong RAM của Streamlit: quá số dòng này thì chỉ hướng dẫn xuất bằng export.py
+EXPORT_APP_MAX_ROWS = 200_000
+
+# --- FILE UPLOAD: chép ra spool trên đĩa, session_state chỉ giữ handle (uploads.py) ---
+@st.cache_resource
+def get_upload_spool():
+    return UploadSpool(UPLOAD_SPOOL)
+
+def forget_upload(f_obj):
+    # Streamlit giữ bytes upload trong RAM tới hết phiên; đã chép ra đĩa (hoặc bị từ chối) thì bỏ ngay, như chat_input tự làm
+    ctx = get_script_run_ctx()
+    if ctx and isinstance(ctx.uploaded_file_mgr, MemoryUploadedFileManager):
+        ctx.uploaded_file_mgr.remove_file(session_id=ctx.session_id, file_id=f_obj.file_id)
+
+def spool_upload(f_obj):
+    # Vừa chép vừa băm theo khối
+    try:
+        return get_upload_spool().save(st.session_state.perf_sid, f_obj, f_obj.name, f_obj.size, "pdf" not in f_obj.type)
+    finally:
+        forget_upload(f_obj)
+
+def drop_upload():
+    # Bỏ file đang nhập cùng kết quả phân tích chưa lưu
+    if st.session_state.job_id: get_job_queue().discard([st.session_state.job_id])
+    get_upload_spool().release(st.session_state.upload)
+    st.session_state.upload = None; st.session_state.pdf_data = None; st.session_state.job_id = None
+
+# --- CHỐNG TRÙNG: tra theo dedup_key trên unique index (1 truy vấn cho cả danh sách key) ---
+def saved_duplicates(keys):
+    count_query()
+    with get_db().connection() as conn:
+        return find_duplicates(conn, keys)
+
+def dup_text(row):
+    return f"#{row['id']} (ngày {row['date']}, {format_vnd(row['total_amount'])})"
+
+# --- DANH SÁCH HÓA ĐƠN CHO MÀN HÌNH LIÊN KẾT DỰ ÁN ---
+LINK_PAGE_SIZE = 50
+
+def fetch_link_page(pid, inv_type, filters, cursor=None):
+    # Hóa đơn chưa thuộc dự án nào hoặc thuộc dự án đang chọn (LEFT JOIN, uq_links_invoice đảm bảo tối đa 1 dòng)
+    # Phân trang keyset theo (iso_date DESC, id DESC): cursor = (iso_date, id) của dòng cuối trang trước
+    where = ["i.status = 'active'", "i.type = ?", "(l.project_id IS NULL OR l.project_id = ?)"]
+    params = [inv_type, pid]
+    if fts_query(filters.get('q')):
+        where.append("i.id IN (SELECT rowid FROM invoices_fts WHERE invoices_fts MATCH ?)")
+        params.append(fts_query(filters['q']))
+    if filters.get('date_from'): where.append("i.iso_date >= ?"); params.append(filters['date_from'].strftime("%Y-%m-%d"))
+    if filters.get('date_to'): where.append("i.iso_date <= ?"); params.append(filters['date_to'].strftime("%Y-%m-%d"))
+    if filters.get('amount_min') is not None: where.append("i.total_amount >= ?"); params.append(filters['amount_min'])
+    if filters.get('amount_max') is not None: where.append("i.total_amount <= ?"); params.append(filters['amount_max'])
+    if cursor:
+        # DESC xếp NULL xuống cuối
+        if cursor[0] is None: where.append("(i.iso_date IS NULL AND i.id < ?)"); params.append(cursor[1])
+        else:
+            where.append("(i.iso_date < ? OR (i.iso_date = ? AND i.id < ?) OR i.iso_date IS NULL)")
+            params += [cursor[0], cursor[0], cursor[1]]
+    return run_query(f"""SELECT i.id, i.iso_date, i.memo, i.total_amount, i.file_path, (l.project_id IS NOT NULL) AS Selected
+                         FROM invoices i LEFT JOIN project_links l ON l.invoice_id = i.id
+                         WHERE {' AND '.join(where)}
+                         ORDER BY i.iso_date DESC, i.id DESC LIMIT ?""", (*params, LINK_PAGE_SIZE + 1))
+
+def link_page_editor(inv_type, rows, has_next, disabled, thumbs=False):
+    cursors = st.session_state.lk_cursors[inv_type]
+    df = pd.DataFrame(rows, columns=['id', 'iso_date', 'memo', 'total_amount', 'file_path', 'Selected'])
+    df['Selected'] = df['Selected'].astype(bool)
+    df['Ngày'] = df['iso_date'].fillna('')
+    df['Show'] = df['memo'].fillna('') + " (" + df['total_amount'].apply(format_vnd) + ")"
+    cols, col_cfg = ['Selected', 'id', 'Ngày', 'Show'], {"Selected": st.column_config.CheckboxColumn(required=True), "id": None}
+    if thumbs:
+        # Ảnh thu nhỏ tạo sẵn (vài KB/ảnh) gửi kèm bảng dạng data URI, chỉ khi người dùng bật
+        df['Ảnh'] = [thumb_data_uri(r['file_path']) for r in rows]
+        cols.insert(1, 'Ảnh'); col_cfg['Ảnh'] = st.column_config.ImageColumn(width="small")
+    edited = st.data_editor(df[cols], column_config=col_cfg, disabled=disabled, hide_index=True, key=f"e_{inv_type.lower()}_{len(cursors)}")
+    p1, p2, p3 = st.columns([1,2,1])
+    if p1.button("◀", key=f"prev_{inv_type}", disabled=len(cursors) == 1):
+        cursors.pop(); st.rerun()
+    p2.caption(f"Trang {len(cursors)}")
+    if p3.button("▶", key=f"next_{inv_type}", disabled=not has_next):
+        cursors.append((rows[-1]['iso_date'], rows[-1]['id'])); st.rerun()
+    return edited
+
+# Pool process dùng chung cho mọi session: pdfplumber tốn CPU nên chạy ngoài tiến trình Streamlit
+# (spawn thay vì fork vì server Streamlit chạy đa luồng; xem start_process_pool về __main__); worker chết thì tự tạo lại pool
+@st.cache_resource
+def get_extract_pool():
+    return ProcessPool(os.cpu_count() or 2)
+
+# Cache ảnh xem trước dùng chung cho mọi session (giới hạn bộ nhớ)
+@st.cache_resource
+def get_preview_cache():
+    return PreviewCache(max_bytes=64 * 1024 * 1024)
+
+# --- ĐO HIỆU NĂNG (ring buffer dùng chung cho mọi session) ---
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+def count_query():
+    # Đếm truy vấn của lần chạy hiện tại (cả trang hoặc 1 fragment) trong session
+    st.session_state.perf_queries = st.session_state.get("perf_queries", 0) + 1
+
+def end_rerun():
+    # Gọi ở cuối script (và trước st.stop()): ghi thời gian cả lần rerun, đẩy số liệu xuống DB nếu bật
+    m = get_metrics()
+    user = (st.session_state.user_info or {}).get('name', '(chưa đăng nhập)')
+    m.record("rerun", user, (time.perf_counter() - RERUN_STARTED) * 1000, st.session_state.perf_sid)
+    m.record_queries("app", st.session_state.perf_queries)
+    st.session_state.perf_full_run = False
+    if m.persist:
+        m.flush(get_db())
+
+def perf_fragment(func=None, *, run_every=None):
+    # st.fragment + đo riêng các lần fragment tự chạy lại (lúc chạy cùng cả trang thì tính vào rerun của trang)
+    if func is None: return functools.partial(perf_fragment, run_every=run_every)
+    @st.fragment(run_every=run_every)
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        if st.session_state.get("perf_full_run"): return func(*args, **kwargs)
+        st.session_state.perf_queries = 0
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            m = get_metrics()
+            m.record("fragment", func.__name__, (time.perf_counter() - t0) * 1000, st.session_state.perf_sid)
+            m.record_queries(func.__name__, st.session_state.perf_queries)
+            if m.persist:
+                m.flush(get_db())
+    return run
+
+# --- HÀNG ĐỢI PHÂN TÍCH/LƯU CHẠY NỀN (luồng worker dùng chung cho mọi session, gửi việc nặng sang pool process) ---
+# Khởi tạo ngay lần chạy đầu (kể cả màn hình đăng nhập) để job còn dở từ lần chạy app trước được xử lý tiếp
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(get_db(), get_blob_store(), JOB_SPOOL, pool=get_extract_pool(), workers=os.cpu_count() or 2,
+                    metrics=get_metrics(), cache_max_bytes=CACHE_MAX_BYTES).start()
+
+if "perf_sid" not in st.session_state: st.session_state.perf_sid = uuid.uuid4().hex[:8]
+RERUN_STARTED = time.perf_counter()
+st.session_state.perf_queries = 0; st.session_state.perf_full_run = True
+get_metrics().start_rerun(st.session_state.perf_sid)
+get_job_queue()
 
 # ==========================================
-# 3. CSS & XỬ LÝ FILE (PDF/IMAGE -> PDF)
+# 3. CSS
 # ==========================================
 comp = get_company_data()
 st.markdown("""
@@ -168,7 +279,8 @@ st.markdown("""
     }
     .report-card:hover { transform: translateY(-3px); border-color: #28a745; }
     .company-header { display: flex; align-items: center; justify-content: center; gap: 25px; padding: 20px; border-bottom: 1px solid #ddd; margin-bottom: 20px; }
-    .header-logo { border-radius: 10px; object-fit: contain; }
+    .header-logo, [class*="st-key-logo_"] img { border-radius: 10px; object-fit: contain; }
+    .st-key-company_header { border-bottom: 1px solid #ddd; padding-bottom: 20px; margin-bottom: 20px; }
     .stButton button { border-radius: 8px; font-weight: 600; text-transform: uppercase; }
     
     /* Style cho hàng bị xóa */
@@ -177,104 +289,6 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def extract_numbers_from_line(line):
-    raw_nums = re.findall(r'(?<!\d)(?!0\d)\d{1,3}(?:[.,]\d{3})+(?![.,]\d)', line)
-    return [float(n.replace('.', '').replace(',', '')) for n in raw_nums if not (1990 <= float(n.replace('.', '').replace(',', '')) <= 2030)]
-
-# --- HÀM CHUYỂN ẢNH SANG PDF ---
-def convert_image_to_pdf(image_file):
-    try:
-        img = Image.open(image_file)
-        # Chuyển sang RGB nếu cần
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-            
-        img_width, img_height = img.size
-        
-        # Tạo PDF buffer
-        pdf_buffer = io.BytesIO()
-        c = canvas.Canvas(pdf_buffer, pagesize=(img_width, img_height))
-        
-        # Lưu ảnh tạm thời để vẽ vào PDF (reportlab cần đường dẫn file ảnh)
-        temp_img_path = f"temp_img_{int(time.time())}.jpg"
-        img.save(temp_img_path)
-        
-        c.drawImage(temp_img_path, 0, 0, img_width, img_height)
-        c.save()
-        
-        # Xóa ảnh tạm
-        if os.path.exists(temp_img_path):
-            os.remove(temp_img_path)
-            
-        pdf_buffer.seek(0)
-        return pdf_buffer
-    except Exception as e:
-        return None
-
-def extract_data_smart(file_obj, is_image=False):
-    text_content = ""
-    msg = None
-    
-    try:
-        # Nếu là ảnh, convert sang PDF trước
-        pdf_file = file_obj
-        if is_image:
-            pdf_buffer = convert_image_to_pdf(file_obj)
-            if pdf_buffer:
-                pdf_file = pdf_buffer
-            else:
-                return None, "Lỗi chuyển đổi ảnh sang PDF"
-
-        # Dùng pdfplumber để đọc (hoạt động tốt với cả PDF gốc và PDF từ ảnh nếu ảnh rõ nét)
-        with pdfplumber.open(pdf_file) as pdf:
-            for page in pdf.pages: 
-                extracted = page.extract_text()
-                if extracted:
-                    text_content += extracted + "\n"
-        
-        # Nếu PDF (từ ảnh) mà không trích xuất được text -> Cần OCR (Tesseract)
-        # Ở đây ta giả định pdfplumber đọc được text cơ bản. Nếu không, trả về thông báo nhập tay.
-        if not text_content.strip():
-             return {"date": "", "seller": "", "buyer": "", "inv_num": "", "inv_sym": "", "pre_tax": 0.0, "tax": 0.0, "total": 0.0, "all_numbers": []}, "Không đọc được chữ từ file này. Vui lòng nhập tay."
-
-    except Exception as e: return None, f"Lỗi đọc file: {str(e)}"
-    
-    all_found_numbers = set()
-    info = {"date": "", "seller": "", "buyer": "", "inv_num": "", "inv_sym": "", "pre_tax": 0.0, "tax": 0.0, "total": 0.0, "all_numbers": []}
-    
-    m_no = re.search(r'(?:Số hóa đơn|Số HĐ|Số|No)[:\s\.]*(\d{1,8})\b', text_content, re.IGNORECASE)
-    if m_no: info["inv_num"] = m_no.group(1).zfill(7)
-    m_sym = re.search(r'(?:Ký hiệu|Mẫu số|Serial)[:\s\.]*([A-Z0-9]{1,2}[A-Z0-9/-]{3,10})', text_content, re.IGNORECASE)
-    if m_sym: info["inv_sym"] = m_sym.group(1)
-    m_date = re.search(r'(?:Ngày|ngày)\s+(\d{1,2})\s+(?:tháng|Tháng)\s+(\d{1,2})\s+(?:năm|Năm)\s+(\d{4})', text_content)
-    if m_date: info["date"] = f"{int(m_date.group(1)):02d}/{int(m_date.group(2)):02d}/{m_date.group(3)}"
-    else:
-        m_date_alt = re.search(r'(\d{2}/\d{2}/\d{4})', text_content)
-        if m_date_alt: info["date"] = m_date_alt.group(1)
-    
-    lines = text_content.split('\n')
-    for line in lines:
-        line_l = line.lower()
-        nums = extract_numbers_from_line(line)
-        for n in nums: all_found_numbers.add(n)
-        if not nums: continue
-        val = max(nums)
-        if any(kw in line_l for kw in ["thanh toán", "tổng cộng"]): info["total"] = val
-        elif any(kw in line_l for kw in ["tiền hàng", "thành tiền"]): info["pre_tax"] = val
-        elif "thuế" in line_l and "suất" not in line_l: info["tax"] = val
-        
-    if info["total"] == 0 and all_found_numbers: info["total"] = max(all_found_numbers)
-    if info["pre_tax"] == 0: info["pre_tax"] = round(info["total"] / 1.08)
-    if info["tax"] == 0: info["tax"] = info["total"] - info["pre_tax"]
-    
-    for line in lines[:35]:
-        l_c = line.strip()
-        if re.search(r'^(Đơn vị bán|Người bán|Bên A|Nhà cung cấp)', l_c, re.IGNORECASE): info["seller"] = l_c.split(':')[-1].strip()
-        elif re.search(r'^(Đơn vị mua|Người mua|Khách hàng|Bên B)', l_c, re.IGNORECASE): info["buyer"] = l_c.split(':')[-1].strip()
-        
-    info["all_numbers"] = list(all_found_numbers) 
-    return info, msg
-
 # ==========================================
 # 4. GIAO DIỆN CHÍNH
 # ==========================================
@@ -282,8 +296,9 @@ if not st.session_state.logged_in:
     col_a, col_b, col_c = st.columns([1, 2, 1])
     with col_b:
         st.write("")
-        if comp['logo_b64_str']:
-            st.markdown(f'<div style="text-align:center;"><img src="data:image/png;base64,{comp["logo_b64_str"]}" height="120" class="header-logo"></div>', unsafe_allow_html=True)
+        if comp['logos'].get('login'):
+            _, c_logo, _ = st.columns([1, 1, 1])
+            with c_logo: show_logo('login')
         st.markdown(f"""<div style="text-align:center; margin-top:20px;"><h1 style="color:#28a745 !important;">{comp['name']}</h1><p>📍 {comp['address']}<br>📞 {comp['phone']}</p></div>""", unsafe_allow_html=True)
         
         tab_login, tab_reg = st.tabs(["🔐 Đăng nhập", "📝 Đăng ký"])
@@ -305,61 +320,155 @@ if not st.session_state.logged_in:
                         run_query("INSERT INTO users (username, password, role, status) VALUES (?, ?, ?, ?)", (nu, hash_pass(np), 'user', 'pending'), commit=True)
                         st.success("Đã gửi yêu cầu!")
                     except: st.error("Tên đã tồn tại!")
+    end_rerun()
     st.stop()
 
+# --- ADMIN PANEL (fragment: bấm nút/nhập liệu trong panel chỉ chạy lại panel) ---
+@perf_fragment
+def admin_panel():
+    st.caption("1. Duyệt User")
+    for u in run_query("SELECT * FROM users WHERE role='user'") or []:
+        c1, c2, c3 = st.columns([2,1,1])
+        c1.write(f"{u['username']} ({u['status']})")
+        if u['status'] == 'pending' and c2.button("✔", key=f"a_{u['id']}"):
+            run_query("UPDATE users SET status='approved' WHERE id=?", (u['id'],), commit=True); st.rerun(scope="fragment")
+        if c3.button("✖", key=f"d_{u['id']}"):
+            run_query("DELETE FROM users WHERE id=?", (u['id'],), commit=True); st.rerun(scope="fragment")
+
+    st.divider(); st.caption("2. Duyệt Yêu Cầu Sửa Giá")
+    # --- ADMIN DUYỆT YÊU CẦU SỬA ---
+    req_invoices = run_query("SELECT * FROM invoices WHERE request_edit=1 AND status='active'")
+    if req_invoices:
+        for r in req_invoices:
+            with st.container():
+                st.info(f"HĐ: {r['invoice_number']} | Tiền: {format_vnd(r['total_amount'])}")
+                ca, cb = st.columns(2)
+                if ca.button("Duyệt (Reset)", key=f"app_e_{r['id']}"):
+                    # Reset count và bỏ cờ request
+                    run_query("UPDATE invoices SET edit_count=0, request_edit=0 WHERE id=?", (r['id'],), commit=True)
+                    st.success("Đã duyệt!"); time.sleep(0.5); st.rerun()
+                if cb.button("Từ chối", key=f"den_e_{r['id']}"):
+                    run_query("UPDATE invoices SET request_edit=0 WHERE id=?", (r['id'],), commit=True)
+                    st.rerun()
+    else:
+        st.caption("Không có yêu cầu nào.")
+
+    st.divider(); st.caption("3. Cập nhật thông tin")
+    with st.form("comp_update"):
+        cn = st.text_input("Tên", value=comp['name'])
+        ca = st.text_input("Địa chỉ", value=comp['address'])
+        cp = st.text_input("SĐT", value=comp['phone'])
+        ul = st.file_uploader("Logo", type=['png','jpg'])
+        if st.form_submit_button("Lưu"):
+            try:
+                update_company_info(cn, ca, cp, ul.read() if ul else None)
+                st.success("Xong!"); time.sleep(0.5); st.rerun()
+            except OSError: st.error("File logo không đọc được!")
+
+    st.divider(); st.caption("4. Cache phân tích")
+    cs = run_query("SELECT hits, misses FROM cache_stats WHERE name='extract'", fetch_one=True)
+    cz = run_query("SELECT COUNT(*) AS n, COALESCE(SUM(size), 0) AS bytes FROM extract_cache", fetch_one=True)
+    if cs and cz:
+        total_req = cs['hits'] + cs['misses']
+        st.write(f"Hit: {cs['hits']} | Miss: {cs['misses']} | Tỉ lệ: {cs['hits'] / total_req:.0%}" if total_req else "Chưa có lượt phân tích.")
+        st.write(f"{cz['n']} file | {cz['bytes'] / 1024 / 1024:.1f} / {CACHE_MAX_BYTES // 1024 // 1024} MB")
+
+    st.divider(); st.caption("5. Báo cáo dự án")
+    if st.button("🔄 Tính lại bảng tổng hợp"):
+        get_db().write(rebuild_project_summary)
+        st.toast("Đã tính lại!")
+
+    st.divider(); st.caption("6. Kho file")
+    if st.button("📊 Thống kê kho file"):
+        with get_db().connection() as conn:
+            ss = store_stats(conn, get_blob_store())
+        st.write(f"{ss['files']} file ({ss['bytes'] / 1024 / 1024:.1f} MB) | {ss['refs']} hóa đơn tham chiếu | {ss['shared']} file dùng chung")
+        st.write(f"Ảnh thu nhỏ/xem trước: {ss['derived']} file ({ss['derived_bytes'] / 1024 / 1024:.1f} MB)")
+        st.write(f"File upload tạm: {get_upload_spool().usage() / 1024 / 1024:.1f} MB")
+    if st.button("🧹 Dọn file không dùng"):
+        with get_db().connection() as conn:
+            removed, freed = collect_garbage(conn, get_blob_store())
+        st.toast(f"Đã xóa {removed} file ({freed / 1024 / 1024:.1f} MB)")
+    if st.button("🖼️ Tạo ảnh thu nhỏ còn thiếu"):
+        # Hóa đơn lưu trước khi có ảnh thu nhỏ (hoặc tạo ảnh bị lỗi); render trên pool process dùng chung
+        bar = st.progress(0.0, text="Đang tạo ảnh...")
+        with get_db().connection() as conn:
+            done, failed = backfill_thumbs(conn, get_extract_pool(), progress=lambda n, total: bar.progress(n / total, text=f"{n}/{total} file"))
+        bar.empty()
+        st.toast(f"Đã tạo ảnh cho {done} file" + (f", lỗi {len(failed)}" if failed else ""))
+
+    st.divider(); st.caption("7. Hiệu năng")
+    pm = get_metrics()
+    pm.persist = st.toggle("Lưu số liệu vào DB (perf_metrics)", value=pm.persist)
+    ms_fmt = {c: st.column_config.NumberColumn(format="%.1f") for c in ["p50", "p95", "p99", "max", "total"]}
+    st.dataframe(pd.DataFrame(pm.summary(), columns=["name", "n", "p50", "p95", "p99", "max", "total"]), hide_index=True, column_config=ms_fmt)
+    st.caption("SQL chậm nhất (p95, ms)")
+    st.dataframe(pd.DataFrame(pm.slowest("sql"), columns=["name", "n", "p50", "p95", "p99", "max", "total"]), hide_index=True, column_config=ms_fmt)
+    st.caption("Số truy vấn mỗi lần chạy (app = cả trang)")
+    st.dataframe(pd.DataFrame(pm.queries_per_run(), columns=["scope", "runs", "avg", "max"]), hide_index=True,
+                 column_config={"avg": st.column_config.NumberColumn(format="%.1f")})
+    st.caption("Rerun theo session")
+    st.dataframe(pd.DataFrame(pm.reruns_by_session(), columns=["session", "user", "reruns", "completed", "p50"]), hide_index=True, column_config=ms_fmt)
+    if st.button("Xóa số liệu"): pm.clear(); st.rerun(scope="fragment")
+
+    st.divider(); st.caption("8. Hàng đợi xử lý")
+    count_query()
+    js = get_job_queue().stats()
+    st.write(f"Đang chờ/xử lý: {js['depth']} job | Job chờ lâu nhất: {js['oldest_wait']:.0f}s")
+    st.write(" | ".join(f"{JOB_LABELS[k]}: {v}" for k, v in sorted(js['counts'].items()) if k in JOB_LABELS) or "Chưa có job nào.")
+    if get_db().writer:
+        ws = get_db().writer.stats()
+        st.write(f"Writer: {ws['writes']} lệnh ghi / {ws['batches']} giao dịch (tối đa {ws['max_batch']}), lỗi {ws['errors']}, đang chờ {ws['pending']}")
+    s_fmt = {c: st.column_config.NumberColumn(format="%.2f s") for c in ["p50", "p95", "max"]}
+    st.dataframe(pd.DataFrame(js['timings'], columns=["step", "n", "p50", "p95", "max"]), hide_index=True, column_config=s_fmt)
+    # Bấm nút là panel chạy lại và đọc lại số liệu
+    st.button("🔄 Làm mới", key="jobs_refresh")
+
+    st.divider(); st.caption("9. Hóa đơn trùng")
+    if st.button("🔎 Quét hóa đơn trùng"):
+        count_query()
+        with get_db().connection() as conn:
+            groups = scan_duplicates(conn)
+        if not groups: st.success("Không có hóa đơn trùng.")
+        else:
+            st.warning(f"{len(groups)} nhóm trùng, {sum(g['n'] - 1 for g in groups)} bản thừa, tiền bị tính thừa {format_vnd(sum(g['extra'] or 0 for g in groups))}")
+            st.dataframe(pd.DataFrame([{"Mã HĐ": "#" + g['ids'].replace(",", ", #"), "Số bản": g['n'], "Ngày": g['date'], "Bên bán": g['seller'],
+                                        "Thừa": format_vnd(g['extra'])} for g in groups]), hide_index=True)
+            st.caption("Hủy các bản thừa ở mục Lịch sử (tab Nhập Hóa Đơn).")
+
+    st.divider(); st.caption("10. Lưu trữ")
+    count_query()
+    with get_db().connection() as conn:
+        archives = list_archives(conn)
+    for a in archives:
+        st.write(f"{a['year']}: {a['invoices']} hóa đơn ({a['deleted']} đã hủy) | {a['archived_at']}")
+    keep_from = st.number_input("Giữ lại từ năm", value=datetime.now().year, step=1, format="%d")
+    if WRITER_SOCKET:
+        # Chuyển lưu trữ (ATTACH file khác) và VACUUM không đi qua writer được; chạy từ app sẽ giữ khóa ghi lâu hơn
+        # busy_timeout, cả lô lệnh ghi đang gom của writer bị lỗi "database is locked"
+        st.info(f"App đang ghi qua writer: chạy chuyển lưu trữ bằng dòng lệnh lúc vắng người dùng "
+                f"(VACUUM thì dừng writer trước):\n\n`python archive.py run --before {keep_from}`")
+    elif st.button("📦 Chuyển hóa đơn cũ/đã hủy sang lưu trữ"):
+        with st.spinner("Đang chuyển..."):
+            moved = archive_invoices(get_db(), ARCHIVE_DIR, keep_from)
+            if moved: size, after = vacuum_db(get_db())
+        if moved: st.toast(f"Đã chuyển {sum(moved.values())} hóa đơn, DB: {size / 1024 / 1024:.1f} → {after / 1024 / 1024:.1f} MB"); st.rerun(scope="fragment")
+        else: st.toast("Không có hóa đơn cần chuyển.")
+
+    st.divider()
+    if st.button("🗑️ Xóa TẤT CẢ hóa đơn", type="primary"):
+        get_db().write(delete_all_invoices)
+        remove_archive_files(ARCHIVE_DIR)
+        get_blob_store().clear()
+        st.toast("Đã xóa sạch!"); time.sleep(1); st.rerun()
+
 # --- SIDEBAR ---
 with st.sidebar:
-    if comp['logo_b64_str']: st.markdown(f'<div style="text-align:center;"><img src="data:image/png;base64,{comp["logo_b64_str"]}" width="150" style="border-radius:10px;"></div>', unsafe_allow_html=True)
+    show_logo('sidebar')
     st.success(f"Chào, **{st.session_state.user_info['name']}**")
     
     if st.session_state.user_info['role'] == 'admin':
-        with st.expander("⚙️ Admin Panel"):
-            st.caption("1. Duyệt User")
-            for u in run_query("SELECT * FROM users WHERE role='user'") or []:
-                c1, c2, c3 = st.columns([2,1,1])
-                c1.write(f"{u['username']} ({u['status']})")
-                if u['status'] == 'pending' and c2.button("✔", key=f"a_{u['id']}"):
-                    run_query("UPDATE users SET status='approved' WHERE id=?", (u['id'],), commit=True); st.rerun()
-                if c3.button("✖", key=f"d_{u['id']}"):
-                    run_query("DELETE FROM users WHERE id=?", (u['id'],), commit=True); st.rerun()
-            
-            st.divider(); st.caption("2. Duyệt Yêu Cầu Sửa Giá")
-            # --- ADMIN DUYỆT YÊU CẦU SỬA ---
-            req_invoices = run_query("SELECT * FROM invoices WHERE request_edit=1 AND status='active'")
-            if req_invoices:
-                for r in req_invoices:
-                    with st.container():
-                        st.info(f"HĐ: {r['invoice_number']} | Tiền: {format_vnd(r['total_amount'])}")
-                        ca, cb = st.columns(2)
-                        if ca.button("Duyệt (Reset)", key=f"app_e_{r['id']}"):
-                            # Reset count và bỏ cờ request
-                            run_query("UPDATE invoices SET edit_count=0, request_edit=0 WHERE id=?", (r['id'],), commit=True)
-                            st.success("Đã duyệt!"); time.sleep(0.5); st.rerun()
-                        if cb.button("Từ chối", key=f"den_e_{r['id']}"):
-                            run_query("UPDATE invoices SET request_edit=0 WHERE id=?", (r['id'],), commit=True)
-                            st.rerun()
-            else:
-                st.caption("Không có yêu cầu nào.")
-
-            st.divider(); st.caption("3. Cập nhật thông tin")
-            with st.form("comp_update"):
-                cn = st.text_input("Tên", value=comp['name'])
-                ca = st.text_input("Địa chỉ", value=comp['address'])
-                cp = st.text_input("SĐT", value=comp['phone'])
-                ul = st.file_uploader("Logo", type=['png','jpg'])
-                if st.form_submit_button("Lưu"):
-                    update_company_info(cn, ca, cp, ul.read() if ul else None)
-                    st.success("Xong!"); time.sleep(0.5); st.rerun()
-            
-            st.divider()
-            if st.button("🗑️ Xóa TẤT CẢ hóa đơn", type="primary"):
-                run_query("DELETE FROM invoices", commit=True)
-                run_query("DELETE FROM sqlite_sequence WHERE name='invoices'", commit=True)
-                if os.path.exists(UPLOAD_FOLDER):
-                    for f in os.listdir(UPLOAD_FOLDER):
-                        try: os.remove(os.path.join(UPLOAD_FOLDER, f))
-                        except: pass
-                st.toast("Đã xóa sạch!"); time.sleep(1); st.rerun()
+        with st.expander("⚙️ Admin Panel"): admin_panel()
 
     if st.button("Đăng xuất", use_container_width=True):
         st.session_state.logged_in = False; st.rerun()
@@ -367,164 +476,358 @@ with st.sidebar:
     menu = st.radio("MENU", ["1. Nhập Hóa Đơn", "2. Liên Kết Dự Án", "3. Báo Cáo Tổng Hợp"])
 
 # --- HEADER ---
-l_html = f'<img src="data:image/png;base64,{comp["logo_b64_str"]}" height="80" class="header-logo">' if comp['logo_b64_str'] else ''
-st.markdown(f'<div class="company-header">{l_html}<div><h1 style="margin:0; color:#28a745;">{comp["name"]}</h1><p style="margin:0;">{comp["address"]} | {comp["phone"]}</p></div></div>', unsafe_allow_html=True)
+h_text = f'<div><h1 style="margin:0; color:#28a745;">{comp["name"]}</h1><p style="margin:0;">{comp["address"]} | {comp["phone"]}</p></div>'
+if comp['logos'].get('header'):
+    with st.container(key="company_header"):
+        h_logo, h_name = st.columns([1, 5], vertical_alignment="center")
+        with h_logo: show_logo('header')
+        with h_name: st.markdown(h_text, unsafe_allow_html=True)
+else: st.markdown(f'<div class="company-header">{h_text}</div>', unsafe_allow_html=True)
 
 # State init
 if "pdf_data" not in st.session_state: st.session_state.pdf_data = None
 if "edit_lock" not in st.session_state: st.session_state.edit_lock = True
 if "local_edit_count" not in st.session_state: st.session_state.local_edit_count = 0
 if "uploader_key" not in st.session_state: st.session_state.uploader_key = 0
-if "uploaded_file_obj" not in st.session_state: st.session_state.uploaded_file_obj = None
+if "upload" not in st.session_state: st.session_state.upload = None
+if "job_id" not in st.session_state: st.session_state.job_id = None
+if "saving_jobs" not in st.session_state: st.session_state.saving_jobs = []
+
+# --- FRAGMENT: mỗi vùng tự chạy lại khi người dùng thao tác trong vùng đó ---
+# Xem trước: đổi trang chỉ render lại cột xem trước
+@perf_fragment
+def preview_column(upload):
+    try:
+        # Hiển thị PDF
+        # Chỉ render trang đang xem (đọc từ file spool), ảnh trang lấy từ cache nếu đã render trước đó
+        pv = get_preview_cache()
+        f_hash = upload['hash']
+        if not upload['is_image']:
+            n_pages = len(pv.page_sizes(f_hash, upload['path']))
+            st.info(f"{n_pages} trang")
+            page_no = st.number_input("Trang", min_value=1, max_value=n_pages, value=1, step=1, key=f"pv_{f_hash[:12]}") if n_pages > 1 else 1
+            with get_metrics().timer("preview", "render_page"):
+                page_img = pv.render_page(f_hash, upload['path'], page_no - 1)
+            st.image(page_img, caption=f"Trang {page_no}", use_container_width=True)
+        # Hiển thị Ảnh (bản thu nhỏ)
+        else:
+            with get_metrics().timer("preview", "render_image"):
+                st.image(pv.render_image(f_hash, upload['path']), caption="Ảnh hóa đơn", use_container_width=True)
+    except: st.error("Lỗi hiển thị file")
+
+# Tiến độ job nền: mỗi giây chỉ hỏi lại DB trạng thái các job, xong hết thì chạy lại cả trang để hiện kết quả
+@perf_fragment(run_every=1)
+def job_progress(job_ids):
+    count_query()
+    jobs = get_job_queue().get(job_ids)
+    if not any(j['state'] in JOB_ACTIVE for j in jobs.values()): st.rerun()
+    if len(jobs) == 1:
+        j = next(iter(jobs.values()))
+        st.info(f"{JOB_LABELS[j['state']]}: {j['file_name']}" + (f" (còn {j['ahead']} file phía trước)" if j['ahead'] else ""))
+        return
+    done = sum(j['state'] not in JOB_ACTIVE for j in jobs.values())
+    st.progress(done / len(jobs), text=f"{done}/{len(jobs)} file")
+    st.dataframe(pd.DataFrame([{"File": j['file_name'], "Trạng thái": JOB_LABELS[j['state']], "Ghi chú": j['error'] or j['msg'] or ""}
+                               for j in jobs.values()]), hide_index=True, use_container_width=True)
+
+# Form hóa đơn: Phân tích chỉ xếp job vào hàng đợi; Sửa giá / Chốt giá chỉ chạy lại form, lưu xong mới chạy lại cả trang
+@perf_fragment
+def invoice_form(upload):
+    jq = get_job_queue()
+    if st.button("🔍 PHÂN TÍCH", type="primary", use_container_width=True):
+        # Phân tích lại thì bỏ job cũ của form này
+        if st.session_state.job_id: jq.discard([st.session_state.job_id])
+        st.session_state.job_id = jq.enqueue([(upload['name'], upload['path'], upload['is_image'], upload['hash'])],
+                                             st.session_state.perf_sid, st.session_state.user_info['name'])[0]
+        st.session_state.pdf_data = None; st.session_state.edit_lock = True; st.session_state.local_edit_count = 0
+
+    if st.session_state.job_id and not st.session_state.pdf_data:
+        job = jq.get([st.session_state.job_id]).get(st.session_state.job_id)
+        if job and job['state'] in JOB_ACTIVE: job_progress([job['id']])
+        elif job and job['state'] == 'ready':
+            data, msg = job['result'], job['msg']
+
+            if msg: st.warning(msg)
+
+            data['file_name'] = job['file_name']
+            key = dedup_key(data['inv_sym'], data['inv_num'], data['seller'])
+            dup = saved_duplicates([key]).get(key)
+            data['dup_text'] = dup_text(dup) if dup else None
+            st.session_state.pdf_data = data
+            diff = abs(data['total'] - (data['pre_tax'] + data['tax']))
+            if diff < 10: st.success(f"✅ Chuẩn! Tổng: {format_vnd(data['total'])}")
+            else: st.warning(f"⚠️ Lệch: {format_vnd(diff)}")
+        else:
+            st.error((job or {}).get('error') or "Không phân tích được file")
+            st.session_state.job_id = None
+
+    if st.session_state.pdf_data:
+        d = st.session_state.pdf_data
+        if d.get('dup_text'): st.warning(f"⚠️ Hóa đơn này đã được lưu: {d['dup_text']}")
+        with st.form("inv_form"):
+            typ = st.radio("Loại", ["Đầu vào", "Đầu ra"], horizontal=True)
+            # Thêm Link Drive
+            drive_link = st.text_input("🔗 Link Drive (Tùy chọn)")
+
+            memo = st.text_input("Gợi nhớ", value=d.get('file_name',''))
+            date = st.text_input("Ngày", value=d['date'])
+            c1, c2 = st.columns(2)
+            num = c1.text_input("Số", value=d['inv_num']); sym = c2.text_input("Ký hiệu", value=d['inv_sym'])
+            st.divider()
+            seller = st.text_input("Bên Bán", value=d['seller'])
+            buyer = st.text_input("Bên Mua", value=d['buyer'])
+
+            st.markdown("#### 💰 Tiền")
+            pre = st.number_input("Tiền hàng", value=float(d['pre_tax']), disabled=st.session_state.edit_lock, format="%.0f")
+            tax = st.number_input("VAT", value=float(d['tax']), disabled=st.session_state.edit_lock, format="%.0f")
+            total = pre + tax
+
+            # CẢNH BÁO CHỈNH SỬA & LOGIC ADMIN
+            is_locked_admin = False
+            if st.session_state.local_edit_count == 1:
+                st.markdown('<div style="background:#ffeef7; color:red; padding:10px; border-radius:5px; margin-bottom:10px;">🌸 <b>Lần sửa 1/2:</b> Cẩn thận nha!</div>', unsafe_allow_html=True)
+            elif st.session_state.local_edit_count >= 2:
+                is_locked_admin = True
+                st.markdown('<div style="background:#fff3cd; color:orange; padding:10px; border-radius:5px; margin-bottom:10px;">🍊 <b>Hết lượt sửa!</b> Cần gửi yêu cầu Admin duyệt để lưu.</div>', unsafe_allow_html=True)
+
+            st.markdown(f'<div class="money-box">{format_vnd(total)}</div>', unsafe_allow_html=True)
+
+            b1, b2 = st.columns(2)
+            if b1.form_submit_button("✏️ Sửa giá"):
+                if not is_locked_admin:
+                    st.session_state.edit_lock = False; st.rerun(scope="fragment")
+                else: st.error("Đã hết lượt sửa!")
+
+            if not st.session_state.edit_lock and b2.form_submit_button("✅ Chốt giá"):
+                st.session_state.pdf_data.update({'pre_tax': pre, 'tax': tax, 'total': total})
+                st.session_state.edit_lock = True; st.session_state.local_edit_count += 1; st.rerun(scope="fragment")
+
+            # Khóa chống trùng theo giá trị đang nhập trên form
+            key = dedup_key(sym, num, seller)
+
+            # NÚT LƯU THAY ĐỔI THEO TRẠNG THÁI
+            btn_label = "🚀 GỬI YÊU CẦU DUYỆT" if is_locked_admin else "💾 LƯU HÓA ĐƠN"
+
+            if st.form_submit_button(btn_label, type="primary", use_container_width=True):
+                if not date or not num: st.error("Thiếu ngày/số!")
+                elif not st.session_state.edit_lock: st.warning("Chốt giá trước!")
+                elif dup := saved_duplicates([key]).get(key):
+                    st.error(f"Trùng hóa đơn đã lưu {dup_text(dup)}: cùng ký hiệu, số và bên bán!")
+                else:
+                    t = 'OUT' if "Đầu ra" in typ else 'IN'
+                    req_flag = 1 if is_locked_admin else 0
+                    fields = dict(t=t, date=date, num=num, sym=sym, seller=seller, buyer=buyer, pre=pre, tax=tax, total=total,
+                                  edit_count=st.session_state.local_edit_count, memo=memo, drive_link=drive_link, req_flag=req_flag)
+                    # Ghi kho file + hóa đơn do worker làm, trang chỉ theo dõi tới khi lưu xong
+                    if jq.request_save({st.session_state.job_id: fields}):
+                        st.session_state.saving_jobs.append(st.session_state.job_id)
+                        st.toast("Đang gửi yêu cầu duyệt cho Admin..." if is_locked_admin else "Đang lưu hóa đơn...")
+                        # Chạy lại cả trang: làm mới ô upload
+                        get_upload_spool().release(st.session_state.upload)
+                        st.session_state.pdf_data = None; st.session_state.job_id = None; st.session_state.uploader_key += 1; st.session_state.upload = None; st.rerun()
+                    else: st.error("Kết quả phân tích đã hết hạn, hãy phân tích lại!")
+
+# Lịch sử: gõ tìm kiếm / hủy hóa đơn chỉ truy vấn lại danh sách
+@perf_fragment
+def history_list():
+    # Kỳ cũ đã chuyển sang file lưu trữ: chỉ gắn file đó vào kết nối khi người dùng chọn
+    archives = {r['year']: r['path'] for r in run_query("SELECT year, path FROM archives ORDER BY year DESC")}
+    h1, h2 = st.columns([3, 1])
+    search_q = h1.text_input("🔎 Tìm hóa đơn (số, ký hiệu, bên bán/mua, gợi nhớ, nội dung file)", key="hist_q")
+    # "Tất cả các kỳ": tìm kiếm gồm cả file lưu trữ; không gõ tìm thì như Hiện hành (hóa đơn mới nhất nằm ở DB nóng)
+    period = h2.selectbox("Kỳ", (["Tất cả các kỳ"] if archives else []) + ["Hiện hành"] + [f"Lưu trữ {y}" for y in archives], key="hist_period")
+    year = period.removeprefix("Lưu trữ ") if period.startswith("Lưu trữ ") else None
+    if period == "Tất cả các kỳ" and fts_query(search_q):
+        count_query()
+        rows = search_all_periods(get_db(), search_q)
+        if not rows: st.caption("Không tìm thấy hóa đơn phù hợp.")
+    elif year:
+        count_query()
+        try:
+            with attach_archive(get_db(), archives[year]) as conn:
+                if fts_query(search_q): rows = search_invoices(conn, search_q, schema="arch")
+                else: rows = conn.execute("SELECT * FROM arch.invoices ORDER BY id DESC LIMIT 15").fetchall()
+        except FileNotFoundError:
+            st.error(f"Không tìm thấy file lưu trữ {archives[year]}"); return
+        st.caption(f"Dữ liệu lưu trữ năm {year} (chỉ xem)")
+        if fts_query(search_q) and not rows: st.caption("Không tìm thấy hóa đơn phù hợp.")
+    elif fts_query(search_q):
+        # Kết quả xếp theo độ liên quan (bm25)
+        count_query()
+        with get_db().connection() as conn:
+            rows = search_invoices(conn, search_q)
+        if not rows: st.caption("Không tìm thấy hóa đơn phù hợp.")
+    else:
+        # Lấy tất cả (kể cả xóa) để hiển thị
+        rows = run_query("SELECT * FROM invoices ORDER BY id DESC LIMIT 15")
+    if rows:
+        for r in map(dict, rows):
+            # Dòng tìm thấy trong file lưu trữ (tìm tất cả các kỳ): chỉ xem như khi chọn kỳ lưu trữ
+            r_year = year or r.get('archive_year')
+            # Xử lý giao diện hàng xóa
+            bg_style = "deleted-row" if r['status'] == 'deleted' else "active-row"
+            req_msg = " | ⏳ Đang chờ duyệt sửa" if r.get('request_edit') == 1 else ""
+            if r_year and not year: req_msg += f" | 📦 Lưu trữ {r_year}"
+
+            with st.container():
+                # Ảnh thu nhỏ tạo sẵn lúc lưu, chỉ đọc từ đĩa; bấm 🔍 xem ảnh trang đầu (cũng tạo sẵn)
+                thumb = thumb_path(r['file_path']) if r.get('file_path') else None
+                has_thumb = thumb and os.path.exists(thumb)
+                c_img, c_row, c_pv = st.columns([1, 12, 1], vertical_alignment="center")
+                if has_thumb: c_img.image(thumb, width=48)
+                c_row.markdown(f"""
+                    <div class="{bg_style}" style="display: flex; align-items: center; justify-content: space-between;">
+                        <div style="flex:1"><b>#{r['id']}</b></div>
+                        <div style="flex:1">{r['type']}</div>
+                        <div style="flex:3">{r['memo']} | {r['invoice_number']} {req_msg}</div>
+                        <div style="flex:2; font-weight:bold;">{format_vnd(r['total_amount'])}</div>
+                        <div style="flex:1">{r['status']}</div>
+                    </div>
+                """, unsafe_allow_html=True)
+                pv_key = (r_year, r['id'])
+                if has_thumb and c_pv.button("🔍", key=f"hpv_{r_year or ''}_{r['id']}"):
+                    st.session_state.hist_preview = None if st.session_state.get("hist_preview") == pv_key else pv_key
+                if r.get('snippet'): st.caption(r['snippet'])
+                if has_thumb and st.session_state.get("hist_preview") == pv_key and os.path.exists(thumb_path(r['file_path'], "preview")):
+                    st.image(thumb_path(r['file_path'], "preview"), width=600)
+
+                # Nút chức năng (chỉ hiện cho active)
+                if r['status'] == 'active' and not r_year and st.session_state.user_info['role'] == 'admin':
+                    if st.button("❌ Hủy", key=f"del_{r['id']}"):
+                        run_query("UPDATE invoices SET status='deleted' WHERE id=?", (r['id'],), commit=True); st.rerun(scope="fragment")
 
 # --- TAB 1: NHẬP HÓA ĐƠN ---
 if menu == "1. Nhập Hóa Đơn":
-    uploaded_file = st.file_uploader("Upload Hóa Đơn (PDF/Ảnh)", type=["pdf", "png", "jpg", "jpeg"], key=f"up_{st.session_state.uploader_key}")
-    show_pdf = st.checkbox("Xem File", value=True)
-    
-    if uploaded_file:
-        # Lưu file tạm vào session state để dùng khi lưu
-        st.session_state.uploaded_file_obj = uploaded_file
-        
+    jq = get_job_queue()
+    # Hóa đơn đang lưu ở nền: theo dõi tới khi xong rồi báo kết quả
+    if st.session_state.saving_jobs:
+        count_query()
+        saving = jq.get(st.session_state.saving_jobs)
+        if any(j['state'] in JOB_ACTIVE for j in saving.values()): job_progress(list(saving))
+        else:
+            saved = [j for j in saving.values() if j['state'] == 'saved']
+            if saved: st.success(f"Đã lưu {len(saved)} hóa đơn!")
+            if any(j['fields'].get('req_flag') for j in saved): st.success("Đã gửi yêu cầu duyệt cho Admin!")
+            for j in saving.values():
+                if j['state'] != 'saved': st.error(f"Không lưu được {j['file_name']}: {j['error']}")
+            st.session_state.saving_jobs = []
+
+    # Hóa đơn đã phân tích ở phiên trước (vd. trước khi app khởi động lại) mà chưa lưu
+    count_query()
+    unsaved = jq.unsaved(st.session_state.user_info['name'], st.session_state.perf_sid)
+    if unsaved:
+        u1, u2, u3 = st.columns([4, 1, 1], vertical_alignment="center")
+        u1.info(f"📋 Có {len(unsaved)} hóa đơn đã phân tích nhưng chưa lưu")
+        if u2.button("Mở lại", use_container_width=True):
+            jq.adopt(unsaved, st.session_state.perf_sid)
+            st.session_state.batch_mode = True; st.session_state.batch_jobs = {'ids': unsaved}; st.rerun()
+        if u3.button("Bỏ hết", use_container_width=True):
+            jq.discard(unsaved); st.rerun()
+
+    batch_mode = st.toggle("📦 Nhập hàng loạt (nhiều file)", key="batch_mode")
+    upload = None
+    if not batch_mode:
+        upload = st.session_state.upload
+        # Chạm file spool mỗi lần rerun để không bị dọn; file đã bị dọn (phiên bỏ quá lâu) thì upload lại
+        if upload and not get_upload_spool().touch(upload): drop_upload(); upload = None
+        if upload:
+            f1, f2 = st.columns([4, 1], vertical_alignment="center")
+            f1.info(f"📎 {upload['name']} ({upload['size'] / 1024 / 1024:.1f} MB)")
+            if f2.button("Đổi file", use_container_width=True): drop_upload(); st.rerun()
+        else:
+            new_file = st.file_uploader("Upload Hóa Đơn (PDF/Ảnh)", type=["pdf", "png", "jpg", "jpeg"], key=f"up_{st.session_state.uploader_key}")
+            if new_file:
+                # Chép ra đĩa ngay rồi làm mới ô upload: từ đây chỉ dùng handle
+                st.session_state.uploader_key += 1
+                try:
+                    st.session_state.upload = spool_upload(new_file); st.session_state.pdf_data = None; st.session_state.job_id = None
+                    st.rerun()
+                except SpoolFull as e: st.error(str(e))
+        show_pdf = st.checkbox("Xem File", value=True)
+    else:
+        # --- NHẬP HÀNG LOẠT: xếp cả lô vào hàng đợi (worker phân tích song song trên pool process), duyệt rồi lưu một lần ---
+        if "batch_jobs" not in st.session_state: st.session_state.batch_jobs = None
+        files = st.file_uploader("Upload nhiều Hóa Đơn (PDF/Ảnh)", type=["pdf", "png", "jpg", "jpeg"], accept_multiple_files=True, key=f"upb_{st.session_state.uploader_key}")
+        bj = st.session_state.batch_jobs
+
+        if files and st.button(f"🔍 PHÂN TÍCH {len(files)} FILE", type="primary", use_container_width=True):
+            # Chép cả lô ra đĩa (trả RAM cho Streamlit), job giữ file qua hard link nên bản spool bỏ ngay sau khi xếp hàng
+            spool, handles = get_upload_spool(), []
+            try:
+                for f in files: handles.append(spool_upload(f))
+                if bj: jq.discard(bj['ids'])
+                # File đã phân tích trước đó worker lấy thẳng từ cache, không gửi sang pool
+                ids = jq.enqueue([(h['name'], h['path'], h['is_image'], h['hash']) for h in handles],
+                                 st.session_state.perf_sid, st.session_state.user_info['name'])
+                st.session_state.batch_jobs = bj = {'ids': ids}
+            except SpoolFull as e: st.toast(str(e), icon="⚠️")
+            finally:
+                for h in handles: spool.release(h)
+                for f in files: forget_upload(f)
+            st.session_state.uploader_key += 1; st.rerun()
+
+        if bj:
+            count_query()
+            jobs = jq.get(bj['ids'])
+            if any(j['state'] in JOB_ACTIVE for j in jobs.values()): job_progress(bj['ids'])
+            else:
+                rows = []
+                review = [jobs[i] for i in bj['ids'] if i in jobs and jobs[i]['state'] in ('ready', 'failed')]
+                keys = {j['id']: dedup_key(j['result']['inv_sym'], j['result']['inv_num'], j['result']['seller']) for j in review if j['result']}
+                # Trùng hóa đơn đã lưu hoặc trùng file trước đó trong lô: mặc định không lưu
+                saved_dups, first_in_batch = saved_duplicates(keys.values()), {}
+                for j in review:
+                    d = j['result'] or {}
+                    key = keys.get(j['id'])
+                    dup = (f"Trùng hóa đơn đã lưu {dup_text(saved_dups[key])}" if key in saved_dups else
+                           f"Trùng file {first_in_batch[key]} trong lô" if key in first_in_batch else None)
+                    if key and key not in first_in_batch: first_in_batch[key] = j['file_name']
+                    rows.append({"Lưu": j['state'] == 'ready' and not dup and d.get('date', '') != '' and d.get('inv_num', '') != '', "job": j['id'], "File": j['file_name'],
+                                 "Loại": "Đầu vào", "Ngày": d.get('date', ''), "Số": d.get('inv_num', ''), "Ký hiệu": d.get('inv_sym', ''),
+                                 "Bên Bán": d.get('seller', ''), "Bên Mua": d.get('buyer', ''),
+                                 "Tiền hàng": float(d.get('pre_tax', 0)), "VAT": float(d.get('tax', 0)), "Tổng": float(d.get('total', 0)),
+                                 "Gợi nhớ": j['file_name'],
+                                 "Trạng thái": "❌ Lỗi" if j['state'] == 'failed' else ("🔁 Trùng" if dup else ("⚠️ Cần kiểm tra" if j['msg'] else "✅ Xong")),
+                                 "Ghi chú": dup or j['error'] or j['msg'] or ""})
+                st.caption("Kiểm tra lại từng dòng trước khi lưu. Muốn sửa giá thì dùng chế độ nhập từng file.")
+                edited = st.data_editor(pd.DataFrame(rows), hide_index=True, use_container_width=True, key=f"be_{st.session_state.uploader_key}",
+                                        column_config={"job": None,
+                                                       "Lưu": st.column_config.CheckboxColumn(required=True),
+                                                       "Loại": st.column_config.SelectboxColumn(options=["Đầu vào", "Đầu ra"], required=True),
+                                                       "Tiền hàng": st.column_config.NumberColumn(format="%.0f"),
+                                                       "VAT": st.column_config.NumberColumn(format="%.0f"),
+                                                       "Tổng": st.column_config.NumberColumn(format="%.0f")},
+                                        disabled=["File", "Tiền hàng", "VAT", "Tổng", "Trạng thái", "Ghi chú"])
+
+                if rows and st.button("💾 LƯU TẤT CẢ", type="primary", use_container_width=True):
+                    to_save, skipped, batch_keys = {}, [], set()
+                    for _, r in edited[edited['Lưu']].iterrows():
+                        key = dedup_key(r['Ký hiệu'], r['Số'], r['Bên Bán'])
+                        # Trùng dòng khác trong lô thì chỉ lưu dòng đầu (trùng hóa đơn đã lưu thì worker báo lỗi)
+                        if not r['Ngày'] or not r['Số'] or (key and key in batch_keys):
+                            skipped.append(r['File']); continue
+                        if key: batch_keys.add(key)
+                        t = 'OUT' if "Đầu ra" in r['Loại'] else 'IN'
+                        to_save[int(r['job'])] = dict(t=t, date=r['Ngày'], num=r['Số'], sym=r['Ký hiệu'], seller=r['Bên Bán'], buyer=r['Bên Mua'],
+                                                      pre=float(r['Tiền hàng']), tax=float(r['VAT']), total=float(r['Tổng']), edit_count=0, memo=r['Gợi nhớ'])
+                    accepted = jq.request_save(to_save)
+                    skipped += [jobs[i]['file_name'] for i in to_save if i not in accepted]
+                    # Dòng không chọn lưu thì bỏ luôn job
+                    jq.discard([i for i in bj['ids'] if i not in accepted])
+                    st.session_state.saving_jobs += accepted
+                    st.toast(f"Đang lưu {len(accepted)} hóa đơn...")
+                    if skipped: st.toast("Bỏ qua (thiếu ngày/số, trùng hoặc lỗi file): " + ", ".join(skipped), icon="⚠️")
+                    st.session_state.batch_jobs = None; st.session_state.uploader_key += 1; st.rerun()
+
+    if upload:
         c_pdf, c_form = st.columns([1,1]) if show_pdf else (None, st.container())
         if show_pdf:
-            with c_pdf:
-                try:
-                    # Hiển thị PDF
-                    if "pdf" in uploaded_file.type:
-                        with pdfplumber.open(uploaded_file) as pdf:
-                            st.info(f"{len(pdf.pages)} trang")
-                            for i, p in enumerate(pdf.pages):
-                                st.image(p.to_image(resolution=300).original, caption=f"Trang {i+1}", use_container_width=True)
-                    # Hiển thị Ảnh
-                    else:
-                        st.image(uploaded_file, caption="Ảnh hóa đơn", use_container_width=True)
-                except: st.error("Lỗi hiển thị file")
+            with c_pdf: preview_column(upload)
         
-        with c_form:
-            if st.button("🔍 PHÂN TÍCH", type="primary", use_container_width=True):
-                is_img = "pdf" not in uploaded_file.type
-                data, msg = extract_data_smart(uploaded_file, is_image=is_img)
-                
-                if msg: st.warning(msg)
-                
-                data['file_name'] = uploaded_file.name
-                st.session_state.pdf_data = data; st.session_state.edit_lock = True; st.session_state.local_edit_count = 0
-                diff = abs(data['total'] - (data['pre_tax'] + data['tax']))
-                if diff < 10: st.success(f"✅ Chuẩn! Tổng: {format_vnd(data['total'])}")
-                else: st.warning(f"⚠️ Lệch: {format_vnd(diff)}")
-
-            if st.session_state.pdf_data:
-                d = st.session_state.pdf_data
-                with st.form("inv_form"):
-                    typ = st.radio("Loại", ["Đầu vào", "Đầu ra"], horizontal=True)
-                    # Thêm Link Drive
-                    drive_link = st.text_input("🔗 Link Drive (Tùy chọn)")
-                    
-                    memo = st.text_input("Gợi nhớ", value=d.get('file_name',''))
-                    date = st.text_input("Ngày", value=d['date'])
-                    c1, c2 = st.columns(2)
-                    num = c1.text_input("Số", value=d['inv_num']); sym = c2.text_input("Ký hiệu", value=d['inv_sym'])
-                    st.divider()
-                    seller = st.text_input("Bên Bán", value=d['seller'])
-                    buyer = st.text_input("Bên Mua", value=d['buyer'])
-                    
-                    st.markdown("#### 💰 Tiền")
-                    pre = st.number_input("Tiền hàng", value=float(d['pre_tax']), disabled=st.session_state.edit_lock, format="%.0f")
-                    tax = st.number_input("VAT", value=float(d['tax']), disabled=st.session_state.edit_lock, format="%.0f")
-                    total = pre + tax
-                    
-                    # CẢNH BÁO CHỈNH SỬA & LOGIC ADMIN
-                    is_locked_admin = False
-                    if st.session_state.local_edit_count == 1:
-                        st.markdown('<div style="background:#ffeef7; color:red; padding:10px; border-radius:5px; margin-bottom:10px;">🌸 <b>Lần sửa 1/2:</b> Cẩn thận nha!</div>', unsafe_allow_html=True)
-                    elif st.session_state.local_edit_count >= 2:
-                        is_locked_admin = True
-                        st.markdown('<div style="background:#fff3cd; color:orange; padding:10px; border-radius:5px; margin-bottom:10px;">🍊 <b>Hết lượt sửa!</b> Cần gửi yêu cầu Admin duyệt để lưu.</div>', unsafe_allow_html=True)
-
-                    st.markdown(f'<div class="money-box">{format_vnd(total)}</div>', unsafe_allow_html=True)
-                    
-                    b1, b2 = st.columns(2)
-                    if b1.form_submit_button("✏️ Sửa giá"):
-                        if not is_locked_admin:
-                            st.session_state.edit_lock = False; st.rerun()
-                        else: st.error("Đã hết lượt sửa!")
-                    
-                    if not st.session_state.edit_lock and b2.form_submit_button("✅ Chốt giá"):
-                        st.session_state.pdf_data.update({'pre_tax': pre, 'tax': tax, 'total': total})
-                        st.session_state.edit_lock = True; st.session_state.local_edit_count += 1; st.rerun()
-
-                    # NÚT LƯU THAY ĐỔI THEO TRẠNG THÁI
-                    btn_label = "🚀 GỬI YÊU CẦU DUYỆT" if is_locked_admin else "💾 LƯU HÓA ĐƠN"
-                    
-                    if st.form_submit_button(btn_label, type="primary", use_container_width=True):
-                        if not date or not num: st.error("Thiếu ngày/số!")
-                        elif not st.session_state.edit_lock: st.warning("Chốt giá trước!")
-                        else:
-                            # Xử lý lưu file (Nếu là ảnh thì convert sang PDF để lưu)
-                            f_obj = st.session_state.uploaded_file_obj
-                            f_obj.seek(0)
-                            
-                            is_img = "pdf" not in f_obj.type
-                            pdf_bytes = None
-                            if is_img:
-                                pdf_buffer = convert_image_to_pdf(f_obj)
-                                if pdf_buffer: pdf_bytes = pdf_buffer.getvalue()
-                            
-                            if is_img and pdf_bytes:
-                                # Lưu PDF đã convert
-                                path, final_name = save_file_local(f_obj, is_converted_pdf=True, pdf_bytes=pdf_bytes)
-                            else:
-                                # Lưu file gốc (PDF)
-                                path, final_name = save_file_local(f_obj)
-
-                            if path:
-                                t = 'OUT' if "Đầu ra" in typ else 'IN'
-                                req_flag = 1 if is_locked_admin else 0
-                                
-                                run_query("""INSERT INTO invoices 
-                                (type, date, invoice_number, invoice_symbol, seller_name, buyer_name, 
-                                pre_tax_amount, tax_amount, total_amount, file_name, status, 
-                                edit_count, created_at, memo, file_path, drive_link, request_edit) 
-                                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                                          (t, date, num, sym, seller, buyer, pre, tax, total, final_name, 
-                                           'active', st.session_state.local_edit_count, 
-                                           datetime.now().strftime("%Y-%m-%d %H:%M:%S"), memo, path, drive_link, req_flag), commit=True)
-                                
-                                if is_locked_admin: st.success("Đã gửi yêu cầu duyệt cho Admin!")
-                                else: st.success("Đã lưu thành công!")
-                                
-                                time.sleep(1)
-                                st.session_state.pdf_data = None; st.session_state.uploader_key += 1; st.session_state.uploaded_file_obj = None; st.rerun()
+        with c_form: invoice_form(upload)
 
     st.divider()
-    with st.expander("Lịch sử", expanded=True):
-        # Lấy tất cả (kể cả xóa) để hiển thị
-        rows = run_query("SELECT * FROM invoices ORDER BY id DESC LIMIT 15")
-        if rows:
-            df = pd.DataFrame([dict(r) for r in rows])
-            df['Tiền'] = df['total_amount'].apply(format_vnd)
-            
-            for _, r in df.iterrows():
-                # Xử lý giao diện hàng xóa
-                bg_style = "deleted-row" if r['status'] == 'deleted' else "active-row"
-                req_msg = " | ⏳ Đang chờ duyệt sửa" if r.get('request_edit') == 1 else ""
-                
-                with st.container():
-                    st.markdown(f"""
-                        <div class="{bg_style}" style="display: flex; align-items: center; justify-content: space-between;">
-                            <div style="flex:1"><b>#{r['id']}</b></div>
-                            <div style="flex:1">{r['type']}</div>
-                            <div style="flex:3">{r['memo']} | {r['invoice_number']} {req_msg}</div>
-                            <div style="flex:2; font-weight:bold;">{r['Tiền']}</div>
-                            <div style="flex:1">{r['status']}</div>
-                        </div>
-                    """, unsafe_allow_html=True)
-                    
-                    # Nút chức năng (chỉ hiện cho active)
-                    if r['status'] == 'active' and st.session_state.user_info['role'] == 'admin':
-                        if st.button("❌ Hủy", key=f"del_{r['id']}"):
-                            run_query("UPDATE invoices SET status='deleted' WHERE id=?", (r['id'],), commit=True); st.rerun()
+    with st.expander("Lịch sử", expanded=True): history_list()
 
 # --- TAB 2: LIÊN KẾT DỰ ÁN ---
 elif menu == "2. Liên Kết Dự Án":
@@ -541,106 +844,144 @@ elif menu == "2. Liên Kết Dự Án":
             if p_map:
                 d_p = st.selectbox("Xóa", list(p_map.keys()))
                 if st.button("Xóa") and st.session_state.user_info['role'] == 'admin':
-                    run_query("DELETE FROM projects WHERE id=?", (p_map[d_p],), commit=True)
-                    run_query("DELETE FROM project_links WHERE project_id=?", (p_map[d_p],), commit=True); st.rerun()
+                    get_db().write(run_statements, [("DELETE FROM projects WHERE id=?", (p_map[d_p],)),
+                                                    ("DELETE FROM project_links WHERE project_id=?", (p_map[d_p],))])
+                    st.rerun()
 
     if selected_p:
         pid = p_map[selected_p]
         if "edit_mode" not in st.session_state: st.session_state.edit_mode = False
-        
-        # LOGIC ẨN HÓA ĐƠN ĐÃ THUỘC DỰ ÁN KHÁC
-        all_links = run_query("SELECT * FROM project_links")
-        blocked_ids = {l['invoice_id'] for l in all_links if l['project_id'] != pid}
-        current_ids = {l['invoice_id'] for l in all_links if l['project_id'] == pid}
-
         c_btn, _ = st.columns([1,5])
         if not st.session_state.edit_mode:
             if c_btn.button("✏️ Chỉnh sửa"): st.session_state.edit_mode = True; st.rerun()
         else:
             if c_btn.button("💾 LƯU"): st.session_state.trigger_save = True
 
-        all_inv = run_query("SELECT * FROM invoices WHERE status='active' ORDER BY date DESC")
-        if all_inv:
-            df = pd.DataFrame([dict(r) for r in all_inv])
-            df = df[~df['id'].isin(blocked_ids)]
+        # --- BỘ LỌC (lọc trong SQL, mỗi lần chỉ lấy 1 trang) ---
+        f1, f2, f3, f4, f5 = st.columns([3,2,2,2,2])
+        filters = {
+            'q': f1.text_input("🔎 Tìm (gợi nhớ, số HĐ, bên bán/mua)", key="lk_q").strip(),
+            'date_from': f2.date_input("Từ ngày", value=None, format="DD/MM/YYYY", key="lk_from"),
+            'date_to': f3.date_input("Đến ngày", value=None, format="DD/MM/YYYY", key="lk_to"),
+            'amount_min': f4.number_input("Tiền từ", min_value=0.0, value=None, step=1000000.0, format="%.0f", key="lk_min"),
+            'amount_max': f5.number_input("Tiền đến", min_value=0.0, value=None, step=1000000.0, format="%.0f", key="lk_max"),
+        }
+        # Đổi dự án/bộ lọc thì quay về trang đầu
+        lk_sig = (pid, tuple(filters.values()))
+        if st.session_state.get("lk_sig") != lk_sig:
+            st.session_state.lk_sig = lk_sig; st.session_state.lk_cursors = {'IN': [None], 'OUT': [None]}
+
+        pages = {}
+        for t in ('IN', 'OUT'):
+            rows = fetch_link_page(pid, t, filters, st.session_state.lk_cursors[t][-1])
+            pages[t] = ([dict(r) for r in rows[:LINK_PAGE_SIZE]], len(rows) > LINK_PAGE_SIZE)
+        # Hóa đơn đang thuộc dự án trên các trang đang hiển thị (so sánh khi lưu)
+        current_ids = {r['id'] for t in pages for r in pages[t][0] if r['Selected']}
+
+        if any(pages[t][0] or len(st.session_state.lk_cursors[t]) > 1 for t in pages):
+            c_in, c_out = st.columns(2)
+            dis = not st.session_state.edit_mode
+            if not dis: st.caption("Lưu trước khi chuyển trang, thay đổi chưa lưu sẽ bị bỏ.")
             
-            if not df.empty:
-                df['Selected'] = df['id'].isin(current_ids)
-                df['Show'] = df['memo'].fillna('') + " (" + df['total_amount'].apply(format_vnd) + ")"
-                
-                c_in, c_out = st.columns(2)
-                dis = not st.session_state.edit_mode
+            thumbs = st.toggle("🖼️ Ảnh thu nhỏ", key="lk_thumbs")
+            with c_in:
+                st.warning("Đầu vào")
+                e_in = link_page_editor('IN', *pages['IN'], dis, thumbs)
+            with c_out:
+                st.info("Đầu ra")
+                e_out = link_page_editor('OUT', *pages['OUT'], dis, thumbs)
+
+            if st.session_state.get("trigger_save"):
+                s_ids = set()
+                if not e_in.empty: s_ids.update(e_in[e_in['Selected']]['id'].tolist())
+                if not e_out.empty: s_ids.update(e_out[e_out['Selected']]['id'].tolist())
                 
-                with c_in:
-                    st.warning("Đầu vào")
-                    d_in = df[df['type']=='IN'][['Selected','id','Show']]
-                    e_in = st.data_editor(d_in, column_config={"Selected": st.column_config.CheckboxColumn(required=True), "id": None}, disabled=dis, hide_index=True, key="e_in")
-                with c_out:
-                    st.info("Đầu ra")
-                    d_out = df[df['type']=='OUT'][['Selected','id','Show']]
-                    e_out = st.data_editor(d_out, column_config={"Selected": st.column_config.CheckboxColumn(required=True), "id": None}, disabled=dis, hide_index=True, key="e_out")
-
-                if st.session_state.get("trigger_save"):
-                    s_ids = []
-                    if not e_in.empty: s_ids += e_in[e_in['Selected']]['id'].tolist()
-                    if not e_out.empty: s_ids += e_out[e_out['Selected']]['id'].tolist()
-                    
-                    run_query("DELETE FROM project_links WHERE project_id=?", (pid,), commit=True)
-                    for i in s_ids:
-                        run_query("INSERT INTO project_links (project_id, invoice_id) VALUES (?,?)", (pid, i), commit=True)
-                    
-                    st.session_state.edit_mode = False; st.session_state.trigger_save = False; st.success("Đã lưu!"); st.rerun()
-            else: st.info("Không còn hóa đơn trống.")
+                # Chỉ ghi phần thay đổi so với lúc mở, trong 1 giao dịch
+                added, removed = s_ids - current_ids, current_ids - s_ids
+                st.session_state.trigger_save = False
+                try:
+                    get_db().write(run_statements, [("DELETE FROM project_links WHERE project_id=? AND invoice_id=?", [(pid, i) for i in removed], True),
+                                                    ("INSERT INTO project_links (project_id, invoice_id) VALUES (?,?)", [(pid, i) for i in added], True)])
+                except sqlite3.IntegrityError:
+                    # uq_links_invoice: hóa đơn vừa được người khác gán vào dự án khác
+                    st.error("Có hóa đơn đã thuộc dự án khác, không lưu được. Vui lòng tải lại!")
+                else:
+                    st.session_state.edit_mode = False; st.success("Đã lưu!"); st.rerun()
+        else: st.info("Không còn hóa đơn trống.")
 
 # --- TAB 3: BÁO CÁO ---
 elif menu == "3. Báo Cáo Tổng Hợp":
     st.title("📊 Báo Cáo Tài Chính")
-    
-    # --- BỘ LỌC THÁNG ---
-    all_dates = run_query("SELECT date FROM invoices WHERE status='active'")
-    valid_dates = []
-    for r in all_dates:
-        try: valid_dates.append(datetime.strptime(r['date'], "%d/%m/%Y"))
-        except: pass
-    
-    months = sorted(list(set([d.strftime("%m/%Y") for d in valid_dates])), reverse=True)
-    selected_month = st.selectbox("📅 Chọn Tháng Lọc Dự Án (Bỏ trống = Tất cả)", ["Tất cả"] + months)
-
-    base_query = """
-        SELECT p.project_name, i.type, i.total_amount, i.date
-        FROM projects p
-        JOIN project_links l ON p.id = l.project_id
-        JOIN invoices i ON l.invoice_id = i.id
-        WHERE i.status = 'active'
-    """
-    rows = run_query(base_query)
-    
-    if rows:
-        df = pd.DataFrame([dict(r) for r in rows])
-        if selected_month != "Tất cả":
-            df['dt'] = pd.to_datetime(df['date'], format='%d/%m/%Y', errors='coerce')
-            df['MyMonth'] = df['dt'].dt.strftime('%m/%Y')
-            df = df[df['MyMonth'] == selected_month]
-
-        if not df.empty:
-            agg = df.groupby(['project_name', 'type'])['total_amount'].sum().unstack(fill_value=0).reset_index()
-            if 'IN' not in agg: agg['IN'] = 0
-            if 'OUT' not in agg: agg['OUT'] = 0
-            agg['Lãi'] = agg['OUT'] - agg['IN']
-            
-            st.metric(f"LỢI NHUẬN TỔNG ({selected_month})", format_vnd(agg['Lãi'].sum()))
-            
-            for _, r in agg.iterrows():
-                with st.container():
-                    st.markdown(f"""
-                    <div class="report-card">
-                        <h4>📂 {r['project_name']}</h4><hr style="margin:5px 0;">
-                        <div style="display:flex; justify-content:space-between;">
-                            <span>Thu: <b>{format_vnd(r['OUT'])}</b></span>
-                            <span>Chi: <b>{format_vnd(r['IN'])}</b></span>
-                            <span style="color:{'#28a745' if r['Lãi']>=0 else 'red'}">Lãi: <b>{format_vnd(r['Lãi'])}</b></span>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-        else: st.info(f"Không có dữ liệu cho tháng {selected_month}")
-    else: st.info("Chưa có dữ liệu.")
+
+    # Ma trận dự án x tháng tính 1 lần cho mọi dự án, cache theo version dữ liệu báo cáo (trigger tăng khi số liệu đổi)
+    count_query()
+    with get_db().connection() as conn: version = report_version(conn)
+    matrix, undated = load_report_matrix(version)
+    if matrix.empty and undated.empty: st.info("Chưa có dữ liệu.")
+    if not matrix.empty:
+        months = list(matrix.index.get_level_values("month").unique())
+        month_label = lambda m: f"{m[5:7]}/{m[:4]}"
+        c1, c2 = st.columns([3, 1])
+        if len(months) > 1:
+            m_from, m_to = c1.select_slider("📅 Khoảng tháng", options=months, value=(months[0], months[-1]), format_func=month_label)
+        else: m_from = m_to = months[0]
+        value = c2.selectbox("Giá trị", REPORT_VALUES, index=REPORT_VALUES.index("Lãi"))
+        month_idx = matrix.index.get_level_values("month")
+        view = matrix[(month_idx >= m_from) & (month_idx <= m_to)]
+
+        period = month_label(m_from) if m_from == m_to else f"{month_label(m_from)} - {month_label(m_to)}"
+        k1, k2, k3 = st.columns(3)
+        k1.metric(f"TỔNG THU ({period})", format_vnd(view["Thu"].sum()))
+        k2.metric(f"TỔNG CHI ({period})", format_vnd(view["Chi"].sum()))
+        k3.metric(f"LỢI NHUẬN TỔNG ({period})", format_vnd(view["Lãi"].sum()))
+
+        # Biểu đồ tháng x dự án: cột chồng theo dự án, lãi lũy kế thì vẽ đường
+        chart = view[value].unstack("project").rename(index=month_label)
+        if value == "Lãi lũy kế": st.line_chart(chart)
+        else: st.bar_chart(chart)
+        # Bảng dự án x tháng; Thu/Chi/Lãi có thêm cột tổng kỳ, mọi giá trị trừ chênh lệch có dòng tổng các dự án
+        table = view[value].unstack("month").rename(columns=month_label)
+        if value in ("Thu", "Chi", "Lãi"): table["Tổng"] = table.sum(axis=1)
+        if value != "Lãi so tháng trước": table.loc["Tổng"] = table.sum()
+        st.dataframe(table, use_container_width=True, column_config={c: st.column_config.NumberColumn(c, format="localized") for c in table.columns})
+    if not undated.empty:
+        st.caption(f"Hóa đơn chưa rõ tháng (không nằm trong bảng theo tháng): Thu {format_vnd(undated['Thu'].sum())}, "
+                   f"Chi {format_vnd(undated['Chi'].sum())}, Lãi {format_vnd(undated['Lãi'].sum())}")
+
+    # --- XUẤT DỮ LIỆU ---
+    # File chỉ được tạo khi bấm tải (đọc DB theo khối, không dựng DataFrame); bản tải về vẫn nằm trong RAM của Streamlit
+    # nên chỉ cho tải tới EXPORT_APP_MAX_ROWS dòng, lớn hơn / định kỳ thì dùng CLI: python export.py invoices|pnl <file>
+    with st.expander("📤 Xuất dữ liệu"):
+        e1, e2 = st.columns(2)
+        what = e1.radio("Dữ liệu", ["Hóa đơn", "Lãi/lỗ dự án theo tháng"], horizontal=True)
+        fmt = e2.selectbox("Định dạng", list(EXPORT_WRITERS), format_func=str.upper)
+        projects = {r['project_name']: r['id'] for r in run_query("SELECT id, project_name FROM projects ORDER BY project_name")}
+        f1, f2, f3 = st.columns(3)
+        d_from = f1.date_input("Từ ngày", value=None, format="DD/MM/YYYY")
+        d_to = f2.date_input("Đến ngày", value=None, format="DD/MM/YYYY")
+        project = f3.selectbox("Dự án", ["Tất cả"] + list(projects))
+        pid = projects.get(project)
+        if what == "Hóa đơn":
+            f4, f5 = st.columns(2)
+            inv_type = {"Tất cả": None, "Đầu vào": "IN", "Đầu ra": "OUT"}[f4.selectbox("Loại", ["Tất cả", "Đầu vào", "Đầu ra"])]
+            status = {"Tất cả": None, "Còn hiệu lực": "active", "Đã hủy": "deleted"}[f5.selectbox("Trạng thái", ["Còn hiệu lực", "Đã hủy", "Tất cả"])]
+            query = invoice_export_query(d_from and d_from.isoformat(), d_to and d_to.isoformat(), inv_type, status, pid)
+            name, cli = "hoa_don", ["invoices"] + [f"--{k} {v}" for k, v in [("type", inv_type), ("status", status)] if v]
+            # Hóa đơn gồm cả các năm đã chuyển sang lưu trữ
+            with_archives = True
+        else:
+            query = pnl_export_query(d_from and d_from.strftime("%Y-%m"), d_to and d_to.strftime("%Y-%m"), pid)
+            name, cli = "lai_lo_du_an", ["pnl"]
+            with_archives = False
+        db = get_db()
+        n_rows = export_row_count(query, with_archives)
+        if n_rows > EXPORT_APP_MAX_ROWS:
+            day_fmt = "%Y-%m-%d" if what == "Hóa đơn" else "%Y-%m"
+            cli += [f"--{k} {d.strftime(day_fmt)}" for k, d in [("from", d_from), ("to", d_to)] if d] + ([f'--project "{project}"'] if pid else [])
+            st.warning(f"{n_rows:,} dòng, quá lớn để tải qua trình duyệt (tối đa {EXPORT_APP_MAX_ROWS:,}). Thu hẹp bộ lọc hoặc xuất trên máy chủ:"
+                       f"\n\n`{' '.join(['python export.py', cli[0], f'{name}.{fmt}'] + cli[1:])}`")
+        else:
+            st.download_button(f"⬇️ Tải {fmt.upper()} ({n_rows:,} dòng)", data=lambda: export_bytes(db, fmt, query, with_archives),
+                               file_name=f"{name}_{datetime.now():%Y%m%d}.{fmt}", mime=EXPORT_MIME[fmt], use_container_width=True)
+
+end_rerun()
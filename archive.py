@@ -0,0 +1,240 @@
+import os
+import json
+import shutil
+import sqlite3
+import argparse
+from datetime import datetime
+from pathlib import Path
+from contextlib import contextmanager
+from search import SEARCH_DDL, FTS_COLUMNS, search_invoices
+from reports import SUMMARY_DDL, rebuild_project_summary
+
+# ==========================================
+# LƯU TRỮ NÓNG/LẠNH
+# Hóa đơn đã hủy và hóa đơn của các năm đã khóa sổ được chuyển (kèm liên kết dự án, text tìm kiếm)
+# sang file SQLite riêng theo năm: .archive/invoices_<năm>.db, sau đó VACUUM DB nóng
+# DB nóng chỉ giữ: danh sách file lưu trữ, tổng hợp lãi/lỗ phần đã lưu trữ (báo cáo không phải mở file lưu trữ)
+# và file hóa đơn mà bản lưu trữ còn trỏ tới (GC kho file không xóa)
+# Xem/tìm hóa đơn kỳ cũ: ATTACH file của năm đó vào kết nối, chỉ khi người dùng chọn kỳ đó
+# python archive.py run [--before NĂM] | list
+# ==========================================
+
+ARCHIVE_DIR = ".archive"
+ARCHIVE_CHUNK = 5000
+
+ARCHIVE_DDL = [
+    '''CREATE TABLE IF NOT EXISTS archives (year TEXT PRIMARY KEY, path TEXT NOT NULL, invoices INTEGER, deleted INTEGER, archived_at TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS archive_month_summary (
+        year TEXT NOT NULL, project_id INTEGER NOT NULL, year_month TEXT NOT NULL, type TEXT NOT NULL,
+        total REAL NOT NULL DEFAULT 0, cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (year, project_id, year_month, type)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS archive_files (file_path TEXT NOT NULL, year TEXT NOT NULL, n INTEGER NOT NULL, PRIMARY KEY (file_path, year)) WITHOUT ROWID''',
+    # Báo cáo đọc view này: phần nóng (trigger cập nhật) + phần đã lưu trữ
+    '''CREATE VIEW IF NOT EXISTS project_month_all AS
+        SELECT project_id, year_month, type, total, cnt FROM project_month_summary
+        UNION ALL SELECT project_id, year_month, type, total, cnt FROM archive_month_summary''',
+]
+
+# Bảng trong file lưu trữ (bảng invoices tạo theo schema của DB nóng); dữ liệu chỉ đọc nên không cần trigger
+ARCHIVE_FILE_DDL = [
+    '''CREATE TABLE IF NOT EXISTS project_links (id INTEGER PRIMARY KEY, project_id INTEGER, invoice_id INTEGER)''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS uq_links_invoice ON project_links(invoice_id)''',
+    SEARCH_DDL[0],
+    SUMMARY_DDL[0],
+]
+
+# Được chuyển: hóa đơn đã hủy, hoặc thuộc năm trước :before; hóa đơn đang chờ duyệt sửa ở lại
+ARCHIVABLE = "(status = 'deleted' OR (year_month IS NOT NULL AND year_month != '' AND year_month < :before)) AND COALESCE(request_edit, 0) = 0"
+YEAR_KEY = "COALESCE(NULLIF(substr(year_month, 1, 4), ''), 'undated')"
+# Bản gốc của nhóm trùng (dedup.py) chưa chuyển khi còn bản trùng trỏ tới nó ở lại DB nóng
+ARCHIVE_CANDIDATES = f'''SELECT id FROM invoices WHERE {ARCHIVABLE} AND {YEAR_KEY} = :year
+    AND id NOT IN (SELECT dup_of FROM invoices WHERE dup_of IS NOT NULL AND NOT ({ARCHIVABLE}))
+    ORDER BY id LIMIT :n'''
+IDS = "(SELECT value FROM json_each(?))"
+
+def ensure_archive_tables(conn):
+    for ddl in ARCHIVE_DDL:
+        conn.execute(ddl)
+
+def archive_path(archive_dir, year):
+    return os.path.join(archive_dir, f"invoices_{year}.db")
+
+def list_archives(conn):
+    return conn.execute("SELECT year, path, invoices, deleted, archived_at FROM archives ORDER BY year DESC").fetchall()
+
+@contextmanager
+def attach_archive(db, path, alias="arch"):
+    # Kết nối trong pool + file lưu trữ gắn dưới tên alias; tháo ra khi xong để kết nối dùng lại được
+    if not os.path.exists(path): raise FileNotFoundError(path)
+    with db.connection() as conn:
+        conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction: conn.rollback()
+            conn.execute(f"DETACH DATABASE {alias}")
+
+def open_archive_reader(path, hot_path):
+    # Mở file lưu trữ (chỉ đọc) làm DB chính, DB nóng gắn dưới tên hot (bảng projects...): câu truy vấn viết cho DB nóng
+    # không ghi tên schema (invoices, project_links, invoices_fts) chạy nguyên văn trên file lưu trữ
+    if not os.path.exists(path): raise FileNotFoundError(path)
+    conn = sqlite3.connect(Path(path).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("ATTACH DATABASE ? AS hot", (hot_path,))
+    return conn
+
+@contextmanager
+def archive_readers(db):
+    # [(năm, kết nối đọc)] cho mọi file lưu trữ còn trên đĩa; kết nối riêng ngoài pool (không giới hạn số ATTACH)
+    # Mượn kết nối pool chỉ để đọc danh sách, trả lại trước khi yield: gọi trước khi lấy kết nối pool khác
+    with db.connection() as conn:
+        archives = [(r[0], r[1]) for r in list_archives(conn)]
+    readers = []
+    try:
+        for year, path in archives:
+            if os.path.exists(path): readers.append((year, open_archive_reader(path, db.path)))
+        yield readers
+    finally:
+        for _, conn in readers: conn.close()
+
+def search_all_periods(db, text, limit=50):
+    # Tìm ở DB nóng + mọi file lưu trữ, mỗi dòng có archive_year (None = DB nóng); xếp chung theo điểm bm25
+    # (mỗi file tính điểm riêng nên chỉ gần đúng). Hóa đơn nằm ở cả 2 nơi (chuyển dở dang) lấy bản ở DB nóng
+    with db.connection() as conn:
+        rows = [dict(r, archive_year=None) for r in search_invoices(conn, text, limit)]
+    seen = {r['id'] for r in rows}
+    with archive_readers(db) as readers:
+        for year, conn in readers:
+            for r in search_invoices(conn, text, limit):
+                if r['id'] not in seen: rows.append(dict(r, archive_year=year)); seen.add(r['id'])
+    return sorted(rows, key=lambda r: r['rank'])[:limit]
+
+def open_archive_file(path, hot_path):
+    # Kết nối ghi file lưu trữ, DB nóng gắn dưới tên hot để chép dữ liệu sang
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("ATTACH DATABASE ? AS hot", (hot_path,))
+    if not conn.execute("SELECT 1 FROM main.sqlite_master WHERE type='table' AND name='invoices'").fetchone():
+        conn.execute(conn.execute("SELECT sql FROM hot.sqlite_master WHERE type='table' AND name='invoices'").fetchone()[0])
+    # Cột mới thêm vào DB nóng sau lần lưu trữ trước
+    have = {r[1] for r in conn.execute("PRAGMA main.table_info(invoices)")}
+    for r in conn.execute("PRAGMA hot.table_info(invoices)").fetchall():
+        if r[1] not in have: conn.execute(f'ALTER TABLE invoices ADD COLUMN "{r[1]}" {r[2]}')
+    for ddl in ARCHIVE_FILE_DDL:
+        conn.execute(ddl)
+    return conn
+
+def copy_chunk(arch, ids, cols):
+    # BEGIN thường (không IMMEDIATE): chỉ khóa ghi file lưu trữ, DB nóng chỉ đọc
+    ids_json, col_list, fts = json.dumps(ids), ", ".join(f'"{c}"' for c in cols), ", ".join(FTS_COLUMNS)
+    arch.execute("BEGIN")
+    try:
+        arch.execute(f"INSERT OR REPLACE INTO invoices ({col_list}) SELECT {col_list} FROM hot.invoices WHERE id IN {IDS}", (ids_json,))
+        arch.execute(f"INSERT OR REPLACE INTO project_links (id, project_id, invoice_id) SELECT id, project_id, invoice_id FROM hot.project_links WHERE invoice_id IN {IDS}", (ids_json,))
+        arch.execute(f"DELETE FROM invoices_fts WHERE rowid IN {IDS}", (ids_json,))
+        arch.execute(f"INSERT INTO invoices_fts (rowid, {fts}) SELECT rowid, {fts} FROM hot.invoices_fts WHERE rowid IN {IDS}", (ids_json,))
+    except BaseException:
+        arch.rollback()
+        raise
+    arch.commit()
+
+def remove_chunk(conn, year, ids):
+    # Gọi trong giao dịch của DB nóng; cộng dồn tạm tổng hợp + tham chiếu file, refresh_archive tính lại chính xác sau
+    ids_json = json.dumps(ids)
+    conn.execute(f'''INSERT INTO archive_files (file_path, year, n)
+                     SELECT file_path, ?, COUNT(*) FROM invoices WHERE id IN {IDS} AND file_path IS NOT NULL GROUP BY file_path
+                     ON CONFLICT(file_path, year) DO UPDATE SET n = n + excluded.n''', (year, ids_json))
+    conn.execute(f'''INSERT INTO archive_month_summary (year, project_id, year_month, type, total, cnt)
+                     SELECT ?, l.project_id, COALESCE(i.year_month, ''), COALESCE(i.type, ''), SUM(COALESCE(i.total_amount, 0)), COUNT(*)
+                     FROM project_links l JOIN invoices i ON i.id = l.invoice_id WHERE i.id IN {IDS} AND i.status = 'active'
+                     GROUP BY l.project_id, COALESCE(i.year_month, ''), COALESCE(i.type, '')
+                     ON CONFLICT(year, project_id, year_month, type) DO UPDATE SET total = total + excluded.total, cnt = cnt + excluded.cnt''',
+                 (year, ids_json))
+    # Xóa liên kết trước: trigger trừ hóa đơn khỏi project_month_summary đúng 1 lần
+    conn.execute(f"DELETE FROM project_links WHERE invoice_id IN {IDS}", (ids_json,))
+    conn.execute(f"DELETE FROM invoices WHERE id IN {IDS}", (ids_json,))
+
+def refresh_archive(db, year, path):
+    # Tính lại phần DB nóng giữ thay cho file lưu trữ của 1 năm, từ chính file đó
+    with attach_archive(db, path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM archive_month_summary WHERE year = ?", (year,))
+        conn.execute('''INSERT INTO archive_month_summary (year, project_id, year_month, type, total, cnt)
+                        SELECT ?, project_id, year_month, type, total, cnt FROM arch.project_month_summary''', (year,))
+        conn.execute("DELETE FROM archive_files WHERE year = ?", (year,))
+        conn.execute('''INSERT INTO archive_files (file_path, year, n)
+                        SELECT file_path, ?, COUNT(*) FROM arch.invoices WHERE file_path IS NOT NULL GROUP BY file_path''', (year,))
+        conn.execute('''INSERT OR REPLACE INTO archives (year, path, invoices, deleted, archived_at)
+                        SELECT ?, ?, COUNT(*), COALESCE(SUM(status = 'deleted'), 0), ? FROM arch.invoices''',
+                     (year, path, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        conn.commit()
+
+def archive_invoices(db, archive_dir=ARCHIVE_DIR, before=None, chunk=ARCHIVE_CHUNK, progress=None):
+    # before: năm đầu tiên còn giữ ở DB nóng (mặc định năm nay); trả về {năm: số hóa đơn đã chuyển}
+    params = {"before": str(before or datetime.now().year)}
+    with db.connection() as conn:
+        years = [r[0] for r in conn.execute(f"SELECT DISTINCT {YEAR_KEY} FROM invoices WHERE {ARCHIVABLE} ORDER BY 1", params)]
+        cols = [r[1] for r in conn.execute("PRAGMA table_info(invoices)")]
+    if years: os.makedirs(archive_dir, exist_ok=True)
+    moved = {}
+    for year in years:
+        path = archive_path(archive_dir, year)
+        arch = open_archive_file(path, db.path)
+        try:
+            while True:
+                # Giữ khóa ghi DB nóng trong lúc chuyển 1 khối: không ai sửa được các hóa đơn đang chuyển.
+                # File lưu trữ commit trước, DB nóng xóa sau: dừng giữa chừng thì hóa đơn nằm ở cả 2 nơi,
+                # lần chạy sau chép đè rồi xóa -> không bao giờ mất dữ liệu
+                with db.transaction() as conn:
+                    ids = [r[0] for r in conn.execute(ARCHIVE_CANDIDATES, {**params, "year": year, "n": chunk})]
+                    if not ids: break
+                    copy_chunk(arch, ids, cols)
+                    remove_chunk(conn, year, ids)
+                moved[year] = moved.get(year, 0) + len(ids)
+                if progress: progress(year, moved[year])
+            arch.execute("BEGIN")
+            rebuild_project_summary(arch)
+            arch.commit()
+        finally:
+            arch.close()
+        refresh_archive(db, year, path)
+    return moved
+
+def vacuum_db(db):
+    # Trả dung lượng đã xóa về cho hệ điều hành; trả về (byte trước, byte sau)
+    size = os.path.getsize(db.path)
+    with db.connection() as conn:
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return size, os.path.getsize(db.path)
+
+def drop_archives(conn):
+    # Dùng khi xóa toàn bộ hóa đơn (id bắt đầu lại từ 1, bản lưu trữ cũ không còn khớp)
+    for table in ("archives", "archive_month_summary", "archive_files"):
+        conn.execute(f"DELETE FROM {table}")
+
+def remove_archive_files(archive_dir=ARCHIVE_DIR):
+    # Chỉ gọi sau khi drop_archives đã commit: giao dịch bị hoàn tác thì file lưu trữ vẫn còn nguyên
+    shutil.rmtree(archive_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    from db import open_database
+    parser = argparse.ArgumentParser(description="Chuyển hóa đơn đã hủy / năm đã khóa sổ sang file lưu trữ theo năm")
+    parser.add_argument("action", choices=["run", "list"])
+    parser.add_argument("--before", type=int, help="Năm đầu tiên còn giữ ở DB nóng (mặc định năm nay)")
+    parser.add_argument("--db", default="invoice_app.db", help="Đường dẫn DB")
+    parser.add_argument("--dir", default=ARCHIVE_DIR, help="Thư mục file lưu trữ")
+    parser.add_argument("--no-vacuum", action="store_true", help="Không VACUUM DB nóng sau khi chuyển")
+    args = parser.parse_args()
+    db = open_database(args.db)
+    if args.action == "run":
+        moved = archive_invoices(db, args.dir, args.before, progress=lambda y, n: print(f"\r{y}: {n}", end="", flush=True))
+        if moved: print()
+        print(f"Đã chuyển {sum(moved.values())} hóa đơn sang lưu trữ" + "".join(f"\n  {y}: {n}" for y, n in moved.items()))
+        if moved and not args.no_vacuum:
+            size, after = vacuum_db(db)
+            print(f"VACUUM: {size / 1024 / 1024:.1f} MB -> {after / 1024 / 1024:.1f} MB")
+    with db.connection() as conn:
+        for year, path, n, deleted, at in list_archives(conn):
+            print(f"  {year}: {n} hóa đơn ({deleted} đã hủy)  {path}  [{at}]")
+    db.close()
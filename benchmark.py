@@ -0,0 +1,258 @@
+import io
+import os
+import sys
+import json
+import glob
+import time
+import random
+import platform
+import argparse
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from extractor import ENGINE_VERSION, analyze_bytes, extract_from_bytes
+from metrics import percentile
+
+# ==========================================
+# BENCHMARK PHÂN TÍCH HÓA ĐƠN
+# python benchmark.py corpus [thư mục] [--n 60] [--seed 1]   -> sinh bộ hóa đơn mẫu (reportlab) + manifest.json
+# python benchmark.py run [thư mục] [--out kq.json]           -> đo độ trễ, thông lượng, RSS, độ chính xác
+# python benchmark.py compare cu.json moi.json                -> so sánh 2 lần chạy
+# Cùng seed -> cùng bộ file, kết quả giữa các lần chạy so sánh được với nhau
+# ==========================================
+
+CORPUS_DIR = "bench_corpus"
+FIELDS = ["total", "tax", "date", "inv_num", "inv_sym"]
+LAYOUTS = ["classic", "compact", "table"]
+NUMBER_FORMATS = ["dot", "comma", "plain", "dong"]
+FONT_CANDIDATES = ["/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "C:/Windows/Fonts/arial.ttf", "/Library/Fonts/Arial Unicode.ttf"]
+SELLERS = ["Công ty TNHH Thương mại Hòa Bình", "Công ty CP Xây dựng Đông Á", "Công ty TNHH Điện máy Sài Gòn", "Doanh nghiệp tư nhân Minh Đức"]
+BUYERS = ["Công ty CP Đầu tư Phương Nam", "Công ty TNHH Kỹ thuật Đại Việt", "Hộ kinh doanh Nguyễn Văn An"]
+ITEMS = ["Xi măng PCB40", "Thép cuộn D8", "Cát vàng", "Gạch ống", "Sơn nước ngoại thất", "Dây điện 2x2.5", "Ống nhựa PVC 90", "Công vận chuyển"]
+VAT_RATES = [0.08, 0.1, 0.05]
+
+def fmt_number(n, style):
+    n = int(round(n))
+    if style == "dot": return f"{n:,}".replace(",", ".")
+    if style == "comma": return f"{n:,}"
+    if style == "dong": return f"{n:,}".replace(",", ".") + " đ"
+    return str(n)
+
+def find_font(path=None):
+    for p in [path] + FONT_CANDIDATES:
+        if p and os.path.exists(p): return p
+    raise SystemExit("Không tìm thấy font Unicode, chỉ định bằng --font <file .ttf>")
+
+# --- SINH BỘ HÓA ĐƠN MẪU ---
+def make_invoice(rng, idx):
+    layout = LAYOUTS[idx % len(LAYOUTS)]
+    style = rng.choice(NUMBER_FORMATS)
+    n_items = rng.randint(1, 6) if layout != "table" else rng.choice([3, 30, 70, 250])
+    items = [(rng.choice(ITEMS), rng.randint(1, 50), rng.randint(5, 900) * 1000) for _ in range(n_items)]
+    pre = sum(q * p for _, q, p in items)
+    tax = round(pre * rng.choice(VAT_RATES))
+    d = (rng.randint(1, 28), rng.randint(1, 12), rng.randint(2022, 2025))
+    truth = {"total": float(pre + tax), "tax": float(tax), "date": f"{d[0]:02d}/{d[1]:02d}/{d[2]}",
+             "inv_num": str(rng.randint(1, 9999999)).zfill(7), "inv_sym": f"{rng.randint(1, 2)}C{d[2] % 100}T{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}"}
+    return {"layout": layout, "format": style, "items": items, "pre": pre, "seller": rng.choice(SELLERS), "buyer": rng.choice(BUYERS), "truth": truth}
+
+def draw_invoice(inv, font):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    t, style = inv["truth"], inv["format"]
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    y = 800
+    def line(text, x=50, size=10):
+        nonlocal y
+        if y < 60:
+            c.showPage(); y = 800
+        c.setFont(font, size); c.drawString(x, y, text); y -= 16
+
+    line("HÓA ĐƠN GIÁ TRỊ GIA TĂNG", 180, 14)
+    if inv["layout"] == "compact":
+        line(f"Serial: {t['inv_sym']}    Số HĐ: {int(t['inv_num'])}    {t['date']}")
+        line(f"Người bán: {inv['seller']}")
+        line(f"Khách hàng: {inv['buyer']}")
+    else:
+        d, m, yr = t["date"].split("/")
+        line(f"Ký hiệu: {t['inv_sym']}")
+        line(f"Số: {int(t['inv_num'])}")
+        line(f"Ngày {d} tháng {m} năm {yr}")
+        line(f"Đơn vị bán hàng: {inv['seller']}")
+        line(f"Đơn vị mua hàng: {inv['buyer']}")
+    line("")
+    for k, (name, qty, price) in enumerate(inv["items"], 1):
+        line(f"{k}  {name}  SL {qty}  Đơn giá {fmt_number(price, style)}  {fmt_number(qty * price, style)}", 60, 9)
+    line("")
+    line(f"Cộng tiền hàng: {fmt_number(inv['pre'], style)}")
+    line(f"Tiền thuế GTGT: {fmt_number(t['tax'], style)}")
+    line(f"Tổng cộng thanh toán: {fmt_number(t['total'], style)}")
+    c.save()
+    return buf.getvalue()
+
+def pdf_to_image(pdf_bytes, fmt):
+    import pdfplumber
+    with pdfplumber.open(io.BytesIO(pdf_bytes), pages=[1]) as pdf:
+        img = pdf.pages[0].to_image(resolution=150).original.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG" if fmt == "jpg" else "PNG", quality=90)
+    return buf.getvalue()
+
+def build_corpus(out_dir, n=60, seed=1, image_every=4, font_path=None):
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    import pdfplumber
+    pdfmetrics.registerFont(TTFont("BenchFont", find_font(font_path)))
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    manifest = []
+    for i in range(n):
+        inv = make_invoice(rng, i)
+        pdf_bytes = draw_invoice(inv, "BenchFont")
+        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf: pages = len(pdf.pages)
+        entry = {"layout": inv["layout"], "format": inv["format"], "pages": pages, "truth": inv["truth"]}
+        name = f"inv_{i:04d}.pdf"
+        with open(os.path.join(out_dir, name), "wb") as f: f.write(pdf_bytes)
+        manifest.append({"file": name, "kind": "pdf", **entry})
+        # Bản ảnh chụp (trang 1) của một phần hóa đơn
+        if image_every and i % image_every == 0:
+            fmt = "jpg" if i % (image_every * 2) == 0 else "png"
+            name = f"inv_{i:04d}.{fmt}"
+            with open(os.path.join(out_dir, name), "wb") as f: f.write(pdf_to_image(pdf_bytes, fmt))
+            manifest.append({"file": name, "kind": "image", **entry, "pages": 1})
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"seed": seed, "n": n, "files": manifest}, f, ensure_ascii=False, indent=1)
+    return manifest
+
+# --- ĐO ---
+def peak_rss_mb(who="self"):
+    # ru_maxrss: KB trên Linux, byte trên macOS; Windows không có module resource
+    try: import resource
+    except ImportError: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def field_matches(info, truth):
+    info = info or {}
+    res = {}
+    for f in FIELDS:
+        got = info.get(f)
+        res[f] = abs(float(got or 0) - truth[f]) < 0.5 if f in ("total", "tax") else (got or "") == truth[f]
+    return res
+
+def summarize(rows, elapsed=None):
+    lat = [r["ms"] for r in rows]
+    out = {"files": len(rows), "pages": sum(r["pages"] for r in rows),
+           "p50_ms": percentile(lat, 50), "p90_ms": percentile(lat, 90), "p99_ms": percentile(lat, 99), "max_ms": max(lat) if lat else None,
+           "accuracy": {f: round(sum(r["match"][f] for r in rows) / len(rows), 4) if rows else None for f in FIELDS}}
+    busy = (elapsed if elapsed is not None else sum(lat) / 1000) or 1e-9
+    out["files_per_s"] = round(len(rows) / busy, 2)
+    out["pages_per_s"] = round(out["pages"] / busy, 2)
+    return out
+
+def run_benchmark(corpus_dir, repeat=3, workers=0):
+    with open(os.path.join(corpus_dir, "manifest.json"), encoding="utf-8") as f: manifest = json.load(f)
+    files = manifest["files"]
+    blobs = {e["file"]: open(os.path.join(corpus_dir, e["file"]), "rb").read() for e in files}
+
+    # Làm nóng: import lười, font cache của pdfplumber...
+    analyze_bytes(blobs[files[0]["file"]], is_image=files[0]["kind"] == "image")
+
+    rows = []
+    started = time.perf_counter()
+    for e in files:
+        best, info = None, None
+        # Lấy lần nhanh nhất trong các lần lặp để giảm nhiễu
+        for _ in range(max(1, repeat)):
+            t0 = time.perf_counter()
+            info, _msg, _pdf = analyze_bytes(blobs[e["file"]], is_image=e["kind"] == "image")
+            ms = (time.perf_counter() - t0) * 1000
+            best = ms if best is None else min(best, ms)
+        rows.append({"file": e["file"], "kind": e["kind"], "layout": e["layout"], "format": e["format"],
+                     "pages": e["pages"], "ms": round(best, 2), "match": field_matches(info, e["truth"])})
+    seq_elapsed = time.perf_counter() - started
+
+    result = {
+        "meta": {"engine_version": ENGINE_VERSION, "python": platform.python_version(), "platform": platform.platform(),
+                 "cpu_count": os.cpu_count(), "run_at": datetime.now().isoformat(timespec="seconds"),
+                 "corpus": os.path.abspath(corpus_dir), "seed": manifest.get("seed"), "repeat": repeat},
+        "overall": summarize(rows),
+        "by_kind": {k: summarize([r for r in rows if r["kind"] == k]) for k in sorted({r["kind"] for r in rows})},
+        "by_layout": {k: summarize([r for r in rows if r["layout"] == k]) for k in sorted({r["layout"] for r in rows})},
+        "sequential_wall_s": round(seq_elapsed, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "files": rows,
+    }
+
+    if workers and workers > 1:
+        # Thông lượng song song giống chế độ hàng loạt của app (spawn, gửi bytes sang worker)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(extract_from_bytes, ["warmup"] * workers, [blobs[files[0]["file"]]] * workers))
+            t0 = time.perf_counter()
+            list(pool.map(extract_from_bytes, [e["file"] for e in files], [blobs[e["file"]] for e in files], [e["kind"] == "image" for e in files]))
+            par = time.perf_counter() - t0
+        result["parallel"] = {"workers": workers, "wall_s": round(par, 3), "files_per_s": round(len(files) / par, 2),
+                              "pages_per_s": round(sum(e["pages"] for e in files) / par, 2), "peak_rss_children_mb": peak_rss_mb("children")}
+    return result
+
+def print_summary(result):
+    o = result["overall"]
+    print(f"Engine v{result['meta']['engine_version']}: {o['files']} file, {o['pages']} trang")
+    print(f"  Độ trễ p50 {o['p50_ms']:.1f} ms, p90 {o['p90_ms']:.1f} ms, p99 {o['p99_ms']:.1f} ms, max {o['max_ms']:.1f} ms")
+    print(f"  Thông lượng 1 tiến trình: {o['files_per_s']} file/s, {o['pages_per_s']} trang/s; RSS đỉnh {result['peak_rss_mb']} MB")
+    if "parallel" in result:
+        p = result["parallel"]
+        print(f"  Song song {p['workers']} worker: {p['files_per_s']} file/s, {p['pages_per_s']} trang/s")
+    for kind, s in result["by_kind"].items():
+        print(f"  [{kind}] " + ", ".join(f"{f} {v * 100:.0f}%" for f, v in s["accuracy"].items()))
+
+def compare(old, new):
+    # Chênh lệch các chỉ số chính (âm = nhanh hơn với độ trễ)
+    def row(label, a, b, unit=""):
+        if a is None or b is None: return
+        pct = (b - a) / a * 100 if a else 0
+        print(f"  {label:<22} {a:>10.2f} -> {b:>10.2f}{unit}  ({pct:+.1f}%)")
+    print(f"Engine v{old['meta']['engine_version']} -> v{new['meta']['engine_version']}")
+    for k in ("p50_ms", "p90_ms", "p99_ms", "files_per_s", "pages_per_s"): row(k, old["overall"][k], new["overall"][k])
+    row("peak_rss_mb", old.get("peak_rss_mb"), new.get("peak_rss_mb"))
+    for f in FIELDS: row(f"accuracy.{f}", old["overall"]["accuracy"][f] * 100, new["overall"]["accuracy"][f] * 100, "%")
+    # File mà trường nào đó đúng trước nhưng sai sau
+    old_rows = {r["file"]: r for r in old["files"]}
+    regress = [(r["file"], f) for r in new["files"] if r["file"] in old_rows for f in FIELDS if old_rows[r["file"]]["match"][f] and not r["match"][f]]
+    for name, f in regress[:30]: print(f"  Sai mới: {name} ({f})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark phân tích hóa đơn")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("corpus", help="Sinh bộ hóa đơn mẫu")
+    p.add_argument("dir", nargs="?", default=CORPUS_DIR)
+    p.add_argument("--n", type=int, default=60, help="Số hóa đơn PDF")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--image-every", type=int, default=4, help="Cứ N hóa đơn thì thêm 1 bản ảnh (0: không)")
+    p.add_argument("--font", help="Font .ttf có dấu tiếng Việt")
+    p = sub.add_parser("run", help="Chạy đo trên bộ mẫu")
+    p.add_argument("dir", nargs="?", default=CORPUS_DIR)
+    p.add_argument("--out", help="Ghi kết quả JSON (mặc định bench_<thời gian>.json)")
+    p.add_argument("--repeat", type=int, default=3, help="Số lần lặp mỗi file (lấy lần nhanh nhất)")
+    p.add_argument("--workers", type=int, default=0, help="Đo thêm thông lượng song song với N tiến trình")
+    p = sub.add_parser("compare", help="So sánh 2 file kết quả")
+    p.add_argument("old"); p.add_argument("new")
+    args = parser.parse_args()
+
+    if args.cmd == "corpus":
+        m = build_corpus(args.dir, n=args.n, seed=args.seed, image_every=args.image_every, font_path=args.font)
+        print(f"Đã sinh {len(m)} file vào {args.dir}")
+    elif args.cmd == "run":
+        if not glob.glob(os.path.join(args.dir, "manifest.json")):
+            print(f"Chưa có bộ mẫu ở {args.dir}, chạy: python benchmark.py corpus {args.dir}")
+            sys.exit(1)
+        result = run_benchmark(args.dir, repeat=args.repeat, workers=args.workers)
+        out = args.out or f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(out, "w", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=1)
+        print_summary(result)
+        print(f"Kết quả: {out}")
+    else:
+        with open(args.old, encoding="utf-8") as f: old = json.load(f)
+        with open(args.new, encoding="utf-8") as f: new = json.load(f)
+        compare(old, new)
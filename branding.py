@@ -0,0 +1,76 @@
+import io
+import base64
+from PIL import Image, ImageOps
+
+# ==========================================
+# THƯƠNG HIỆU CÔNG TY (tên, địa chỉ, SĐT, logo)
+# company_info.version tăng mỗi lần lưu -> app chỉ đọc lại DB khi version đổi
+# Logo gốc vẫn giữ ở company_info.logo_base64, giao diện dùng các bản thu nhỏ trong company_logo
+# ==========================================
+
+# Khung hiển thị (rộng, cao px) của logo ở từng vị trí; ảnh lưu gấp đôi cho màn hình độ phân giải cao
+LOGO_VARIANTS = {"login": (360, 120), "sidebar": (150, 150), "header": (240, 80)}
+LOGO_SCALE = 2
+
+BRANDING_DDL = [
+    '''CREATE TABLE IF NOT EXISTS company_logo (variant TEXT PRIMARY KEY, version INTEGER, mime TEXT, width INTEGER, height INTEGER, data BLOB)''',
+]
+
+DEFAULT_BRANDING = {"name": "Company", "address": "...", "phone": "...", "version": 0, "logos": {}}
+
+def make_logo_variants(logo_bytes):
+    # {variant: (mime, rộng hiển thị, cao hiển thị, bytes)}; ảnh có nền trong suốt giữ PNG, còn lại nén JPEG
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(logo_bytes)))
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    out = {}
+    for name, (box_w, box_h) in LOGO_VARIANTS.items():
+        ratio = min(box_w / img.width, box_h / img.height)
+        show_w, show_h = max(1, round(img.width * ratio)), max(1, round(img.height * ratio))
+        # Không phóng to ảnh gốc nhỏ
+        v = img.copy()
+        v.thumbnail((show_w * LOGO_SCALE, show_h * LOGO_SCALE), Image.LANCZOS)
+        buf = io.BytesIO()
+        if has_alpha:
+            v.save(buf, format="PNG", optimize=True); mime = "image/png"
+        else:
+            v.save(buf, format="JPEG", quality=85, optimize=True); mime = "image/jpeg"
+        out[name] = (mime, show_w, show_h, buf.getvalue())
+    return out
+
+def write_logo_variants(conn, logo_bytes, version):
+    conn.execute("DELETE FROM company_logo")
+    if not logo_bytes: return
+    conn.executemany("INSERT INTO company_logo (variant, version, mime, width, height, data) VALUES (?,?,?,?,?,?)",
+                     [(name, version, *v) for name, v in make_logo_variants(logo_bytes).items()])
+
+def ensure_branding_tables(conn):
+    for ddl in BRANDING_DDL:
+        conn.execute(ddl)
+    try: conn.execute("ALTER TABLE company_info ADD COLUMN version INTEGER DEFAULT 0")
+    except Exception: pass
+    # DB cũ: có logo nhưng chưa có bản thu nhỏ
+    row = conn.execute("SELECT logo_base64, COALESCE(version, 0) FROM company_info WHERE id = 1").fetchone()
+    if row and row[0] and not conn.execute("SELECT 1 FROM company_logo LIMIT 1").fetchone():
+        try: write_logo_variants(conn, base64.b64decode(row[0]), row[1])
+        except Exception: pass
+
+def branding_version(conn):
+    row = conn.execute("SELECT COALESCE(version, 0) FROM company_info WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+def load_branding(conn):
+    row = conn.execute("SELECT name, address, phone, COALESCE(version, 0) FROM company_info WHERE id = 1").fetchone()
+    if not row: return dict(DEFAULT_BRANDING)
+    logos = {r[0]: {"mime": r[1], "width": r[2], "height": r[3], "data": r[4]}
+             for r in conn.execute("SELECT variant, mime, width, height, data FROM company_logo")}
+    return {"name": row[0], "address": row[1], "phone": row[2], "version": row[3], "logos": logos}
+
+def save_branding(conn, name, address, phone, logo_bytes=None):
+    # Trả về version mới; không có logo mới thì giữ logo cũ
+    conn.execute("UPDATE company_info SET name=?, address=?, phone=?, version = COALESCE(version, 0) + 1 WHERE id=1", (name, address, phone))
+    version = branding_version(conn)
+    if logo_bytes:
+        conn.execute("UPDATE company_info SET logo_base64=? WHERE id=1", (base64.b64encode(logo_bytes).decode('utf-8'),))
+        write_logo_variants(conn, logo_bytes, version)
+    return version
@@ -0,0 +1,271 @@
+import json
+import time
+import queue
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from reports import ensure_project_summary, rebuild_project_summary, ensure_report_version
+from search import ensure_search_index, set_invoice_text
+from metrics import ensure_metrics_table
+from branding import ensure_branding_tables
+from dedup import ensure_dedup_index, dedup_key
+from archive import ensure_archive_tables, drop_archives
+
+# ==========================================
+# KẾT NỐI SQLITE DÙNG CHUNG (POOL)
+# WAL cho phép đọc song song khi đang ghi, busy_timeout thay cho lỗi "database is locked"
+# Kết nối ở chế độ autocommit, giao dịch nhiều lệnh đi qua transaction()
+# Lệnh ghi của app đi qua write(op, ...): op(conn, ...) chạy trong 1 giao dịch; chạy nhiều tiến trình app chung 1 DB
+# thì gắn writer (writer.py) để mọi lệnh ghi do 1 tiến trình duy nhất thực hiện, đọc vẫn đi thẳng vào DB
+# ==========================================
+
+class Database:
+    def __init__(self, path, pool_size=8, busy_timeout=10.0, writer=None):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.writer = writer
+
+    def _connect(self):
+        # cached_statements: mỗi kết nối giữ lại câu lệnh đã prepare để dùng lại giữa các lần rerun
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        # Mỗi kết nối chỉ được một luồng dùng tại một thời điểm
+        self.slots.acquire()
+        try:
+            try: conn = self.idle.get_nowait()
+            except queue.Empty: conn = self._connect()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction: conn.rollback()
+                self.idle.put(conn)
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE: giữ quyền ghi ngay từ đầu để không bị lỗi nâng khóa giữa chừng
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def write(self, op, *args, **kwargs):
+        # op phải là hàm cấp module có trong WRITE_OPS (writer.py) và trả về dữ liệu thường (không trả sqlite3.Row)
+        # Có writer: gửi sang tiến trình writer, lỗi của op (vd. IntegrityError) được ném lại ở đây
+        if self.writer: return self.writer.call(op.__name__, args, kwargs)
+        with self.transaction() as conn:
+            return op(conn, *args, **kwargs)
+
+    def execute(self, query, params=(), fetch_one=False, commit=False):
+        if commit:
+            self.write(run_statements, [(query, params)])
+            return True
+        with self.connection() as conn:
+            cur = conn.execute(query, params)
+            if fetch_one: return cur.fetchone()
+            return cur.fetchall()
+
+    def close(self):
+        while True:
+            try: self.idle.get_nowait().close()
+            except queue.Empty: break
+
+# ==========================================
+# CẤU TRÚC BẢNG & MIGRATION (dùng chung cho app Streamlit và công cụ dòng lệnh)
+# Các hàm nhận sẵn kết nối, người gọi tự quản lý giao dịch
+# ==========================================
+
+# Ngày nhập dạng dd/mm/YYYY -> YYYY-MM-DD để sắp xếp/lọc bằng index (None nếu sai định dạng)
+def to_iso_date(date_str):
+    try: return datetime.strptime((date_str or "").strip(), "%d/%m/%Y").strftime("%Y-%m-%d")
+    except ValueError: return None
+
+def init_db(conn):
+    c = conn.cursor()
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE, password TEXT, role TEXT, status TEXT)''')
+    # Thêm sẵn drive_link, request_edit, iso_date, year_month vào bảng invoices
+    c.execute('''CREATE TABLE IF NOT EXISTS invoices (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT, date TEXT, invoice_number TEXT, invoice_symbol TEXT, 
+        seller_name TEXT, buyer_name TEXT, pre_tax_amount REAL, tax_amount REAL, total_amount REAL, 
+        file_name TEXT, status TEXT, edit_count INTEGER, created_at TEXT, memo TEXT, file_path TEXT,
+        drive_link TEXT, request_edit INTEGER DEFAULT 0, iso_date TEXT, year_month TEXT
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS projects (id INTEGER PRIMARY KEY AUTOINCREMENT, project_name TEXT, created_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS project_links (id INTEGER PRIMARY KEY AUTOINCREMENT, project_id INTEGER, invoice_id INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS company_info (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, address TEXT, phone TEXT, logo_base64 TEXT)''')
+    # Cache kết quả phân tích theo SHA-256 nội dung file (kèm PDF đã convert nếu là ảnh)
+    c.execute('''CREATE TABLE IF NOT EXISTS extract_cache (file_hash TEXT PRIMARY KEY, engine_version INTEGER, info_json TEXT, msg TEXT, pdf_bytes BLOB, size INTEGER, last_used REAL, created_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0)''')
+    c.execute("INSERT OR IGNORE INTO cache_stats (name, hits, misses) VALUES ('extract', 0, 0)")
+    # Tiến độ import hàng loạt (import_invoices.py): file nào đã xong thì lần chạy sau bỏ qua
+    c.execute('''CREATE TABLE IF NOT EXISTS import_checkpoint (source_path TEXT PRIMARY KEY, file_hash TEXT, status TEXT, invoice_id INTEGER, error TEXT, run_at TEXT)''')
+    # Hàng đợi phân tích/lưu hóa đơn chạy nền (jobs.py): file upload nằm ở spool_path cho tới khi lưu xong
+    # state: queued -> parsing -> ready -> saving -> saved | failed; locked=1 khi một worker đang xử lý
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, state TEXT NOT NULL, locked INTEGER DEFAULT 0, session TEXT, user TEXT,
+        file_name TEXT, file_hash TEXT, is_image INTEGER, spool_path TEXT, pdf_path TEXT,
+        result_json TEXT, msg TEXT, fields_json TEXT, invoice_id INTEGER, error TEXT,
+        created_at REAL, started_at REAL, ready_at REAL, save_at REAL, done_at REAL, worker_pid INTEGER, locked_by TEXT
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user, state)")
+
+    # Data mặc định
+    c.execute("SELECT * FROM users WHERE username = 'admin'")
+    if not c.fetchone():
+        admin_pw = hashlib.sha256("admin123".encode()).hexdigest()
+        c.execute("INSERT INTO users (username, password, role, status) VALUES (?, ?, ?, ?)", ('admin', admin_pw, 'admin', 'approved'))
+    
+    c.execute("SELECT * FROM company_info WHERE id = 1")
+    if not c.fetchone():
+        c.execute("INSERT INTO company_info (name, address, phone, logo_base64) VALUES (?, ?, ?, ?)", ('Tên Công Ty Của Bạn', 'Địa chỉ...', '090...', ''))
+
+# Hàm cập nhật cấu trúc bảng nếu là DB cũ (Migration)
+def migrate_db_columns(conn):
+    c = conn.cursor()
+    try:
+        # Thêm cột drive_link nếu chưa có
+        c.execute("ALTER TABLE invoices ADD COLUMN drive_link TEXT")
+    except: pass
+    
+    try:
+        # Thêm cột request_edit (0: ko, 1: có yêu cầu duyệt sửa)
+        c.execute("ALTER TABLE invoices ADD COLUMN request_edit INTEGER DEFAULT 0")
+    except: pass
+
+    try:
+        # Thêm cột ngày chuẩn ISO (YYYY-MM-DD) và tháng (YYYY-MM)
+        c.execute("ALTER TABLE invoices ADD COLUMN iso_date TEXT")
+        c.execute("ALTER TABLE invoices ADD COLUMN year_month TEXT")
+    except: pass
+
+    try:
+        # Tiến trình đang giữ job (nhiều tiến trình app chung DB: chỉ gỡ khóa job của tiến trình đã chết)
+        c.execute("ALTER TABLE jobs ADD COLUMN worker_pid INTEGER")
+    except: pass
+
+    try:
+        # Hàng đợi (JobQueue) đang giữ job: trong cùng tiến trình có thể có hàng đợi mới sau khi xóa cache
+        c.execute("ALTER TABLE jobs ADD COLUMN locked_by TEXT")
+    except: pass
+
+    # Điền ngày ISO cho các dòng cũ
+    rows = c.execute("SELECT id, date FROM invoices WHERE iso_date IS NULL AND date IS NOT NULL AND date != ''").fetchall()
+    backfill = [(iso, iso[:7], r[0]) for r in rows if (iso := to_iso_date(r[1]))]
+    c.executemany("UPDATE invoices SET iso_date=?, year_month=? WHERE id=?", backfill)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status_iso ON invoices(status, iso_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status_month ON invoices(status, year_month)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_type ON invoices(type)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status_type_iso ON invoices(status, type, iso_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_request_edit ON invoices(request_edit, status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_project ON project_links(project_id)")
+    # Mỗi hóa đơn chỉ thuộc 1 dự án: bỏ liên kết trùng của DB cũ rồi khóa bằng UNIQUE.
+    # Luôn giữ liên kết có id nhỏ nhất (tạo sớm nhất) của mỗi hóa đơn; in ra các cặp hóa đơn/dự án bị bỏ
+    extra = c.execute('''SELECT l.id, l.invoice_id, l.project_id, k.project_id FROM project_links l
+                         JOIN (SELECT invoice_id, MIN(id) AS keep_id FROM project_links GROUP BY invoice_id HAVING COUNT(*) > 1) d
+                           ON d.invoice_id = l.invoice_id AND l.id != d.keep_id
+                         JOIN project_links k ON k.id = d.keep_id ORDER BY l.invoice_id, l.id''').fetchall()
+    if extra:
+        print(f"Bỏ {len(extra)} liên kết dự án trùng (mỗi hóa đơn giữ liên kết có id nhỏ nhất):")
+        for link_id, inv_id, proj_id, kept in extra:
+            print(f"  hóa đơn #{inv_id}: bỏ dự án #{proj_id} (liên kết #{link_id}), giữ dự án #{kept}")
+        c.executemany("DELETE FROM project_links WHERE id = ?", [(r[0],) for r in extra])
+    c.execute("DROP INDEX IF EXISTS idx_links_invoice")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_links_invoice ON project_links(invoice_id)")
+
+    # Bảng tổng hợp báo cáo dự án + trigger; lần đầu tạo thì tính từ dữ liệu cũ
+    if ensure_project_summary(conn): rebuild_project_summary(conn)
+    # Chỉ mục tìm kiếm toàn văn (FTS5)
+    ensure_search_index(conn)
+    # Bảng lưu số liệu hiệu năng (chỉ ghi khi admin bật)
+    ensure_metrics_table(conn)
+    # Version thương hiệu + logo thu nhỏ
+    ensure_branding_tables(conn)
+    # Khóa chống trùng (ký hiệu|số|bên bán) + unique index trên hóa đơn active
+    ensure_dedup_index(conn)
+    # Bảng theo dõi file lưu trữ theo năm (archive.py) + view báo cáo gộp nóng/lưu trữ
+    ensure_archive_tables(conn)
+    # Số version dữ liệu báo cáo (trigger trên bảng tổng hợp) để app cache ma trận báo cáo
+    ensure_report_version(conn)
+
+def open_database(path, **kwargs):
+    # Dùng ngoài Streamlit (CLI, script): pool + tạo bảng/migration
+    db = Database(path, **kwargs)
+    with db.transaction() as conn:
+        init_db(conn)
+        migrate_db_columns(conn)
+    return db
+
+# --- LỆNH GHI CHUNG CHO db.write ---
+def run_statements(conn, statements):
+    # [(sql, params)] hoặc [(sql, [params, ...], True)] cho executemany; trả về [(lastrowid, rowcount)] theo thứ tự
+    out = []
+    for sql, params, *many in statements:
+        cur = conn.executemany(sql, params) if many and many[0] else conn.execute(sql, params)
+        out.append((cur.lastrowid, cur.rowcount))
+    return out
+
+def delete_all_invoices(conn):
+    # id bắt đầu lại từ 1: liên kết cũ phải xóa cùng, không thì hóa đơn mới nhận nhầm dự án của hóa đơn cũ cùng id
+    conn.execute("DELETE FROM project_links")
+    conn.execute("DELETE FROM invoices")
+    conn.execute("DELETE FROM project_month_summary")
+    conn.execute("DELETE FROM sqlite_sequence WHERE name='invoices'")
+    # File lưu trữ: người gọi xóa sau khi giao dịch đã commit (archive.remove_archive_files)
+    drop_archives(conn)
+
+# --- GHI HÓA ĐƠN (gọi trong giao dịch của người gọi) ---
+def insert_invoice(conn, t, date, num, sym, seller, buyer, pre, tax, total, final_name, edit_count, memo, path, drive_link="", req_flag=0, raw_text=None):
+    iso = to_iso_date(date)
+    # Trùng hóa đơn active khác -> sqlite3.IntegrityError (uq_invoices_dedup)
+    cur = conn.execute("""INSERT INTO invoices 
+    (type, date, invoice_number, invoice_symbol, seller_name, buyer_name, 
+    pre_tax_amount, tax_amount, total_amount, file_name, status, 
+    edit_count, created_at, memo, file_path, drive_link, request_edit, iso_date, year_month, dedup_key) 
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+              (t, date, num, sym, seller, buyer, pre, tax, total, final_name, 
+               'active', edit_count, 
+               datetime.now().strftime("%Y-%m-%d %H:%M:%S"), memo, path, drive_link, req_flag,
+               iso, iso[:7] if iso else None, dedup_key(sym, num, seller)))
+    # Text thô của file vào chỉ mục tìm kiếm (trigger đã tạo dòng FTS cho hóa đơn)
+    if raw_text: set_invoice_text(conn, cur.lastrowid, raw_text)
+    return cur.lastrowid
+
+# --- CACHE PHÂN TÍCH (khóa = SHA-256 nội dung file, LRU theo last_used; gọi trong giao dịch của người gọi) ---
+def cache_lookup(conn, file_hash, engine_version):
+    # Trả về (info, msg, pdf_bytes) hoặc None, đồng thời đếm hit/miss
+    row = conn.execute("SELECT info_json, msg, pdf_bytes FROM extract_cache WHERE file_hash=? AND engine_version=?", (file_hash, engine_version)).fetchone()
+    if not row:
+        conn.execute("UPDATE cache_stats SET misses = misses + 1 WHERE name='extract'")
+        return None
+    conn.execute("UPDATE extract_cache SET last_used=? WHERE file_hash=?", (time.time(), file_hash))
+    conn.execute("UPDATE cache_stats SET hits = hits + 1 WHERE name='extract'")
+    return json.loads(row[0]), row[1], row[2]
+
+def cache_store(conn, file_hash, engine_version, info, msg, pdf_bytes, max_bytes):
+    info_json = json.dumps(info, ensure_ascii=False)
+    size = len(info_json) + (len(pdf_bytes) if pdf_bytes else 0)
+    conn.execute("INSERT OR REPLACE INTO extract_cache (file_hash, engine_version, info_json, msg, pdf_bytes, size, last_used, created_at) VALUES (?,?,?,?,?,?,?,?)",
+                 (file_hash, engine_version, info_json, msg, pdf_bytes, size, time.time(), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    # Vượt giới hạn thì bỏ các bản ghi dùng lâu nhất
+    conn.execute("""DELETE FROM extract_cache WHERE file_hash IN (
+                      SELECT file_hash FROM (SELECT file_hash, SUM(size) OVER (ORDER BY last_used DESC) AS running FROM extract_cache)
+                      WHERE running > ?)""", (max_bytes,))
@@ -0,0 +1,91 @@
+import re
+import sys
+import sqlite3
+import unicodedata
+
+# ==========================================
+# CHỐNG LƯU TRÙNG HÓA ĐƠN
+# invoices.dedup_key = ký hiệu | số | bên bán (đã chuẩn hóa), unique index một phần trên các hóa đơn active
+# -> tra trùng là 1 lần tìm trên index, DB tự chặn lưu trùng kể cả khi 2 người lưu cùng lúc
+# Dữ liệu cũ đã trùng trước khi có index: bản sau được đánh dấu dup_of = id bản đầu (nằm ngoài index, xem báo cáo quét)
+# ==========================================
+
+DEDUP_INDEX = "uq_invoices_dedup"
+DEDUP_DDL = [
+    f'''CREATE UNIQUE INDEX IF NOT EXISTS {DEDUP_INDEX} ON invoices(dedup_key)
+        WHERE status = 'active' AND dedup_key IS NOT NULL AND dup_of IS NULL''',
+    '''CREATE INDEX IF NOT EXISTS idx_invoices_dup_of ON invoices(dup_of) WHERE dup_of IS NOT NULL''',
+    # Hủy hóa đơn đang giữ key: bản trùng cũ sớm nhất còn active thay chỗ, các bản còn lại trỏ sang bản đó
+    '''CREATE TRIGGER IF NOT EXISTS trg_dedup_cancel AFTER UPDATE OF status ON invoices
+       WHEN OLD.status = 'active' AND NEW.status != 'active' AND OLD.dup_of IS NULL AND OLD.dedup_key IS NOT NULL BEGIN
+        UPDATE invoices SET dup_of = NULL WHERE id = (SELECT MIN(id) FROM invoices WHERE dup_of = OLD.id AND status = 'active');
+        UPDATE invoices SET dup_of = (SELECT id FROM invoices WHERE dedup_key = OLD.dedup_key AND status = 'active' AND dup_of IS NULL)
+        WHERE dup_of = OLD.id;
+    END''',
+]
+
+def dedup_key(sym, num, seller):
+    # Không phân biệt hoa/thường, dấu cách, ký tự phân cách; số HĐ bỏ số 0 đầu ("0000123" = "123")
+    num = re.sub(r"[^0-9A-Z]", "", (num or "").upper()).lstrip("0")
+    sym = re.sub(r"[^0-9A-Z]", "", (sym or "").upper())
+    seller = " ".join(re.sub(r"[\W_]+", " ", unicodedata.normalize("NFC", seller or "").casefold()).split())
+    # Thiếu ký hiệu, số hoặc bên bán thì chưa đủ để coi là trùng (vd. "|7|"): không có key, nằm ngoài unique index
+    if not (num and sym and seller): return None
+    return f"{sym}|{num}|{seller}"
+
+def ensure_dedup_index(conn):
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (DEDUP_INDEX,)).fetchone()
+    if not existed: mark_existing_duplicates(conn)
+    else: drop_weak_keys(conn)
+    for ddl in DEDUP_DDL:
+        conn.execute(ddl)
+    return not existed
+
+def mark_existing_duplicates(conn):
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(invoices)")}
+    if "dedup_key" not in cols: conn.execute("ALTER TABLE invoices ADD COLUMN dedup_key TEXT")
+    if "dup_of" not in cols: conn.execute("ALTER TABLE invoices ADD COLUMN dup_of INTEGER")
+    # Lần đầu: tính key cho hóa đơn cũ, đánh dấu bản trùng (giữ hóa đơn lưu sớm nhất) rồi mới tạo unique index
+    rows = conn.execute("SELECT id, invoice_symbol, invoice_number, seller_name FROM invoices").fetchall()
+    conn.executemany("UPDATE invoices SET dedup_key=? WHERE id=?", [(dedup_key(r[1], r[2], r[3]), r[0]) for r in rows])
+    conn.execute('''UPDATE invoices SET dup_of = d.first_id
+                    FROM (SELECT id, MIN(id) OVER (PARTITION BY dedup_key) AS first_id FROM invoices
+                          WHERE status = 'active' AND dedup_key IS NOT NULL) d
+                    WHERE invoices.id = d.id AND d.first_id != d.id''')
+
+def drop_weak_keys(conn):
+    # DB lưu trước khi key bắt buộc đủ 3 phần: bỏ key thiếu ký hiệu/bên bán và dấu trùng dựa trên key đó
+    n = conn.execute('''UPDATE invoices SET dedup_key = NULL, dup_of = NULL
+                        WHERE dedup_key LIKE '|%' OR dedup_key LIKE '%|' ''').rowcount
+    if n: print(f"Bỏ khóa chống trùng thiếu ký hiệu/bên bán của {n} hóa đơn")
+    return n
+
+def find_duplicates(conn, keys):
+    # {key: hóa đơn active đang giữ key}; điều kiện WHERE trùng với index một phần nên mỗi key chỉ tốn 1 lần tìm trên index
+    keys = list({k for k in keys if k})
+    if not keys: return {}
+    marks = ",".join("?" * len(keys))
+    rows = conn.execute(f'''SELECT id, dedup_key, date, invoice_number, seller_name, total_amount FROM invoices
+                            WHERE dedup_key IN ({marks}) AND status = 'active' AND dedup_key IS NOT NULL AND dup_of IS NULL''', keys).fetchall()
+    return {r[1]: r for r in rows}
+
+def scan_duplicates(conn):
+    # Các nhóm hóa đơn active cùng key (kể cả bản đã đánh dấu dup_of), nhiều bản nhất trước
+    return conn.execute('''SELECT dedup_key, COUNT(*) AS n, GROUP_CONCAT(id) AS ids, MIN(date) AS date,
+                                  MAX(seller_name) AS seller, SUM(total_amount) - MIN(total_amount) AS extra
+                           FROM invoices WHERE status = 'active' AND dedup_key IS NOT NULL
+                           GROUP BY dedup_key HAVING COUNT(*) > 1 ORDER BY n DESC, extra DESC''').fetchall()
+
+# Quét 1 lần DB hiện có: python dedup.py scan [invoice_app.db]
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "scan":
+        print("Cách dùng: python dedup.py scan [đường dẫn DB]")
+        sys.exit(1)
+    conn = sqlite3.connect(sys.argv[2] if len(sys.argv) > 2 else "invoice_app.db")
+    with conn:
+        ensure_dedup_index(conn)
+    groups = scan_duplicates(conn)
+    print(f"{len(groups)} nhóm hóa đơn trùng, {sum(g[1] - 1 for g in groups)} bản thừa, tiền bị tính thừa: {sum(g[5] or 0 for g in groups):,.0f}")
+    for key, n, ids, date, seller, extra in groups:
+        print(f"  {n} bản  #{ids.replace(',', ', #')}  {date}  {seller}  [{key}]")
+    conn.close()
@@ -0,0 +1,191 @@
+import io
+import os
+import csv
+import sys
+import time
+import heapq
+import argparse
+import itertools
+import tempfile
+from contextlib import nullcontext
+from db import open_database
+from archive import archive_readers
+
+# ==========================================
+# XUẤT DỮ LIỆU CHO KẾ TOÁN: HÓA ĐƠN & LÃI/LỖ DỰ ÁN THEO THÁNG -> CSV / XLSX / PARQUET
+# Đọc SQLite theo từng khối (fetchmany) và ghi thẳng ra file, không dựng DataFrame
+# -> bộ nhớ cố định dù xuất hàng triệu dòng; 1 câu SELECT = 1 snapshot nhất quán (WAL)
+# Hóa đơn gồm cả các năm đã chuyển sang file lưu trữ (archive.py), lãi/lỗ đọc view project_month_all (đã gộp sẵn)
+# python export.py invoices|pnl <file.csv|.xlsx|.parquet> [bộ lọc]  (chạy định kỳ hằng đêm)
+# ==========================================
+
+CHUNK_ROWS = 5000
+# Giới hạn dòng của 1 sheet Excel (trừ dòng tiêu đề), vượt thì sang sheet mới
+XLSX_SHEET_ROWS = 1048575
+
+# (cột, kiểu) - kiểu dùng cho schema Parquet
+INVOICE_COLUMNS = [("id", "int"), ("type", "str"), ("date", "str"), ("iso_date", "str"), ("invoice_symbol", "str"), ("invoice_number", "str"),
+                   ("seller_name", "str"), ("buyer_name", "str"), ("pre_tax_amount", "float"), ("tax_amount", "float"), ("total_amount", "float"),
+                   ("status", "str"), ("project", "str"), ("memo", "str"), ("file_name", "str"), ("drive_link", "str"), ("created_at", "str")]
+PNL_COLUMNS = [("project", "str"), ("year_month", "str"), ("revenue", "float"), ("cost", "float"), ("profit", "float"), ("invoices", "int")]
+
+EXPORT_MIME = {"csv": "text/csv", "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+               "parquet": "application/vnd.apache.parquet"}
+
+# --- CÂU TRUY VẤN (trả về sql, params, cột) ---
+def invoice_export_query(date_from=None, date_to=None, inv_type=None, status=None, project_id=None):
+    # date_from/date_to dạng YYYY-MM-DD so với iso_date; sắp theo id để SQLite đọc thẳng theo rowid, không phải sort
+    # Không ghi tên schema: chạy nguyên văn trên file lưu trữ mở bằng open_archive_reader
+    where, params = ["1=1"], []
+    if date_from: where.append("i.iso_date >= ?"); params.append(date_from)
+    if date_to: where.append("i.iso_date <= ?"); params.append(date_to)
+    if inv_type: where.append("i.type = ?"); params.append(inv_type)
+    if status: where.append("i.status = ?"); params.append(status)
+    if project_id: where.append("l.project_id = ?"); params.append(project_id)
+    cols = ", ".join("p.project_name" if c == "project" else f"i.{c}" for c, _ in INVOICE_COLUMNS)
+    sql = f"""SELECT {cols} FROM invoices i
+              LEFT JOIN project_links l ON l.invoice_id = i.id LEFT JOIN projects p ON p.id = l.project_id
+              WHERE {' AND '.join(where)} ORDER BY i.id"""
+    return sql, params, INVOICE_COLUMNS
+
+def pnl_export_query(month_from=None, month_to=None, project_id=None):
+    # Đọc bảng tổng hợp (phần nóng do trigger cập nhật + phần đã lưu trữ), thu = hóa đơn đầu ra, chi = đầu vào
+    where, params = ["1=1"], []
+    if month_from: where.append("s.year_month >= ?"); params.append(month_from)
+    if month_to: where.append("s.year_month <= ?"); params.append(month_to)
+    if project_id: where.append("s.project_id = ?"); params.append(project_id)
+    sql = f"""SELECT p.project_name, s.year_month,
+                     SUM(CASE WHEN s.type = 'OUT' THEN s.total ELSE 0.0 END) AS revenue,
+                     SUM(CASE WHEN s.type = 'IN' THEN s.total ELSE 0.0 END) AS cost,
+                     SUM(CASE WHEN s.type = 'OUT' THEN s.total WHEN s.type = 'IN' THEN -s.total ELSE 0.0 END) AS profit,
+                     SUM(s.cnt) AS invoices
+              FROM project_month_all s JOIN projects p ON p.id = s.project_id
+              WHERE {' AND '.join(where)}
+              GROUP BY s.project_id, s.year_month ORDER BY p.project_name, s.year_month"""
+    return sql, params, PNL_COLUMNS
+
+def iter_chunks(conn, sql, params=(), chunk_rows=CHUNK_ROWS):
+    cur = conn.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(chunk_rows)
+        if not rows: break
+        yield [tuple(r) for r in rows]
+
+def merge_by_id(sources, chunk_rows=CHUNK_ROWS):
+    # Các nguồn (DB nóng trước, rồi file lưu trữ) đều sắp theo id ở cột đầu: trộn thành 1 dòng sắp theo id, mỗi nguồn chỉ giữ
+    # 1 khối trong bộ nhớ. Hóa đơn nằm ở cả 2 nơi (chuyển lưu trữ dở dang) chỉ lấy 1 lần, bản của nguồn đứng trước
+    rows = heapq.merge(*(itertools.chain.from_iterable(s) for s in sources), key=lambda r: r[0])
+    rows = (next(group) for _, group in itertools.groupby(rows, key=lambda r: r[0]))
+    while chunk := list(itertools.islice(rows, chunk_rows)):
+        yield chunk
+
+# --- GHI FILE: nhận file nhị phân đang mở + các khối dòng, trả về số dòng đã ghi ---
+def write_csv(out, columns, chunks):
+    # utf-8-sig: Excel mở đúng tiếng Việt
+    text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+    w = csv.writer(text)
+    w.writerow([c for c, _ in columns])
+    n = 0
+    for rows in chunks:
+        w.writerows(rows); n += len(rows)
+    text.flush(); text.detach()
+    return n
+
+def write_xlsx(out, columns, chunks):
+    # write_only: openpyxl ghi từng dòng ra file tạm, không giữ cả sheet trong bộ nhớ
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws, in_sheet, n = None, XLSX_SHEET_ROWS, 0
+    for rows in chunks:
+        for r in rows:
+            if in_sheet >= XLSX_SHEET_ROWS:
+                ws = wb.create_sheet(f"Sheet{len(wb.worksheets) + 1}")
+                ws.append([c for c, _ in columns]); in_sheet = 0
+            ws.append(r); in_sheet += 1
+        n += len(rows)
+    if ws is None: wb.create_sheet("Sheet1").append([c for c, _ in columns])
+    wb.save(out)
+    return n
+
+def write_parquet(out, columns, chunks):
+    # Mỗi khối = 1 row group, schema cố định theo khai báo cột (SQLite không có kiểu cột chặt)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string()}
+    schema = pa.schema([(c, types[t]) for c, t in columns])
+    n = 0
+    with pq.ParquetWriter(out, schema, compression="zstd") as writer:
+        for rows in chunks:
+            cols = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays([pa.array(v, type=f.type) for v, f in zip(cols, schema)], schema=schema))
+            n += len(rows)
+    return n
+
+EXPORT_WRITERS = {"csv": write_csv, "xlsx": write_xlsx, "parquet": write_parquet}
+
+def export_to(out, fmt, conn, query, archives=()):
+    # archives: kết nối đọc file lưu trữ (archive_readers) khi xuất hóa đơn. Mở archive_readers trước rồi mới lấy kết nối pool:
+    # archive_readers cũng mượn 1 kết nối pool, đang giữ sẵn 1 kết nối mà chờ thêm thì pool_size lượt xuất cùng lúc sẽ treo
+    sql, params, columns = query
+    chunks = iter_chunks(conn, sql, params)
+    if archives: chunks = merge_by_id([chunks] + [iter_chunks(a, sql, params) for _, a in archives])
+    return EXPORT_WRITERS[fmt](out, columns, chunks)
+
+def count_rows(db, query, with_archives=False):
+    # Số dòng sẽ xuất (cộng cả file lưu trữ; hóa đơn đang chuyển dở nằm ở 2 nơi thì đếm 2 lần) để app chặn bản tải quá lớn
+    sql, params, _ = query
+    with archive_readers(db) if with_archives else nullcontext(()) as archives, db.connection() as conn:
+        return sum(c.execute(f"SELECT COUNT(*) FROM ({sql})", params).fetchone()[0] for c in [conn] + [a for _, a in archives])
+
+def export_bytes(db, fmt, query, with_archives=False):
+    # Cho nút tải về của app: ghi vào file tạm (tràn ra đĩa khi lớn), trả về bytes
+    with tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as tmp:
+        with archive_readers(db) if with_archives else nullcontext(()) as archives, db.connection() as conn:
+            export_to(tmp, fmt, conn, query, archives)
+        tmp.seek(0)
+        return tmp.read()
+
+def export_file(db, path, fmt, query, with_archives=False):
+    # Ghi ra file tạm cùng thư mục rồi rename: lịch chạy đêm không bao giờ để lại file dở dang
+    fd, tmp = tempfile.mkstemp(prefix=".export-", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f, archive_readers(db) if with_archives else nullcontext(()) as archives, db.connection() as conn:
+            n = export_to(f, fmt, conn, query, archives)
+        # mkstemp tạo file 0600, trả lại quyền đọc thông thường cho file xuất
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return n
+
+def project_id_by_name(db, name):
+    row = db.execute("SELECT id FROM projects WHERE project_name = ?", (name,), fetch_one=True)
+    if not row: raise SystemExit(f"Không tìm thấy dự án: {name}")
+    return row[0]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Xuất hóa đơn / lãi lỗ dự án theo tháng ra CSV, XLSX hoặc Parquet")
+    parser.add_argument("what", choices=["invoices", "pnl"], help="invoices: danh sách hóa đơn, pnl: lãi/lỗ theo dự án - tháng")
+    parser.add_argument("out", help="File đích (.csv, .xlsx, .parquet)")
+    parser.add_argument("--db", default="invoice_app.db", help="Đường dẫn DB")
+    parser.add_argument("--format", choices=list(EXPORT_WRITERS), help="Mặc định theo đuôi file đích")
+    parser.add_argument("--from", dest="date_from", help="invoices: từ ngày YYYY-MM-DD, pnl: từ tháng YYYY-MM")
+    parser.add_argument("--to", dest="date_to", help="invoices: đến ngày YYYY-MM-DD, pnl: đến tháng YYYY-MM")
+    parser.add_argument("--type", choices=["IN", "OUT"], help="invoices: IN (đầu vào) / OUT (đầu ra)")
+    parser.add_argument("--status", choices=["active", "deleted"], help="invoices: trạng thái hóa đơn")
+    parser.add_argument("--project", help="Tên dự án")
+    parser.add_argument("--no-archives", action="store_true", help="invoices: bỏ qua các năm đã chuyển sang file lưu trữ")
+    args = parser.parse_args()
+    fmt = args.format or os.path.splitext(args.out)[1].lstrip(".").lower()
+    if fmt not in EXPORT_WRITERS:
+        print(f"Không rõ định dạng '{fmt}', dùng --format {'|'.join(EXPORT_WRITERS)}")
+        sys.exit(1)
+    db = open_database(args.db)
+    pid = project_id_by_name(db, args.project) if args.project else None
+    if args.what == "invoices": query = invoice_export_query(args.date_from, args.date_to, args.type, args.status, pid)
+    else: query = pnl_export_query(args.date_from, args.date_to, pid)
+    started = time.time()
+    n = export_file(db, args.out, fmt, query, with_archives=args.what == "invoices" and not args.no_archives)
+    print(f"Đã xuất {n} dòng ra {args.out} trong {time.time() - started:.1f}s")
+    db.close()
@@ -0,0 +1,251 @@
+import re
+import io
+import pdfplumber
+from PIL import Image, ImageChops, ImageOps, ImageStat
+from reportlab.pdfgen import canvas
+from reportlab.lib.utils import ImageReader
+
+# ==========================================
+# BỘ TRÍCH XUẤT HÓA ĐƠN (PDF/IMAGE -> DỮ LIỆU)
+# Module độc lập với Streamlit để chạy được trong worker process
+# ==========================================
+
+# Tăng khi đổi logic trích xuất để cache cũ tự hết hiệu lực
+ENGINE_VERSION = 6
+
+def empty_info():
+    return {"date": "", "seller": "", "buyer": "", "inv_num": "", "inv_sym": "", "pre_tax": 0.0, "tax": 0.0, "total": 0.0, "all_numbers": [], "raw_text": "", "text_complete": True, "page_count": 0}
+
+# --- MẪU REGEX BIÊN DỊCH SẴN (dùng lại cho mọi file) ---
+NUMBER_RE = re.compile(r'(?<!\d)(?!0\d)\d{1,3}(?:[.,]\d{3})+(?![.,]\d)')
+INV_NUM_RE = re.compile(r'(?:Số hóa đơn|Số HĐ|Số|No)[:\s\.]*(\d{1,8})\b', re.IGNORECASE)
+INV_SYM_RE = re.compile(r'(?:Ký hiệu|Mẫu số|Serial)[:\s\.]*([A-Z0-9]{1,2}[A-Z0-9/-]{3,10})', re.IGNORECASE)
+DATE_RE = re.compile(r'(?:Ngày|ngày)\s+(\d{1,2})\s+(?:tháng|Tháng)\s+(\d{1,2})\s+(?:năm|Năm)\s+(\d{4})')
+DATE_ALT_RE = re.compile(r'(\d{2}/\d{2}/\d{4})')
+SELLER_RE = re.compile(r'^(Đơn vị bán|Người bán|Bên A|Nhà cung cấp)', re.IGNORECASE)
+BUYER_RE = re.compile(r'^(Đơn vị mua|Người mua|Khách hàng|Bên B)', re.IGNORECASE)
+TOTAL_KW = ("thanh toán", "tổng cộng")
+PRE_TAX_KW = ("tiền hàng", "thành tiền")
+# Tên bên bán/mua chỉ tìm trong các dòng đầu văn bản
+HEADER_LINES = 35
+
+def extract_numbers_from_line(line):
+    nums = []
+    for n in NUMBER_RE.findall(line):
+        v = float(n.replace('.', '').replace(',', ''))
+        # Bỏ các số giống năm
+        if not (1990 <= v <= 2030): nums.append(v)
+    return nums
+
+# --- HÀM CHUYỂN ẢNH SANG PDF (toàn bộ trong bộ nhớ) ---
+# Ảnh được thu nhỏ để vừa khổ A4 ở CONVERT_DPI rồi nén JPEG
+CONVERT_DPI = 150
+A4_INCHES = (8.27, 11.69)
+# Chất lượng JPEG thử lần lượt, dừng ở mức đầu tiên đạt số byte/pixel mục tiêu
+JPEG_QUALITIES = (85, 75, 65, 50)
+JPEG_TARGET_BPP = 0.25
+
+def _is_grayscale(img):
+    # Ảnh scan/chụp giấy trắng đen: 3 kênh gần như trùng nhau -> lưu 1 kênh cho nhẹ
+    r, g, b = img.resize((64, 64)).split()
+    diff = ImageChops.add(ImageChops.difference(r, g), ImageChops.difference(g, b))
+    return ImageStat.Stat(diff).mean[0] < 4
+
+def _encode_jpeg(img):
+    best = None
+    for q in JPEG_QUALITIES:
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=q, optimize=True)
+        best = buf.getvalue()
+        if len(best) <= JPEG_TARGET_BPP * img.width * img.height: break
+    return best
+
+def convert_image_to_pdf(image_file, dpi=CONVERT_DPI):
+    try:
+        img = Image.open(image_file)
+        # JPEG lớn: giải nén thẳng ở tỉ lệ 1/2, 1/4... vẫn đủ cho khổ A4 ở dpi, không dựng cả ảnh gốc trong RAM
+        long_px = round(max(A4_INCHES) * dpi)
+        img.draft('RGB', (long_px, long_px))
+        # Xoay theo EXIF (ảnh chụp điện thoại)
+        img = ImageOps.exif_transpose(img)
+        # Chuyển sang RGB nếu cần
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        # Thu nhỏ để không vượt khổ A4 ở độ phân giải dpi (không phóng to ảnh nhỏ)
+        short_in, long_in = A4_INCHES
+        box = (short_in * dpi, long_in * dpi) if img.width <= img.height else (long_in * dpi, short_in * dpi)
+        scale = min(1.0, box[0] / img.width, box[1] / img.height)
+        if scale < 1.0:
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+        if _is_grayscale(img):
+            img = img.convert('L')
+
+        jpeg_bytes = _encode_jpeg(img)
+        # Kích thước trang (point) = pixel * 72 / dpi
+        page_w, page_h = img.width * 72 / dpi, img.height * 72 / dpi
+
+        pdf_buffer = io.BytesIO()
+        c = canvas.Canvas(pdf_buffer, pagesize=(page_w, page_h))
+        c.drawImage(ImageReader(io.BytesIO(jpeg_bytes)), 0, 0, page_w, page_h)
+        c.save()
+
+        pdf_buffer.seek(0)
+        return pdf_buffer
+    except Exception:
+        return None
+
+# Text thô của toàn bộ PDF (dùng cho phân tích và chỉ mục tìm kiếm)
+def extract_text(pdf_file):
+    return read_pdf_text(pdf_file)[0]
+
+# (text, số trang) - số trang dùng để đo tốc độ import
+def read_pdf_text(pdf_file):
+    text_content = ""
+    with pdfplumber.open(pdf_file) as pdf:
+        for page in pdf.pages:
+            extracted = page.extract_text()
+            if extracted:
+                text_content += extracted + "\n"
+        page_count = len(pdf.pages)
+    return text_content, page_count
+
+# --- QUÉT 1 TRANG: mỗi dòng chỉ đi qua 1 lần ---
+# Trường đầu trang (số, ký hiệu, ngày) lấy kết quả khớp đầu tiên theo thứ tự trang,
+# các dòng tổng tiền lấy dòng cuối cùng -> mỗi trang ghi lại giá trị cuối của riêng nó
+class _InvoiceScan:
+    def __init__(self):
+        self.info = empty_info()
+        self.date_alt = ""
+        self.texts = {}
+        self.page_totals = {}
+        self.numbers = set()
+        self.lines_seen = 0
+
+    def header_done(self):
+        # Chỉ dừng khi đã có ngày dạng "Ngày .. tháng .. năm": ngày dd/mm/yyyy chỉ là dự phòng,
+        # dạng chính nằm ở trang sau vẫn được ưu tiên nên phải đọc tiếp
+        i = self.info
+        return bool(i["inv_num"] and i["inv_sym"] and i["date"]) and self.lines_seen >= HEADER_LINES
+
+    def scan_page(self, page_no, text, forward=True):
+        info = self.info
+        self.texts[page_no] = text
+        if not text: return
+        if forward:
+            if not info["inv_num"] and (m := INV_NUM_RE.search(text)): info["inv_num"] = m.group(1).zfill(7)
+            if not info["inv_sym"] and (m := INV_SYM_RE.search(text)): info["inv_sym"] = m.group(1)
+            if not info["date"] and (m := DATE_RE.search(text)): info["date"] = f"{int(m.group(1)):02d}/{int(m.group(2)):02d}/{m.group(3)}"
+            if not self.date_alt and (m := DATE_ALT_RE.search(text)): self.date_alt = m.group(1)
+        totals = {}
+        for line in text.split('\n'):
+            if forward and self.lines_seen < HEADER_LINES:
+                self.lines_seen += 1
+                l_c = line.strip()
+                if SELLER_RE.search(l_c): info["seller"] = l_c.split(':')[-1].strip()
+                elif BUYER_RE.search(l_c): info["buyer"] = l_c.split(':')[-1].strip()
+            nums = extract_numbers_from_line(line)
+            if not nums: continue
+            self.numbers.update(nums)
+            line_l = line.lower()
+            val = max(nums)
+            if any(kw in line_l for kw in TOTAL_KW): totals["total"] = val
+            elif any(kw in line_l for kw in PRE_TAX_KW): totals["pre_tax"] = val
+            elif "thuế" in line_l and "suất" not in line_l: totals["tax"] = val
+        self.page_totals[page_no] = totals
+
+def scan_invoice_pdf(pdf_file):
+    # Đọc trang 1 (và các trang tiếp theo đến khi đủ thông tin đầu hóa đơn), rồi đọc ngược từ trang cuối
+    # đến khi gặp đủ khối tổng tiền (tổng cộng, tiền hàng, thuế): các trang giữa của bảng kê dài được bỏ qua.
+    # Các trường hóa đơn giống quét toàn bộ (dòng tổng tiền lấy giá trị xuất hiện sau cùng); riêng raw_text/all_numbers
+    # chỉ gồm các trang đã đọc -> text_complete = False, người lưu hóa đơn đọc lại đủ text cho chỉ mục tìm kiếm
+    scan = _InvoiceScan()
+    with pdfplumber.open(pdf_file) as pdf:
+        page_count = len(pdf.pages)
+        def read(i):
+            page = pdf.pages[i]
+            text = page.extract_text() or ""
+            page.close()
+            return text
+        i = 0
+        while i < page_count and not scan.header_done():
+            scan.scan_page(i, read(i)); i += 1
+        j, tail = page_count - 1, {}
+        while j >= i and len(tail) < 3:
+            scan.scan_page(j, read(j), forward=False)
+            for k, v in scan.page_totals[j].items(): tail.setdefault(k, v)
+            j -= 1
+    return scan, page_count
+
+def extract_data_smart(file_obj, is_image=False):
+    msg = None
+
+    try:
+        # Nếu là ảnh, convert sang PDF trước
+        pdf_file = file_obj
+        if is_image:
+            pdf_buffer = convert_image_to_pdf(file_obj)
+            if pdf_buffer:
+                pdf_file = pdf_buffer
+            else:
+                return None, "Lỗi chuyển đổi ảnh sang PDF"
+
+        # Dùng pdfplumber để đọc (hoạt động tốt với cả PDF gốc và PDF từ ảnh nếu ảnh rõ nét)
+        scan, page_count = scan_invoice_pdf(pdf_file)
+        text_content = "".join(scan.texts[p] + "\n" for p in sorted(scan.texts) if scan.texts[p])
+
+        # Nếu PDF (từ ảnh) mà không trích xuất được text -> Cần OCR (Tesseract)
+        # Ở đây ta giả định pdfplumber đọc được text cơ bản. Nếu không, trả về thông báo nhập tay.
+        if not text_content.strip():
+             info = empty_info()
+             info["page_count"] = page_count
+             return info, "Không đọc được chữ từ file này. Vui lòng nhập tay."
+
+    except Exception as e: return None, f"Lỗi đọc file: {str(e)}"
+
+    info = scan.info
+    if not info["date"]: info["date"] = scan.date_alt
+    # Mỗi dòng tổng tiền: lấy giá trị ở trang sau cùng có dòng đó
+    for p in sorted(scan.page_totals):
+        info.update(scan.page_totals[p])
+
+    if info["total"] == 0 and scan.numbers: info["total"] = max(scan.numbers)
+    if info["pre_tax"] == 0: info["pre_tax"] = round(info["total"] / 1.08)
+    if info["tax"] == 0: info["tax"] = info["total"] - info["pre_tax"]
+
+    info["all_numbers"] = list(scan.numbers)
+    # Text của các trang đã đọc (dùng cho chỉ mục tìm kiếm); thiếu trang giữa thì text_complete = False
+    info["raw_text"] = text_content
+    info["text_complete"] = len(scan.texts) == page_count
+    info["page_count"] = page_count
+    return info, msg
+
+# --- PHÂN TÍCH FILE: ảnh chỉ convert 1 lần, trả lại PDF đã convert để lưu ---
+def analyze_file(src, is_image=False):
+    # src: đường dẫn hoặc file-like; đường dẫn thì PIL/pdfplumber đọc dần từ đĩa
+    pdf_bytes = None
+    if is_image:
+        pdf_buffer = convert_image_to_pdf(src)
+        if not pdf_buffer: return None, "Lỗi chuyển đổi ảnh sang PDF", None
+        pdf_bytes = pdf_buffer.getvalue()
+    info, msg = extract_data_smart(io.BytesIO(pdf_bytes) if pdf_bytes else src)
+    return info, msg, pdf_bytes
+
+def analyze_bytes(data, is_image=False):
+    return analyze_file(io.BytesIO(data), is_image=is_image)
+
+# --- ENTRY POINT CHO WORKER PROCESS (nhận bytes vì UploadedFile không pickle được) ---
+def extract_from_bytes(file_name, data, is_image=False):
+    try:
+        info, msg, pdf_bytes = analyze_bytes(data, is_image=is_image)
+    except Exception as e:
+        info, msg, pdf_bytes = None, f"Lỗi đọc file: {str(e)}", None
+    return file_name, info, msg, pdf_bytes
+
+# Worker đọc thẳng file spool trên đĩa: không phải gửi cả file qua pipe sang process
+def extract_from_path(file_name, path, is_image=False):
+    try:
+        info, msg, pdf_bytes = analyze_file(path, is_image=is_image)
+    except Exception as e:
+        info, msg, pdf_bytes = None, f"Lỗi đọc file: {str(e)}", None
+    return file_name, info, msg, pdf_bytes
@@ -0,0 +1,138 @@
+import io
+import os
+import re
+import sys
+import time
+import hashlib
+import argparse
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from db import open_database, insert_invoice
+from dedup import dedup_key, find_duplicates
+from extractor import analyze_bytes, extract_text
+from storage import BlobStore
+from thumbs import safe_make_thumbs
+
+# ==========================================
+# IMPORT HÓA ĐƠN HÀNG LOẠT TỪ THƯ MỤC (không cần Streamlit)
+# python import_invoices.py <thư mục> [--type IN|OUT] [--workers N] [--batch 200]
+# Phân tích song song trên N tiến trình, ghi DB theo lô trong 1 giao dịch,
+# tiến độ lưu ở bảng import_checkpoint: chạy lại sẽ bỏ qua file đã import xong
+# ==========================================
+
+EXTENSIONS = {".pdf": False, ".png": True, ".jpg": True, ".jpeg": True}
+
+def find_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            ext = os.path.splitext(name)[1].lower()
+            if ext in EXTENSIONS: yield os.path.abspath(os.path.join(dirpath, name)), EXTENSIONS[ext]
+
+# --- CHẠY TRONG WORKER: đọc file, phân tích, ghi vào kho file; chỉ trả kết quả nhỏ về tiến trình chính ---
+def import_one(path, is_image, files_dir):
+    try:
+        with open(path, "rb") as f: data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        info, msg, pdf_bytes = analyze_bytes(data, is_image=is_image)
+        if not info: return path, digest, None, None, msg or "Không phân tích được file"
+        if not info["date"] or not info["inv_num"]: return path, digest, info, None, msg or "Thiếu ngày/số hóa đơn"
+        # Phân tích bỏ qua các trang giữa của bảng kê dài: chỉ mục tìm kiếm cần text của mọi trang
+        if not info["text_complete"]: info["raw_text"] = extract_text(io.BytesIO(pdf_bytes or data))
+        store = BlobStore(files_dir)
+        blob = store.put(pdf_bytes) if pdf_bytes else store.put(data, digest=digest)
+        # Ảnh thu nhỏ tạo luôn trong worker; lỗi không làm hỏng việc import (python thumbs.py backfill)
+        safe_make_thumbs(blob)
+        return path, digest, info, blob, None
+    except Exception as e:
+        return path, None, None, None, f"Lỗi đọc file: {str(e)}"
+
+def write_batch(db, batch, inv_type):
+    # Hóa đơn + checkpoint cùng 1 giao dịch: dừng giữa chừng không để lại hóa đơn mà chưa đánh dấu xong
+    # Hóa đơn đã có trong DB (hoặc trùng file trước đó trong cùng lô): không lưu thêm, checkpoint trỏ về hóa đơn sẵn có
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    dups = 0
+    with db.transaction() as conn:
+        existing = find_duplicates(conn, [dedup_key(b[2]["inv_sym"], b[2]["inv_num"], b[2]["seller"]) for b in batch if not b[4]])
+        for path, digest, info, blob, err in batch:
+            inv_id, status = None, "failed" if err else "done"
+            key = None if err else dedup_key(info["inv_sym"], info["inv_num"], info["seller"])
+            if key in existing:
+                inv_id, status, err = existing[key][0], "duplicate", f"Trùng hóa đơn #{existing[key][0]}"
+                dups += 1
+            elif not err:
+                name = re.sub(r'[\\/*?:"<>|]', "", os.path.basename(path))
+                if not path.lower().endswith(".pdf"): name = os.path.splitext(name)[0] + ".pdf"
+                inv_id = insert_invoice(conn, inv_type, info["date"], info["inv_num"], info["inv_sym"], info["seller"], info["buyer"],
+                                        info["pre_tax"], info["tax"], info["total"], name, 0, "", blob, raw_text=info["raw_text"])
+                if key: existing[key] = (inv_id,)
+            conn.execute("INSERT OR REPLACE INTO import_checkpoint (source_path, file_hash, status, invoice_id, error, run_at) VALUES (?,?,?,?,?,?)",
+                         (path, digest, status, inv_id, err, now))
+    return dups
+
+def run_import(args):
+    db = open_database(args.db)
+    done = {r[0] for r in db.execute("SELECT source_path FROM import_checkpoint WHERE status IN ('done', 'duplicate')")}
+    todo = [(p, img) for p, img in find_files(args.dir) if p not in done]
+    print(f"Tìm thấy {len(todo) + len(done)} file, đã import trước đó {len(done)}, cần xử lý {len(todo)}")
+
+    # Giữ nguyên đường dẫn kho như app (tương đối) để GC đối chiếu đúng file_path
+    files_dir = args.files_dir
+    ok, pages, dups, failed, batch = 0, 0, 0, [], []
+    started = time.time()
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+    queue = iter(todo)
+    running = set()
+    try:
+        while True:
+            # Giới hạn số file đang xử lý để không nạp cả thư mục vào bộ nhớ
+            while len(running) < args.workers * 4:
+                nxt = next(queue, None)
+                if nxt is None: break
+                running.add(pool.submit(import_one, nxt[0], nxt[1], files_dir))
+            if not running: break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                res = fut.result()
+                batch.append(res)
+                if res[2]: pages += res[2].get("page_count", 0)
+                if res[4]: failed.append((res[0], res[4]))
+                else: ok += 1
+            if len(batch) >= args.batch:
+                dups += write_batch(db, batch, args.type); batch = []
+                elapsed = time.time() - started
+                print(f"\r{ok + len(failed)}/{len(todo)} file ({(ok + len(failed)) / elapsed:.1f} file/s)", end="", flush=True)
+    except KeyboardInterrupt:
+        print("\nĐang dừng: lưu các file đã xử lý xong, lần chạy sau sẽ tiếp tục từ đây...")
+        pool.shutdown(wait=False, cancel_futures=True)
+    finally:
+        if batch: dups += write_batch(db, batch, args.type)
+        pool.shutdown(wait=True)
+        db.close()
+
+    elapsed = max(time.time() - started, 1e-9)
+    total = ok + len(failed)
+    print(f"\nXong {total} file trong {elapsed:.1f}s: {total / elapsed:.2f} file/s, {pages / elapsed:.2f} trang/s")
+    print(f"Thành công {ok - dups} (bỏ qua {dups} hóa đơn đã có), lỗi {len(failed)}")
+    if failed:
+        reasons = {}
+        for _, err in failed: reasons[err] = reasons.get(err, 0) + 1
+        for err, n in sorted(reasons.items(), key=lambda x: -x[1]): print(f"  {n:>6}  {err}")
+        for path, err in failed[:20]: print(f"  - {path}: {err}")
+        if len(failed) > 20: print(f"  ... và {len(failed) - 20} file khác (xem bảng import_checkpoint)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import hàng loạt hóa đơn PDF/ảnh từ thư mục vào invoice_app.db")
+    parser.add_argument("dir", help="Thư mục chứa hóa đơn (quét cả thư mục con)")
+    parser.add_argument("--db", default="invoice_app.db", help="Đường dẫn DB")
+    parser.add_argument("--files-dir", default=".uploaded_invoices", help="Thư mục kho file của app")
+    parser.add_argument("--type", choices=["IN", "OUT"], default="IN", help="IN: đầu vào (chi), OUT: đầu ra (thu)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Số tiến trình phân tích")
+    parser.add_argument("--batch", type=int, default=200, help="Số file ghi trong 1 giao dịch")
+    args = parser.parse_args()
+    if not os.path.isdir(args.dir):
+        print(f"Không tìm thấy thư mục: {args.dir}")
+        sys.exit(1)
+    sys.exit(run_import(args))
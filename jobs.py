@@ -0,0 +1,357 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from extractor import ENGINE_VERSION, extract_from_path, extract_text
+from db import insert_invoice, cache_lookup, cache_store, run_statements
+from metrics import percentile
+from dedup import dedup_key, find_duplicates
+from thumbs import safe_make_thumbs
+from search import set_invoice_text
+
+# ==========================================
+# HÀNG ĐỢI PHÂN TÍCH & LƯU HÓA ĐƠN CHẠY NỀN (bảng jobs)
+# Giao diện chỉ ghi file vào thư mục spool + 1 dòng jobs rồi trả về ngay, luồng worker làm phần nặng:
+#   queued -> parsing (phân tích trên pool process) -> ready (chờ người dùng kiểm tra)
+#   ready -> saving (người dùng bấm lưu) -> saved (ghi kho file + hóa đơn), lỗi ở bước nào cũng -> failed
+# Job nằm trong DB nên tắt/mở lại app thì job đang dở được chạy tiếp; nhiều tiến trình app chung DB thì worker
+# của mọi tiến trình cùng nhận job (worker_pid = tiến trình, locked_by = hàng đợi đang giữ job), mọi lệnh ghi đi qua db.write
+# ==========================================
+
+JOB_ACTIVE = ("queued", "parsing", "saving")
+JOB_LABELS = {"queued": "⏳ Đang chờ", "parsing": "🔍 Đang phân tích", "ready": "✅ Xong", "saving": "💾 Đang lưu",
+              "saved": "✔️ Đã lưu", "failed": "❌ Lỗi"}
+# Job đã phân tích mà không ai lưu thì bỏ sau 1 ngày; dòng đã xong giữ 14 ngày cho thống kê
+READY_TTL = 86400
+KEEP_DONE = 14 * 86400
+CLEANUP_EVERY = 3600
+# locked_by của các JobQueue đã start trong tiến trình này (luồng worker là daemon, chạy tới khi tiến trình tắt).
+# Xóa cache Streamlit tạo JobQueue mới trong cùng tiến trình: job mang pid này nhưng owner không có ở đây mới là của lần chạy trước
+LIVE_OWNERS = set()
+
+def start_process_pool(workers):
+    # Streamlit chạy app.py dưới tên __main__ (có __file__, không có __spec__) nên tiến trình spawn sẽ chạy lại cả app.py.
+    # Tạm trỏ __main__ sang module này lúc khởi động worker (import lại vô hại), gửi sẵn N việc để pool mở đủ N tiến trình
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        for f in [pool.submit(os.getpid) for _ in range(workers)]: f.result()
+    finally:
+        sys.modules['__main__'] = main
+    return pool
+
+class ProcessPool:
+    # Pool dùng chung lâu dài: 1 tiến trình worker chết (PDF lỗi làm crash, bị OOM killer) làm ProcessPoolExecutor hỏng
+    # vĩnh viễn, mọi submit sau đều BrokenProcessPool -> tạo pool mới rồi chạy lại việc đó 1 lần
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = start_process_pool(workers)
+        self.restarts = 0
+
+    def _renew(self, broken):
+        # Nhiều luồng cùng gặp pool hỏng: chỉ luồng đầu tiên tạo pool mới
+        with self.lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.executor = start_process_pool(self.workers)
+                self.restarts += 1
+
+    def run(self, fn, *args):
+        # Chạy fn trên pool và chờ kết quả; lần thử lại vẫn làm chết worker (chính file này gây lỗi) thì báo lỗi cho người gọi
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                self._renew(executor)
+                if attempt: raise
+
+    def map(self, fn, items, chunksize=1):
+        # Như Executor.map (giữ thứ tự); pool hỏng giữa chừng thì các việc chưa có kết quả chạy lại từng việc qua run
+        items, done = list(items), 0
+        executor = self.executor
+        try:
+            for result in executor.map(fn, items, chunksize=chunksize):
+                done += 1
+                yield result
+        except BrokenProcessPool:
+            self._renew(executor)
+            for item in items[done:]: yield self.run(fn, item)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def job_row(row):
+    job = dict(row)
+    job['result'] = json.loads(job['result_json']) if job.get('result_json') else None
+    job['fields'] = json.loads(job['fields_json']) if job.get('fields_json') else {}
+    return job
+
+def pid_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
+# --- LỆNH GHI (chạy qua db.write, trong 1 giao dịch; có writer service thì chạy ở tiến trình writer) ---
+def claim_job(conn, worker_pid, owner):
+    # Lưu trước (người dùng đang chờ, việc nhẹ), phân tích sau; chọn và khóa job trong cùng giao dịch nên 2 worker không nhận trùng
+    row = conn.execute("SELECT * FROM jobs WHERE locked=0 AND state IN ('saving','queued') ORDER BY state='queued', id LIMIT 1").fetchone()
+    if not row: return None
+    job = job_row(row)
+    if job['state'] == 'queued':
+        job['state'], job['started_at'] = 'parsing', time.time()
+    conn.execute("UPDATE jobs SET locked=1, worker_pid=?, locked_by=?, state=?, started_at=? WHERE id=?",
+                 (worker_pid, owner, job['state'], job['started_at'], job['id']))
+    return job
+
+def save_job(conn, job_id, fields, final_name, path, raw_text):
+    # Hóa đơn + trạng thái saved cùng 1 giao dịch; trùng hóa đơn -> sqlite3.IntegrityError (uq_invoices_dedup)
+    inv_id = insert_invoice(conn, final_name=final_name, path=path, raw_text=raw_text, **fields)
+    conn.execute("UPDATE jobs SET state='saved', locked=0, invoice_id=?, done_at=? WHERE id=?", (inv_id, time.time(), job_id))
+    return inv_id
+
+def release_jobs(conn, owners, pids=()):
+    # Job bị cắt ngang do hàng đợi giữ nó đã dừng (tiến trình tắt/chết): đang phân tích thì xếp hàng lại, đang lưu thì lưu lại
+    # (hóa đơn và trạng thái saved ghi cùng 1 giao dịch nên không bị lưu 2 lần)
+    # owners = locked_by; pids = job khóa từ trước khi có locked_by (pid 0 = trước cả worker_pid)
+    dead = '''(locked_by IN (SELECT value FROM json_each(?))
+               OR (locked_by IS NULL AND COALESCE(worker_pid, 0) IN (SELECT value FROM json_each(?))))'''
+    args = (json.dumps(list(owners)), json.dumps(list(pids)))
+    conn.execute(f"UPDATE jobs SET state='queued', started_at=NULL WHERE state='parsing' AND locked=1 AND {dead}", args)
+    return conn.execute(f"UPDATE jobs SET locked=0, worker_pid=NULL, locked_by=NULL WHERE locked=1 AND {dead}", args).rowcount
+
+class JobQueue:
+    def __init__(self, db, store, spool_dir, pool=None, workers=2, metrics=None, cache_max_bytes=200 * 1024 * 1024, poll=1.0):
+        self.db = db
+        self.store = store
+        self.spool_dir = spool_dir
+        self.pool = pool
+        self.workers = workers
+        self.metrics = metrics
+        self.cache_max_bytes = cache_max_bytes
+        self.poll = poll
+        self.wake = threading.Event()
+        self.last_cleanup = 0
+        self.cleanup_lock = threading.Lock()
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        os.makedirs(spool_dir, exist_ok=True)
+
+    # --- PHÍA GIAO DIỆN: chỉ vài lệnh SQL ngắn, không chờ phân tích ---
+    def enqueue(self, files, session=None, user=None):
+        # files = [(tên file, bytes hoặc đường dẫn file upload đã spool, là ảnh?, sha256)], trả về id job theo đúng thứ tự
+        spooled = [(name, digest, is_image, self._spool(data) if isinstance(data, bytes) else self._spool_file(data)) for name, data, is_image, digest in files]
+        now = time.time()
+        ids = [row_id for row_id, _ in self.db.write(run_statements, [
+            ("INSERT INTO jobs (state, session, user, file_name, file_hash, is_image, spool_path, created_at) VALUES ('queued',?,?,?,?,?,?,?)",
+             (session, user, name, digest, int(is_image), path, now)) for name, digest, is_image, path in spooled])]
+        self.wake.set()
+        return ids
+
+    def request_save(self, fields_by_id):
+        # {job_id: tham số insert_invoice}; chỉ nhận job đang ready, trả về các id đã nhận
+        res = self.db.write(run_statements, [("UPDATE jobs SET state='saving', fields_json=?, save_at=? WHERE id=? AND state='ready'",
+                                              (json.dumps(fields, ensure_ascii=False), time.time(), job_id)) for job_id, fields in fields_by_id.items()])
+        self.wake.set()
+        return [job_id for job_id, (_, n) in zip(fields_by_id, res) if n]
+
+    def discard(self, ids):
+        # Bỏ job chưa lưu (đang chờ hoặc đã phân tích xong); job đang chạy dở thì để worker làm nốt
+        if not ids: return
+        marks = ",".join("?" * len(ids))
+        with self.db.connection() as conn:
+            rows = [dict(r) for r in conn.execute(f"SELECT * FROM jobs WHERE id IN ({marks}) AND locked=0 AND state IN ('queued','ready')", list(ids))]
+        # Điều kiện lặp lại trong UPDATE: worker có thể vừa nhận job sau lúc đọc
+        res = self.db.write(run_statements, [("UPDATE jobs SET state='failed', error='Đã bỏ', done_at=? WHERE id=? AND locked=0 AND state IN ('queued','ready')",
+                                              (time.time(), r['id'])) for r in rows])
+        for r, (_, n) in zip(rows, res):
+            if n: self._drop_spool(r)
+
+    def adopt(self, ids, session):
+        # Chuyển job sang phiên hiện tại (mở lại kết quả của phiên trước)
+        self.db.write(run_statements, [("UPDATE jobs SET session=? WHERE id=?", [(session, i) for i in ids], True)])
+
+    def get(self, ids):
+        # {id: job}, job đang chờ có thêm 'ahead' = số job xếp trước trong hàng đợi
+        if not ids: return {}
+        marks = ",".join("?" * len(ids))
+        with self.db.connection() as conn:
+            rows = conn.execute(f"""SELECT j.*, CASE WHEN j.state = 'queued' THEN (SELECT COUNT(*) FROM jobs q WHERE q.state = 'queued' AND q.id < j.id) END AS ahead
+                                    FROM jobs j WHERE j.id IN ({marks})""", list(ids)).fetchall()
+        return {r['id']: job_row(r) for r in rows}
+
+    def unsaved(self, user, session):
+        # Job đã phân tích xong của user ở phiên khác (vd. trước khi app khởi động lại) mà chưa lưu
+        with self.db.connection() as conn:
+            return [r[0] for r in conn.execute("SELECT id FROM jobs WHERE user=? AND state='ready' AND COALESCE(session, '') != ? ORDER BY id", (user, session))]
+
+    def stats(self, recent=200):
+        # Độ sâu hàng đợi + thời gian (giây) của các job gần nhất: chờ phân tích, phân tích, chờ lưu xong
+        with self.db.connection() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            oldest = conn.execute("SELECT MIN(created_at) FROM jobs WHERE state='queued'").fetchone()[0]
+            rows = conn.execute("SELECT created_at, started_at, ready_at, save_at, done_at FROM jobs WHERE started_at IS NOT NULL ORDER BY id DESC LIMIT ?", (recent,)).fetchall()
+        steps = {"Chờ phân tích": [r[1] - r[0] for r in rows],
+                 "Phân tích": [r[2] - r[1] for r in rows if r[2]],
+                 "Chờ lưu": [r[4] - r[3] for r in rows if r[3] and r[4]]}
+        timings = [{"step": k, "n": len(v), "p50": percentile(v, 50), "p95": percentile(v, 95), "max": max(v) if v else None} for k, v in steps.items()]
+        return {"counts": counts, "depth": sum(counts.get(s, 0) for s in JOB_ACTIVE),
+                "oldest_wait": time.time() - oldest if oldest else 0, "timings": timings}
+
+    # --- WORKER ---
+    def start(self):
+        LIVE_OWNERS.add(self.owner)
+        self.recover()
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True).start()
+        return self
+
+    def recover(self):
+        # Gỡ khóa job của hàng đợi đã dừng: tiến trình khác đã chết, hoặc cùng pid mà không phải hàng đợi đang chạy trong
+        # tiến trình này (lần chạy trước có cùng pid). Hàng đợi cũ còn chạy sau khi xóa cache giữ nguyên job của nó
+        with self.db.connection() as conn:
+            held = conn.execute("SELECT DISTINCT worker_pid, locked_by FROM jobs WHERE locked=1").fetchall()
+        dead = [(pid or 0, owner) for pid, owner in held
+                if not pid or (owner not in LIVE_OWNERS if pid == os.getpid() else not pid_alive(pid))]
+        if dead: self.db.write(release_jobs, [o for _, o in dead if o], [p for p, o in dead if not o])
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is None:
+                    self._maybe_cleanup()
+                    self.wake.wait(self.poll); self.wake.clear()
+                    continue
+            except Exception:
+                # DB bận/lỗi tạm thời: thử lại ở vòng sau
+                time.sleep(self.poll); continue
+            try:
+                if job['state'] == 'parsing': self._parse(job)
+                else: self._save(job)
+            except Exception as e:
+                try: self._fail(job, f"Lỗi xử lý: {str(e)}")
+                except Exception: pass
+
+    def _claim(self):
+        # Đọc trước (không cần khóa ghi): hàng đợi rỗng thì các worker đang rảnh không chiếm lượt của writer
+        with self.db.connection() as conn:
+            if not conn.execute("SELECT 1 FROM jobs WHERE locked=0 AND state IN ('saving','queued') LIMIT 1").fetchone(): return None
+        return self.db.write(claim_job, os.getpid(), self.owner)
+
+    def _parse(self, job):
+        t0 = time.perf_counter()
+        if self.metrics and job['started_at']: self.metrics.record("job", "wait", (job['started_at'] - job['created_at']) * 1000)
+        cached = self.db.write(cache_lookup, job['file_hash'], ENGINE_VERSION)
+        if cached: info, msg, pdf_bytes = cached
+        else:
+            # pdfplumber tốn CPU: chạy trên pool process (tự đọc file spool), luồng worker chỉ chờ kết quả
+            args = (job['file_name'], job['spool_path'], bool(job['is_image']))
+            _, info, msg, pdf_bytes = self.pool.run(extract_from_path, *args) if self.pool else extract_from_path(*args)
+            if info is not None: self.db.write(cache_store, job['file_hash'], ENGINE_VERSION, info, msg, pdf_bytes, self.cache_max_bytes)
+        if info is None: return self._fail(job, msg or "Không phân tích được file")
+        # Ảnh: giữ luôn bản PDF đã convert để lúc lưu không phải convert lại
+        pdf_path = self._spool(pdf_bytes) if job['is_image'] else job['spool_path']
+        self.db.write(run_statements, [("UPDATE jobs SET state='ready', locked=0, result_json=?, msg=?, pdf_path=?, ready_at=? WHERE id=?",
+                                        (json.dumps(info, ensure_ascii=False), msg, pdf_path, time.time(), job['id']))])
+        if self.metrics: self.metrics.record("job", "parse", (time.perf_counter() - t0) * 1000)
+
+    def _save(self, job):
+        t0 = time.perf_counter()
+        f = job['fields']
+        key = dedup_key(f['sym'], f['num'], f['seller'])
+        with self.db.connection() as conn:
+            dup = find_duplicates(conn, [key]).get(key)
+        if dup: return self._fail(job, f"Trùng hóa đơn #{dup[0]} đã lưu")
+        path = self.store.put_file(job['pdf_path'], digest=None if job['is_image'] else job['file_hash'])
+        final_name = re.sub(r'[\\/*?:"<>|]', "", job['file_name'])
+        if job['is_image']: final_name = os.path.splitext(final_name)[0] + ".pdf"
+        result = job['result'] or {}
+        try:
+            inv_id = self.db.write(save_job, job['id'], f, final_name, path, result.get('raw_text'))
+        except sqlite3.IntegrityError:
+            # Người khác vừa lưu đúng hóa đơn này (uq_invoices_dedup)
+            return self._fail(job, "Trùng hóa đơn vừa được lưu")
+        self._drop_spool(job)
+        if self.metrics: self.metrics.record("job", "save", (time.perf_counter() - t0) * 1000)
+        # Hóa đơn đã lưu xong mới tạo ảnh thu nhỏ (render PDF trên pool process); lỗi thì để backfill làm lại
+        t0 = time.perf_counter()
+        try:
+            if self.pool: self.pool.run(safe_make_thumbs, path)
+            else: safe_make_thumbs(path)
+        except Exception:
+            pass
+        if self.metrics: self.metrics.record("job", "thumbs", (time.perf_counter() - t0) * 1000)
+        # Bảng kê dài: lúc phân tích bỏ qua các trang giữa, đọc đủ text cho chỉ mục tìm kiếm sau khi đã lưu
+        # (lỗi thì chỉ mục giữ text các trang đã đọc)
+        if not result.get('text_complete', True):
+            t0 = time.perf_counter()
+            try:
+                text = self.pool.run(extract_text, path) if self.pool else extract_text(path)
+                self.db.write(set_invoice_text, inv_id, text)
+            except Exception:
+                pass
+            if self.metrics: self.metrics.record("job", "index_text", (time.perf_counter() - t0) * 1000)
+
+    def _fail(self, job, error):
+        # Job đã 'saved' thì hóa đơn đã nằm trong DB: không bao giờ đổi ngược thành 'failed'
+        self.db.write(run_statements, [("UPDATE jobs SET state='failed', locked=0, error=?, done_at=? WHERE id=? AND state != 'saved'", (error, time.time(), job['id']))])
+        self._drop_spool(job)
+
+    # --- FILE TẠM (spool) ---
+    def _spool(self, data):
+        # Ghi ra file tạm rồi fsync: job đã vào DB thì file chắc chắn nằm trên đĩa
+        fd, path = tempfile.mkstemp(dir=self.spool_dir, suffix=".bin")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return path
+
+    def _spool_file(self, src):
+        # File upload đã nằm trên đĩa (uploads.py): hard link sang thư mục job, không chép lại nội dung;
+        # 2 bên xóa tên của mình độc lập. Khác ổ đĩa thì mới chép
+        path = os.path.join(self.spool_dir, f"{os.path.basename(src)}.{time.time_ns()}.bin")
+        try: os.link(src, path)
+        except OSError: shutil.copyfile(src, path)
+        return path
+
+    def _drop_spool(self, job):
+        for p in {job['spool_path'], job['pdf_path']}:
+            if p and os.path.exists(p): os.remove(p)
+
+    def _maybe_cleanup(self):
+        if time.time() - self.last_cleanup < CLEANUP_EVERY or not self.cleanup_lock.acquire(blocking=False): return
+        try:
+            self.last_cleanup = time.time()
+            self.cleanup()
+        finally:
+            self.cleanup_lock.release()
+
+    def cleanup(self):
+        # Hết hạn job không ai lưu, xóa dòng cũ, gỡ khóa job của tiến trình đã chết,
+        # dọn file tạm không còn job nào dùng (kể cả file ghi dở khi app tắt)
+        now = time.time()
+        self.db.write(run_statements, [
+            ("UPDATE jobs SET state='failed', error='Hết hạn (không được lưu)', done_at=? WHERE state='ready' AND locked=0 AND ready_at < ?", (now, now - READY_TTL)),
+            ("DELETE FROM jobs WHERE state IN ('saved','failed') AND done_at < ?", (now - KEEP_DONE,))])
+        self.recover()
+        with self.db.connection() as conn:
+            live = {os.path.normpath(p) for row in conn.execute("SELECT spool_path, pdf_path FROM jobs WHERE state NOT IN ('saved','failed')") for p in row if p}
+        cutoff = now - CLEANUP_EVERY
+        for name in os.listdir(self.spool_dir):
+            p = os.path.join(self.spool_dir, name)
+            try:
+                if os.path.normpath(p) not in live and os.path.getmtime(p) < cutoff: os.remove(p)
+            except FileNotFoundError: continue
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from db import open_database, insert_invoice
+from metrics import percentile
+from writer import WriterClient, authkey_path
+
+# ==========================================
+# LOAD TEST GHI ĐỒNG THỜI: N tiến trình app x M session cùng lưu hóa đơn, gán dự án, sửa gợi nhớ
+# python loadtest.py [--processes 4] [--sessions 8] [--saves 50] [--direct] [--keep]
+# Mặc định chạy kèm writer.py (như triển khai nhiều tiến trình); --direct: mỗi tiến trình tự ghi thẳng vào DB để so sánh
+# Kiểm tra cuối: mọi lệnh ghi được báo thành công đều có trong DB và đúng giá trị, không có dòng nào không ai biết,
+# hóa đơn lưu lại lần 2 bị từ chối (IntegrityError truyền đúng về app), bảng tổng hợp dự án khớp với liên kết
+# ==========================================
+
+PROJECTS = 5
+LT_SYMBOL = "LT"
+
+def run_session(db, proc, sess, saves, out):
+    # 1 session: lưu hóa đơn -> gán dự án -> thỉnh thoảng sửa gợi nhớ, như người dùng bấm lưu liên tục
+    acked, errors, lat = {}, [], []
+    for i in range(saves):
+        # Số HĐ chỉ gồm chữ số (dedup_key bỏ ký tự khác số), duy nhất theo tiến trình/session/lần lưu
+        num = f"{proc + 1:03d}{sess:04d}{i:06d}"
+        t0 = time.perf_counter()
+        try:
+            inv_id = db.write(insert_invoice, "OUT" if i % 3 else "IN", f"{i % 28 + 1:02d}/{i % 12 + 1:02d}/2024", num, LT_SYMBOL, f"Bên bán {sess % 4}",
+                              "Bên mua", 1000.0 * (i + 1), 100.0 * (i + 1), 1100.0 * (i + 1), f"{num}.pdf", 0, f"memo {num}", None)
+            acked[inv_id] = {"num": num, "project": None, "memo": f"memo {num}"}
+            lat.append((time.perf_counter() - t0) * 1000)
+            project = (proc + sess + i) % PROJECTS + 1
+            t0 = time.perf_counter()
+            db.execute("INSERT INTO project_links (project_id, invoice_id) VALUES (?,?)", (project, inv_id), commit=True)
+            acked[inv_id]["project"] = project
+            lat.append((time.perf_counter() - t0) * 1000)
+            if i % 10 == 9:
+                t0 = time.perf_counter()
+                db.execute("UPDATE invoices SET memo=? WHERE id=?", (f"sửa {num}", inv_id), commit=True)
+                acked[inv_id]["memo"] = f"sửa {num}"
+                lat.append((time.perf_counter() - t0) * 1000)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+    # Lưu lại hóa đơn đầu tiên: phải bị từ chối bởi uq_invoices_dedup
+    rejected = False
+    try:
+        db.write(insert_invoice, "IN", "01/01/2024", f"{proc + 1:03d}{sess:04d}{0:06d}", LT_SYMBOL, f"Bên bán {sess % 4}", "Bên mua", 1.0, 0.0, 1.0, "dup.pdf", 0, "dup", None)
+    except sqlite3.IntegrityError:
+        rejected = True
+    except Exception as e:
+        errors.append(f"{type(e).__name__}: {e}")
+    out.append((acked, errors, lat, rejected))
+
+def run_replica(db_path, socket, proc, sessions, saves):
+    # 1 tiến trình app: pool kết nối + (nếu có) writer client dùng chung cho các session (luồng)
+    db = open_database(db_path, writer=WriterClient(socket) if socket else None)
+    out = []
+    threads = [threading.Thread(target=run_session, args=(db, proc, s, saves, out)) for s in range(sessions)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    db.close()
+    return out
+
+def start_writer(db_path, socket):
+    proc = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "writer.py"), "--db", db_path, "--socket", socket],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    deadline = time.time() + 30
+    while not (os.path.exists(socket) and os.path.exists(authkey_path(socket))):
+        if proc.poll() is not None or time.time() > deadline: raise SystemExit(f"Writer không khởi động được:\n{proc.stdout.read()}")
+        time.sleep(0.1)
+    return proc
+
+def verify(db_path, results):
+    acked, errors, lat, rejected = {}, [], [], 0
+    for acked_s, errors_s, lat_s, rejected_s in results:
+        acked.update(acked_s); errors += errors_s; lat += lat_s; rejected += rejected_s
+    conn = sqlite3.connect(db_path)
+    rows = {r[0]: r[1:] for r in conn.execute("SELECT i.id, i.invoice_number, i.memo, l.project_id FROM invoices i LEFT JOIN project_links l ON l.invoice_id = i.id WHERE i.invoice_symbol = ?", (LT_SYMBOL,))}
+    summary_cnt = conn.execute("SELECT COALESCE(SUM(cnt), 0) FROM project_month_summary").fetchone()[0]
+    links = conn.execute("SELECT COUNT(*) FROM project_links l JOIN invoices i ON i.id = l.invoice_id WHERE i.status = 'active'").fetchone()[0]
+    conn.close()
+    lost = [i for i, a in acked.items() if i not in rows or rows[i][0] != a["num"]]
+    wrong = [i for i, a in acked.items() if i in rows and (rows[i][1] != a["memo"] or (a["project"] and rows[i][2] != a["project"]))]
+    unknown = [i for i in rows if i not in acked]
+    return {"acked": len(acked), "rows": len(rows), "lost": lost, "wrong": wrong, "unknown": unknown, "errors": errors,
+            "rejected": rejected, "latency": lat, "summary_ok": summary_cnt == links}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test ghi đồng thời nhiều tiến trình vào 1 DB SQLite (qua writer.py hoặc ghi thẳng)")
+    parser.add_argument("--processes", type=int, default=4, help="Số tiến trình app")
+    parser.add_argument("--sessions", type=int, default=8, help="Số session (luồng) mỗi tiến trình")
+    parser.add_argument("--saves", type=int, default=50, help="Số hóa đơn mỗi session lưu")
+    parser.add_argument("--direct", action="store_true", help="Không dùng writer, mỗi tiến trình tự ghi")
+    parser.add_argument("--keep", action="store_true", help="Giữ lại thư mục DB tạm để xem")
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix="inv-loadtest-")
+    db_path, socket = os.path.join(work, "loadtest.db"), None if args.direct else os.path.join(work, "writer.sock")
+    db = open_database(db_path)
+    db.execute("INSERT INTO projects (project_name, created_at) SELECT 'Dự án ' || value, '2024-01-01' FROM json_each(?)",
+               (str(list(range(1, PROJECTS + 1))),), commit=True)
+    db.close()
+    writer = start_writer(db_path, socket) if socket else None
+    total = args.processes * args.sessions
+    print(f"{args.processes} tiến trình x {args.sessions} session x {args.saves} hóa đơn, {'ghi thẳng' if args.direct else 'qua writer'}: {db_path}")
+    started = time.time()
+    results, writer_log = [], ""
+    try:
+        with ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for out in pool.map(run_replica, [db_path] * args.processes, [socket] * args.processes, range(args.processes),
+                                [args.sessions] * args.processes, [args.saves] * args.processes):
+                results += out
+        elapsed = time.time() - started
+        wstats = WriterClient(socket).stats() if socket else None
+    finally:
+        if writer:
+            writer.send_signal(signal.SIGTERM)
+            writer_log = writer.communicate(timeout=30)[0]
+    r = verify(db_path, results)
+    lat = r["latency"]
+    print(f"Xong trong {elapsed:.1f}s: {len(lat)} lệnh ghi thành công ({len(lat) / elapsed:.0f}/s), "
+          f"độ trễ p50 {percentile(lat, 50):.1f} ms, p95 {percentile(lat, 95):.1f} ms, p99 {percentile(lat, 99):.1f} ms")
+    if writer_log.strip(): print(writer_log.strip().splitlines()[-1])
+    if wstats: print(f"Writer: {wstats['writes']} lệnh / {wstats['batches']} giao dịch (trung bình {wstats['writes'] / max(wstats['batches'], 1):.1f}, tối đa {wstats['max_batch']})")
+    print(f"Hóa đơn báo lưu thành công {r['acked']}, có trong DB {r['rows']} | mất {len(r['lost'])} | sai giá trị {len(r['wrong'])} | "
+          f"không ai biết {len(r['unknown'])} | lỗi {len(r['errors'])} | trùng bị từ chối {r['rejected']}/{total} | tổng hợp dự án {'khớp' if r['summary_ok'] else 'LỆCH'}")
+    errs = {}
+    for e in r["errors"]: errs[e] = errs.get(e, 0) + 1
+    for e, n in sorted(errs.items(), key=lambda x: -x[1])[:10]: print(f"  {n:>5}  {e}")
+    if not args.keep: shutil.rmtree(work, ignore_errors=True)
+    ok = not (r["lost"] or r["wrong"] or r["unknown"] or r["errors"]) and r["rejected"] == total and r["summary_ok"]
+    print("OK: không mất lệnh ghi nào" if ok else "THẤT BẠI")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,124 @@
+import re
+import time
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+
+# ==========================================
+# ĐO HIỆU NĂNG MỖI LẦN RERUN
+# Mỗi sự kiện = (thời điểm, loại, tên, ms, session); giữ trong ring buffer cố định,
+# tùy chọn ghi thêm vào bảng perf_metrics để xem lại sau khi khởi động lại app
+# Loại: sql (tên = câu SQL đã chuẩn hóa), preview, app, rerun, fragment,
+# job (wait/parse/save/thumbs/index_text - phân tích/convert chạy trên pool, tính trong job parse)
+# ==========================================
+
+METRICS_DDL = [
+    '''CREATE TABLE IF NOT EXISTS perf_metrics (ts REAL, kind TEXT, name TEXT, ms REAL, session TEXT)''',
+    '''CREATE INDEX IF NOT EXISTS idx_perf_metrics_ts ON perf_metrics(ts)''',
+]
+
+def ensure_metrics_table(conn):
+    for ddl in METRICS_DDL:
+        conn.execute(ddl)
+
+def store_metrics(conn, rows, keep_days=14):
+    conn.executemany("INSERT INTO perf_metrics (ts, kind, name, ms, session) VALUES (?,?,?,?,?)", rows)
+    conn.execute("DELETE FROM perf_metrics WHERE ts < ?", (time.time() - keep_days * 86400,))
+
+@lru_cache(maxsize=1024)
+def normalize_sql(query):
+    # Gom các câu giống nhau: bỏ khoảng trắng thừa, literal -> ?, danh sách IN (?,?,?) -> (?...)
+    q = re.sub(r"\s+", " ", query).strip()
+    q = re.sub(r"'(?:[^']|'')*'", "?", q)
+    q = re.sub(r"\b\d+(?:\.\d+)?\b", "?", q)
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?...)", q)
+
+def percentile(values, p):
+    if not values: return None
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+# Số session giữ bộ đếm rerun (session cũ nhất bị bỏ trước), như ring buffer sự kiện
+MAX_SESSIONS = 1000
+
+class Metrics:
+    def __init__(self, capacity=20000, max_sessions=MAX_SESSIONS):
+        self.events = deque(maxlen=capacity)
+        self.pending = []
+        self.persist = False
+        # Số lần bắt đầu rerun theo session (kể cả lần bị st.rerun()/st.stop() cắt ngang)
+        self.rerun_starts = OrderedDict()
+        self.max_sessions = max_sessions
+        # Số truy vấn của mỗi lần chạy, theo phạm vi ("app" = cả trang, còn lại = tên fragment)
+        self.run_queries = {}
+        self.lock = threading.Lock()
+
+    def start_rerun(self, session):
+        with self.lock:
+            self.rerun_starts[session] = self.rerun_starts.get(session, 0) + 1
+            self.rerun_starts.move_to_end(session)
+            if len(self.rerun_starts) > self.max_sessions: self.rerun_starts.popitem(last=False)
+
+    def record(self, kind, name, ms, session=None):
+        ev = (time.time(), kind, normalize_sql(name) if kind == "sql" else name, ms, session)
+        with self.lock:
+            self.events.append(ev)
+            if self.persist: self.pending.append(ev)
+
+    def record_queries(self, scope, n):
+        with self.lock:
+            self.run_queries.setdefault(scope, deque(maxlen=1000)).append(n)
+
+    def queries_per_run(self):
+        with self.lock:
+            return [{"scope": k, "runs": len(v), "avg": sum(v) / len(v), "max": max(v)} for k, v in self.run_queries.items() if v]
+
+    @contextmanager
+    def timer(self, kind, name, session=None):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, (time.perf_counter() - t0) * 1000, session)
+
+    def drain(self):
+        # Sự kiện chưa ghi xuống DB (chỉ có khi bật persist)
+        with self.lock:
+            out, self.pending = self.pending, []
+        return out
+
+    def flush(self, db, keep_days=14):
+        rows = self.drain()
+        if rows: db.write(store_metrics, rows, keep_days)
+        return len(rows)
+
+    def snapshot(self, kind=None):
+        with self.lock:
+            return [e for e in self.events if kind is None or e[1] == kind]
+
+    def clear(self):
+        with self.lock:
+            self.events.clear(); self.pending = []; self.rerun_starts = OrderedDict(); self.run_queries = {}
+
+    def summary(self, by="kind", kind=None):
+        # Gom theo loại (by="kind") hoặc theo tên trong 1 loại (by="name"): số lần, p50/p95/p99, max, tổng ms
+        groups = {}
+        for e in self.snapshot(kind):
+            groups.setdefault(e[1] if by == "kind" else e[2], []).append(e[3])
+        return [{"name": k, "n": len(v), "p50": percentile(v, 50), "p95": percentile(v, 95), "p99": percentile(v, 99),
+                 "max": max(v), "total": sum(v)} for k, v in groups.items()]
+
+    def slowest(self, kind="sql", n=10):
+        return sorted(self.summary(by="name", kind=kind), key=lambda r: -r["p95"])[:n]
+
+    def reruns_by_session(self):
+        # Thời gian chỉ tính các lần rerun chạy hết script
+        groups = {}
+        for e in self.snapshot("rerun"):
+            groups.setdefault(e[4], []).append(e)
+        with self.lock: starts = dict(self.rerun_starts)
+        return [{"session": s, "user": groups[s][-1][2] if s in groups else "", "reruns": n, "completed": len(groups.get(s, [])),
+                 "p50": percentile([e[3] for e in groups.get(s, [])], 50)} for s, n in starts.items()]
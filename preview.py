@@ -0,0 +1,89 @@
+import io
+import threading
+from collections import OrderedDict
+import pdfplumber
+from PIL import Image, ImageOps
+
+# ==========================================
+# XEM TRƯỚC PDF: render từng trang theo yêu cầu, cache LRU giới hạn dung lượng
+# Khóa cache = (hash file, số trang, DPI); file nguồn là bytes hoặc đường dẫn file spool trên đĩa
+# ==========================================
+
+PREVIEW_MIN_DPI = 72
+PREVIEW_MAX_DPI = 200
+
+def pdf_source(src):
+    return io.BytesIO(src) if isinstance(src, bytes) else src
+
+def fit_dpi(page_width_pt, target_px):
+    # 1 point = 1/72 inch -> DPI để trang vừa khít chiều ngang hiển thị
+    dpi = int(target_px * 72 / page_width_pt) if page_width_pt else PREVIEW_MIN_DPI
+    return max(PREVIEW_MIN_DPI, min(PREVIEW_MAX_DPI, dpi))
+
+class PreviewCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.page_info = {}
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        return None
+
+    def _put(self, key, img_bytes):
+        with self.lock:
+            if key in self.items: return
+            self.items[key] = img_bytes
+            self.size += len(img_bytes)
+            # Bỏ các trang xem lâu nhất khi vượt giới hạn (luôn giữ trang vừa render)
+            while self.size > self.max_bytes and len(self.items) > 1:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old)
+
+    def page_sizes(self, file_hash, pdf_src):
+        # Chỉ đọc kích thước các trang, không render
+        if file_hash not in self.page_info:
+            with pdfplumber.open(pdf_source(pdf_src)) as pdf:
+                sizes = [(float(p.width), float(p.height)) for p in pdf.pages]
+            with self.lock:
+                self.page_info[file_hash] = sizes
+                if len(self.page_info) > 256: self.page_info.pop(next(iter(self.page_info)))
+        return self.page_info[file_hash]
+
+    def render_page(self, file_hash, pdf_src, page_no, target_px=1000):
+        width = self.page_sizes(file_hash, pdf_src)[page_no][0]
+        dpi = fit_dpi(width, target_px)
+        key = (file_hash, page_no, dpi)
+        cached = self._get(key)
+        if cached is not None: return cached
+        with pdfplumber.open(pdf_source(pdf_src), pages=[page_no + 1]) as pdf:
+            img = pdf.pages[0].to_image(resolution=dpi).original
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, format="JPEG", quality=85, optimize=True)
+        img_bytes = buf.getvalue()
+        self._put(key, img_bytes)
+        return img_bytes
+
+    def render_image(self, file_hash, image_src, target_px=1000):
+        # Ảnh chụp/scan: thu nhỏ về khung hiển thị (JPEG giải nén thẳng ở tỉ lệ nhỏ), không gửi ảnh gốc lên trình duyệt
+        key = (file_hash, "img", target_px)
+        cached = self._get(key)
+        if cached is not None: return cached
+        with Image.open(image_src) as img:
+            img.draft('RGB', (target_px, target_px))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((target_px, target_px * 2), Image.LANCZOS)
+            buf = io.BytesIO()
+            img.convert('RGB').save(buf, format="JPEG", quality=85, optimize=True)
+        img_bytes = buf.getvalue()
+        self._put(key, img_bytes)
+        return img_bytes
+
+    def stats(self):
+        with self.lock:
+            return {"pages": len(self.items), "bytes": self.size, "max_bytes": self.max_bytes}
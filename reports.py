@@ -0,0 +1,158 @@
+import sys
+import sqlite3
+import pandas as pd
+
+# ==========================================
+# BẢNG TỔNG HỢP LÃI/LỖ THEO DỰ ÁN - THÁNG
+# project_month_summary được trigger cập nhật mỗi khi hóa đơn/liên kết thay đổi,
+# báo cáo chỉ đọc bảng này thay vì JOIN toàn bộ hóa đơn
+# year_month = '' nếu ngày hóa đơn không đúng định dạng
+# ==========================================
+
+SUMMARY_DDL = [
+    '''CREATE TABLE IF NOT EXISTS project_month_summary (
+        project_id INTEGER NOT NULL, year_month TEXT NOT NULL, type TEXT NOT NULL,
+        total REAL NOT NULL DEFAULT 0, cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (project_id, year_month, type)
+    ) WITHOUT ROWID''',
+
+    # Thêm liên kết: cộng hóa đơn (nếu còn hiệu lực) vào dự án
+    '''CREATE TRIGGER IF NOT EXISTS trg_pms_link_ins AFTER INSERT ON project_links BEGIN
+        INSERT INTO project_month_summary (project_id, year_month, type, total, cnt)
+        SELECT NEW.project_id, COALESCE(i.year_month, ''), COALESCE(i.type, ''), COALESCE(i.total_amount, 0), 1
+        FROM invoices i WHERE i.id = NEW.invoice_id AND i.status = 'active'
+        ON CONFLICT(project_id, year_month, type) DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+    END''',
+
+    # Bỏ liên kết: trừ hóa đơn khỏi dự án
+    '''CREATE TRIGGER IF NOT EXISTS trg_pms_link_del AFTER DELETE ON project_links BEGIN
+        UPDATE project_month_summary
+        SET total = total - (SELECT COALESCE(total_amount, 0) FROM invoices WHERE id = OLD.invoice_id), cnt = cnt - 1
+        WHERE project_id = OLD.project_id
+          AND (year_month, type) = (SELECT COALESCE(year_month, ''), COALESCE(type, '') FROM invoices WHERE id = OLD.invoice_id AND status = 'active');
+        DELETE FROM project_month_summary WHERE project_id = OLD.project_id AND cnt <= 0;
+    END''',
+
+    # Chuyển liên kết sang dự án/hóa đơn khác
+    '''CREATE TRIGGER IF NOT EXISTS trg_pms_link_upd AFTER UPDATE OF project_id, invoice_id ON project_links BEGIN
+        UPDATE project_month_summary
+        SET total = total - (SELECT COALESCE(total_amount, 0) FROM invoices WHERE id = OLD.invoice_id), cnt = cnt - 1
+        WHERE project_id = OLD.project_id
+          AND (year_month, type) = (SELECT COALESCE(year_month, ''), COALESCE(type, '') FROM invoices WHERE id = OLD.invoice_id AND status = 'active');
+        DELETE FROM project_month_summary WHERE project_id = OLD.project_id AND cnt <= 0;
+        INSERT INTO project_month_summary (project_id, year_month, type, total, cnt)
+        SELECT NEW.project_id, COALESCE(i.year_month, ''), COALESCE(i.type, ''), COALESCE(i.total_amount, 0), 1
+        FROM invoices i WHERE i.id = NEW.invoice_id AND i.status = 'active'
+        ON CONFLICT(project_id, year_month, type) DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+    END''',
+
+    # Sửa/hủy hóa đơn: trừ giá trị cũ, cộng giá trị mới cho mọi dự án đang chứa nó
+    '''CREATE TRIGGER IF NOT EXISTS trg_pms_inv_upd AFTER UPDATE OF status, type, year_month, total_amount ON invoices BEGIN
+        UPDATE project_month_summary SET total = total - COALESCE(OLD.total_amount, 0), cnt = cnt - 1
+        WHERE OLD.status = 'active' AND year_month = COALESCE(OLD.year_month, '') AND type = COALESCE(OLD.type, '')
+          AND project_id IN (SELECT project_id FROM project_links WHERE invoice_id = OLD.id);
+        INSERT INTO project_month_summary (project_id, year_month, type, total, cnt)
+        SELECT l.project_id, COALESCE(NEW.year_month, ''), COALESCE(NEW.type, ''), COALESCE(NEW.total_amount, 0), 1
+        FROM project_links l WHERE l.invoice_id = NEW.id AND NEW.status = 'active'
+        ON CONFLICT(project_id, year_month, type) DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+        DELETE FROM project_month_summary WHERE cnt <= 0 AND project_id IN (SELECT project_id FROM project_links WHERE invoice_id = OLD.id);
+    END''',
+
+    # Xóa hẳn hóa đơn
+    '''CREATE TRIGGER IF NOT EXISTS trg_pms_inv_del AFTER DELETE ON invoices BEGIN
+        UPDATE project_month_summary SET total = total - COALESCE(OLD.total_amount, 0), cnt = cnt - 1
+        WHERE OLD.status = 'active' AND year_month = COALESCE(OLD.year_month, '') AND type = COALESCE(OLD.type, '')
+          AND project_id IN (SELECT project_id FROM project_links WHERE invoice_id = OLD.id);
+        DELETE FROM project_month_summary WHERE cnt <= 0 AND project_id IN (SELECT project_id FROM project_links WHERE invoice_id = OLD.id);
+    END''',
+]
+
+def ensure_project_summary(conn):
+    # Trả True nếu bảng vừa được tạo (cần rebuild từ dữ liệu cũ)
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='project_month_summary'").fetchone()
+    for ddl in SUMMARY_DDL:
+        conn.execute(ddl)
+    return not existed
+
+# ==========================================
+# VERSION DỮ LIỆU BÁO CÁO
+# Trigger tăng data_versions['report'] mỗi khi số liệu báo cáo đổi: thêm/hủy/xóa hóa đơn đã gán dự án, lưu/bỏ liên kết
+# (qua trigger của project_month_summary), chuyển lưu trữ, rebuild, đổi tên/xóa dự án
+# App cache ma trận báo cáo theo số version này: xem lại chỉ tốn 1 lần đọc khóa chính cho tới khi dữ liệu đổi
+# ==========================================
+
+REPORT_BUMP = "UPDATE data_versions SET version = version + 1 WHERE name = 'report'"
+
+VERSION_DDL = [
+    '''CREATE TABLE IF NOT EXISTS data_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''',
+    '''INSERT OR IGNORE INTO data_versions (name, version) VALUES ('report', 0)''',
+] + [f"CREATE TRIGGER IF NOT EXISTS trg_ver_{short}_{event[:3].lower()} AFTER {event} ON {table} BEGIN {REPORT_BUMP}; END"
+     for short, table in [("pms", "project_month_summary"), ("ams", "archive_month_summary")] for event in ("INSERT", "UPDATE", "DELETE")] + [
+    f"CREATE TRIGGER IF NOT EXISTS trg_ver_proj_upd AFTER UPDATE OF project_name ON projects BEGIN {REPORT_BUMP}; END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_ver_proj_del AFTER DELETE ON projects BEGIN {REPORT_BUMP}; END",
+]
+
+def ensure_report_version(conn):
+    # Gọi sau khi đã có project_month_summary và archive_month_summary
+    for ddl in VERSION_DDL:
+        conn.execute(ddl)
+
+def report_version(conn):
+    return conn.execute("SELECT version FROM data_versions WHERE name = 'report'").fetchone()[0]
+
+# ==========================================
+# MA TRẬN DỰ ÁN x THÁNG CHO BÁO CÁO TỔNG HỢP
+# 1 truy vấn gộp + 1 lượt pandas cho mọi dự án/tháng: Thu, Chi, Lãi, Lãi lũy kế, Lãi so tháng trước
+# Trục tháng liên tục từ tháng phát sinh đầu tiên đến cuối cùng; tháng dự án không phát sinh = 0
+# ("so tháng trước" luôn so với đúng tháng liền trước, kể cả tháng trống)
+# Hóa đơn không rõ tháng (year_month = '') không nằm trong ma trận, trả riêng để báo cáo cộng vào tổng
+# ==========================================
+
+REPORT_VALUES = ["Thu", "Chi", "Lãi", "Lãi lũy kế", "Lãi so tháng trước"]
+
+def report_rows(conn):
+    return conn.execute('''SELECT p.project_name, s.year_month, s.type, SUM(s.total) FROM project_month_all s
+        JOIN projects p ON p.id = s.project_id GROUP BY p.id, s.year_month, s.type''').fetchall()
+
+def thu_chi(df, index):
+    wide = df.pivot_table(index=index, columns="type", values="total", aggfunc="sum", fill_value=0)
+    wide = wide.reindex(columns=["OUT", "IN"], fill_value=0).set_axis(["Thu", "Chi"], axis=1).astype(float)
+    wide["Lãi"] = wide["Thu"] - wide["Chi"]
+    return wide
+
+def project_month_matrix(rows):
+    # -> (ma trận index (project, month) x REPORT_VALUES, bảng Thu/Chi/Lãi theo dự án của hóa đơn không rõ tháng)
+    df = pd.DataFrame([tuple(r) for r in rows], columns=["project", "month", "type", "total"])
+    dated, undated = df[df["month"] != ""], df[df["month"] == ""]
+    if dated.empty:
+        matrix = pd.DataFrame(columns=REPORT_VALUES, index=pd.MultiIndex.from_tuples([], names=["project", "month"]), dtype=float)
+    else:
+        months = pd.period_range(dated["month"].min(), dated["month"].max(), freq="M").strftime("%Y-%m")
+        grid = pd.MultiIndex.from_product([sorted(dated["project"].unique()), months], names=["project", "month"])
+        matrix = thu_chi(dated, ["project", "month"]).reindex(grid, fill_value=0)
+        by_project = matrix.groupby(level="project", sort=False)["Lãi"]
+        matrix["Lãi lũy kế"] = by_project.cumsum()
+        matrix["Lãi so tháng trước"] = by_project.diff()
+    if undated.empty: return matrix, pd.DataFrame(columns=["Thu", "Chi", "Lãi"], dtype=float)
+    return matrix, thu_chi(undated, "project")
+
+def rebuild_project_summary(conn):
+    conn.execute("DELETE FROM project_month_summary")
+    conn.execute('''INSERT INTO project_month_summary (project_id, year_month, type, total, cnt)
+        SELECT l.project_id, COALESCE(i.year_month, ''), COALESCE(i.type, ''), SUM(COALESCE(i.total_amount, 0)), COUNT(*)
+        FROM project_links l JOIN invoices i ON i.id = l.invoice_id
+        WHERE i.status = 'active'
+        GROUP BY l.project_id, COALESCE(i.year_month, ''), COALESCE(i.type, '')''')
+
+# Chạy tay: python reports.py rebuild [invoice_app.db]
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Cách dùng: python reports.py rebuild [đường dẫn DB]")
+        sys.exit(1)
+    conn = sqlite3.connect(sys.argv[2] if len(sys.argv) > 2 else "invoice_app.db")
+    with conn:
+        ensure_project_summary(conn)
+        rebuild_project_summary(conn)
+    n = conn.execute("SELECT COUNT(*) FROM project_month_summary").fetchone()[0]
+    print(f"Đã tính lại bảng tổng hợp: {n} dòng")
+    conn.close()
@@ -0,0 +1,95 @@
+import os
+import re
+import sys
+import sqlite3
+from extractor import extract_text
+
+# ==========================================
+# TÌM KIẾM TOÀN VĂN HÓA ĐƠN (SQLite FTS5)
+# invoices_fts.rowid = invoices.id; raw_text là text pdfplumber đọc được từ file,
+# các cột còn lại được trigger đồng bộ từ bảng invoices
+# ==========================================
+
+FTS_COLUMNS = ["raw_text", "seller_name", "buyer_name", "memo", "invoice_number", "invoice_symbol"]
+# Trọng số bm25 theo thứ tự cột: số/ký hiệu HĐ và tên các bên quan trọng hơn text thô
+FTS_WEIGHTS = "1.0, 4.0, 4.0, 3.0, 8.0, 8.0"
+
+SEARCH_DDL = [
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS invoices_fts USING fts5(
+        {", ".join(FTS_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2'
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_inv_ins AFTER INSERT ON invoices BEGIN
+        INSERT INTO invoices_fts (rowid, seller_name, buyer_name, memo, invoice_number, invoice_symbol)
+        VALUES (NEW.id, NEW.seller_name, NEW.buyer_name, NEW.memo, NEW.invoice_number, NEW.invoice_symbol);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_inv_upd AFTER UPDATE OF seller_name, buyer_name, memo, invoice_number, invoice_symbol ON invoices BEGIN
+        UPDATE invoices_fts SET seller_name = NEW.seller_name, buyer_name = NEW.buyer_name, memo = NEW.memo,
+            invoice_number = NEW.invoice_number, invoice_symbol = NEW.invoice_symbol
+        WHERE rowid = NEW.id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_inv_del AFTER DELETE ON invoices BEGIN
+        DELETE FROM invoices_fts WHERE rowid = OLD.id;
+    END''',
+]
+
+def ensure_search_index(conn):
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='invoices_fts'").fetchone()
+    for ddl in SEARCH_DDL:
+        conn.execute(ddl)
+    if not existed:
+        # Lần đầu: đưa thông tin các hóa đơn cũ vào chỉ mục (text thô lấy bằng backfill)
+        conn.execute('''INSERT INTO invoices_fts (rowid, seller_name, buyer_name, memo, invoice_number, invoice_symbol)
+                        SELECT id, seller_name, buyer_name, memo, invoice_number, invoice_symbol FROM invoices''')
+    return not existed
+
+def set_invoice_text(conn, invoice_id, raw_text):
+    conn.execute("UPDATE invoices_fts SET raw_text = ? WHERE rowid = ?", (raw_text, invoice_id))
+
+def fts_query(text):
+    # Từ khóa người dùng -> cú pháp FTS5: mỗi từ đặt trong ngoặc kép (tránh lỗi ký tự đặc biệt), khớp tiền tố
+    # remove_diacritics không đổi "đ" thành "d" nên gõ không dấu "don" phải thử thêm "đon"
+    parts = []
+    for t in re.findall(r'[^\s"]+', text or ""):
+        variants = dict.fromkeys([t, t.replace('d', 'đ').replace('D', 'Đ'), t.replace('đ', 'd').replace('Đ', 'D')])
+        ors = " OR ".join(f'"{v}"*' for v in variants)
+        parts.append(f"({ors})" if len(variants) > 1 else ors)
+    return " AND ".join(parts)
+
+def search_invoices(conn, text, limit=50, schema="main"):
+    # schema: tên DB đã ATTACH khi tìm trong file lưu trữ (archive.py)
+    q = fts_query(text)
+    if not q: return []
+    return conn.execute(f'''SELECT i.*, snippet(invoices_fts, 0, '**', '**', '…', 10) AS snippet, bm25(invoices_fts, {FTS_WEIGHTS}) AS rank
+        FROM {schema}.invoices_fts f JOIN {schema}.invoices i ON i.id = f.rowid
+        WHERE invoices_fts MATCH ?
+        ORDER BY rank LIMIT ?''', (q, limit)).fetchall()
+
+def backfill_text(conn, progress=None):
+    # Đọc lại text từ file đã lưu cho các hóa đơn chưa có raw_text trong chỉ mục
+    rows = conn.execute('''SELECT i.id, i.file_path FROM invoices i JOIN invoices_fts f ON f.rowid = i.id
+                           WHERE f.raw_text IS NULL AND i.file_path IS NOT NULL''').fetchall()
+    done, failed = 0, []
+    for inv_id, path in rows:
+        try:
+            if not os.path.exists(path): raise FileNotFoundError(path)
+            text = extract_text(path)
+        except Exception as e:
+            failed.append((inv_id, str(e))); continue
+        with conn:
+            set_invoice_text(conn, inv_id, text)
+        done += 1
+        if progress: progress(done, len(rows))
+    return done, failed
+
+# Chạy 1 lần cho dữ liệu cũ: python search.py backfill [invoice_app.db]
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("Cách dùng: python search.py backfill [đường dẫn DB]")
+        sys.exit(1)
+    conn = sqlite3.connect(sys.argv[2] if len(sys.argv) > 2 else "invoice_app.db")
+    with conn:
+        ensure_search_index(conn)
+    done, failed = backfill_text(conn, progress=lambda n, total: print(f"\r{n}/{total}", end="", flush=True))
+    print(f"\nĐã cập nhật text cho {done} hóa đơn, lỗi {len(failed)}")
+    for inv_id, err in failed: print(f"  #{inv_id}: {err}")
+    conn.close()
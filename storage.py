@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+
+# ==========================================
+# KHO FILE HÓA ĐƠN THEO NỘI DUNG (content-addressed)
+# Tên file = SHA-256 nội dung, chia thư mục con theo 2 cặp ký tự đầu: ab/cd/abcd....pdf
+# File giống nhau chỉ lưu 1 lần; số tham chiếu = số dòng invoices.file_path trỏ tới file
+# ==========================================
+
+# File mới ghi gần đây chưa kịp gắn vào hóa đơn thì GC bỏ qua
+GC_GRACE_SECONDS = 3600
+TMP_PREFIX = ".tmp-"
+COPY_CHUNK = 1024 * 1024
+# File dẫn xuất nằm cạnh file gốc: abcd....<loại>.<đuôi> (ảnh thu nhỏ, xem trước - thumbs.py), sống/chết theo file gốc
+DERIVED_KINDS = ("thumb", "preview")
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_CHUNK): h.update(chunk)
+    return h.hexdigest()
+
+def derived_path(path, kind, ext):
+    return f"{os.path.splitext(path)[0]}.{kind}{ext}"
+
+def derived_source(path):
+    # abcd.thumb.webp -> abcd (phần tên chung với file gốc abcd.pdf); không phải file dẫn xuất -> None
+    stem, kind = os.path.splitext(os.path.splitext(path)[0])
+    return stem if kind.lstrip(".") in DERIVED_KINDS else None
+
+def write_atomic(path, write):
+    # Ghi ra file tạm cùng thư mục rồi rename: người đọc không bao giờ thấy file dở dang
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return path
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest, ext=".pdf"):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + ext)
+
+    def put(self, data, ext=".pdf", digest=None):
+        digest = digest or hashlib.sha256(data).hexdigest()
+        return self._write(self.path_for(digest, ext), lambda f: f.write(data))
+
+    def put_file(self, src, ext=".pdf", digest=None):
+        # Như put() nhưng chép từ file trên đĩa theo từng khối, không nạp cả file vào RAM
+        digest = digest or file_digest(src)
+        def copy(f):
+            with open(src, "rb") as s: shutil.copyfileobj(s, f, COPY_CHUNK)
+        return self._write(self.path_for(digest, ext), copy)
+
+    def _write(self, path, write):
+        if os.path.exists(path):
+            # Đã có: chỉ cập nhật mtime để GC không dọn mất trước khi hóa đơn được ghi
+            os.utime(path)
+            return path
+        return write_atomic(path, write)
+
+    def iter_files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                yield os.path.join(dirpath, name)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+def refcounts(conn):
+    # Số hóa đơn trỏ tới từng file, kể cả hóa đơn đã chuyển sang file lưu trữ (archive.py)
+    refs = {os.path.normpath(p): n for p, n in conn.execute("SELECT file_path, COUNT(*) FROM invoices WHERE file_path IS NOT NULL GROUP BY file_path")}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='archive_files'").fetchone():
+        for p, n in conn.execute("SELECT file_path, SUM(n) FROM archive_files GROUP BY file_path"):
+            refs[os.path.normpath(p)] = refs.get(os.path.normpath(p), 0) + n
+    return refs
+
+def store_stats(conn, store):
+    refs = refcounts(conn)
+    files = list(store.iter_files())
+    derived = [p for p in files if derived_source(p)]
+    return {"files": len(files) - len(derived), "bytes": sum(os.path.getsize(p) for p in files),
+            "refs": sum(refs.values()), "shared": sum(1 for n in refs.values() if n > 1),
+            "derived": len(derived), "derived_bytes": sum(os.path.getsize(p) for p in derived)}
+
+def collect_garbage(conn, store, grace=GC_GRACE_SECONDS, dry_run=False):
+    # Xóa file không còn hóa đơn nào trỏ tới (kể cả file tạm bị bỏ dở, ảnh thu nhỏ của file đã xóa), trả về (số file, số byte)
+    keep = refcounts(conn)
+    keep_stems = {os.path.splitext(p)[0] for p in keep}
+    cutoff = time.time() - grace
+    removed, freed = 0, 0
+    for path in store.iter_files():
+        if os.path.normpath(path) in keep or derived_source(os.path.normpath(path)) in keep_stems: continue
+        try:
+            st = os.stat(path)
+            if st.st_mtime > cutoff: continue
+            if not dry_run: os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += 1; freed += st.st_size
+    if not dry_run:
+        # Dọn thư mục shard rỗng
+        for dirpath, dirnames, filenames in os.walk(store.root, topdown=False):
+            if dirpath != store.root and not dirnames and not filenames:
+                try: os.rmdir(dirpath)
+                except OSError: pass
+    return removed, freed
+
+def migrate_legacy(conn, store):
+    # Chuyển file kiểu cũ (<timestamp>_<tên> nằm phẳng trong thư mục) vào kho theo hash
+    moved = 0
+    rows = conn.execute("SELECT id, file_path FROM invoices WHERE file_path IS NOT NULL").fetchall()
+    for inv_id, old_path in rows:
+        if os.path.dirname(os.path.normpath(old_path)) != os.path.normpath(store.root) or not os.path.exists(old_path): continue
+        with open(old_path, "rb") as f:
+            new_path = store.put(f.read(), ext=os.path.splitext(old_path)[1] or ".pdf")
+        with conn:
+            conn.execute("UPDATE invoices SET file_path = ? WHERE id = ?", (new_path, inv_id))
+        moved += 1
+    # File cũ giờ không còn được tham chiếu -> để GC dọn
+    return moved
+
+# Chạy tay: python storage.py gc|migrate [invoice_app.db] [.uploaded_invoices]
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("gc", "migrate"):
+        print("Cách dùng: python storage.py gc|migrate [đường dẫn DB] [thư mục file]")
+        sys.exit(1)
+    conn = sqlite3.connect(sys.argv[2] if len(sys.argv) > 2 else "invoice_app.db")
+    store = BlobStore(sys.argv[3] if len(sys.argv) > 3 else ".uploaded_invoices")
+    if sys.argv[1] == "migrate":
+        print(f"Đã chuyển {migrate_legacy(conn, store)} file vào kho theo hash")
+    removed, freed = collect_garbage(conn, store)
+    print(f"Đã xóa {removed} file không dùng ({freed / 1024 / 1024:.1f} MB)")
+    conn.close()
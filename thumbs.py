@@ -0,0 +1,105 @@
+import io
+import os
+import sys
+import time
+import base64
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pdfplumber
+from PIL import Image, ImageOps
+from db import open_database
+from preview import fit_dpi
+from storage import derived_path, write_atomic
+
+# ==========================================
+# ẢNH THU NHỎ & ẢNH XEM TRƯỚC TRANG ĐẦU CỦA HÓA ĐƠN ĐÃ LƯU
+# Tạo 1 lần lúc lưu (worker của jobs.py / import_invoices.py) hoặc bằng backfill, nằm cạnh file gốc trong kho:
+#   ab/cd/abcd....pdf -> abcd....thumb.webp (danh sách) + abcd....preview.webp (xem trang đầu)
+# Giao diện chỉ đọc file ảnh có sẵn trên đĩa, không render PDF lúc người dùng xem; chưa có ảnh thì hiện chỗ trống
+# python thumbs.py backfill [--db invoice_app.db] [--workers N]
+# ==========================================
+
+THUMB_PX = 240
+PREVIEW_PX = 1000
+THUMB_EXT = ".webp"
+# (loại, cạnh dài tối đa, chất lượng WebP)
+THUMB_SIZES = [("preview", PREVIEW_PX, 80), ("thumb", THUMB_PX, 70)]
+
+def thumb_path(file_path, kind="thumb"):
+    return derived_path(file_path, kind, THUMB_EXT)
+
+def has_thumbs(file_path):
+    return all(os.path.exists(thumb_path(file_path, kind)) for kind, _, _ in THUMB_SIZES)
+
+def first_page_image(file_path, target_px=PREVIEW_PX):
+    # Render trang đầu vừa khung xem trước; file ảnh (kho cũ) thì giải nén JPEG thẳng ở tỉ lệ nhỏ
+    if file_path.lower().endswith(".pdf"):
+        with pdfplumber.open(file_path, pages=[1]) as pdf:
+            page = pdf.pages[0]
+            img = page.to_image(resolution=fit_dpi(float(page.width), target_px)).original
+    else:
+        img = Image.open(file_path)
+        img.draft('RGB', (target_px, target_px))
+        img = ImageOps.exif_transpose(img)
+    return img.convert('RGB')
+
+def make_thumbs(file_path):
+    # Đã có đủ ảnh thì bỏ qua (file trùng nội dung dùng chung ảnh); trả về True nếu vừa tạo
+    if has_thumbs(file_path): return False
+    img = first_page_image(file_path)
+    # Ảnh nhỏ hơn thu từ ảnh xem trước, không render lại PDF
+    for kind, px, quality in THUMB_SIZES:
+        img.thumbnail((px, px * 2) if kind == "preview" else (px, px), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format="WEBP", quality=quality, method=4)
+        write_atomic(thumb_path(file_path, kind), lambda f: f.write(buf.getvalue()))
+    return True
+
+def safe_make_thumbs(file_path):
+    # Cho pool process / lúc lưu: lỗi tạo ảnh không được làm hỏng việc lưu hóa đơn, backfill sẽ thử lại
+    try:
+        if not os.path.exists(file_path): raise FileNotFoundError(file_path)
+        make_thumbs(file_path)
+        return file_path, None
+    except Exception as e:
+        return file_path, str(e)
+
+def thumb_data_uri(file_path):
+    # Cho cột ảnh của bảng (data_editor chỉ nhận URL): đọc file ảnh nhỏ có sẵn, không có thì None
+    path = thumb_path(file_path) if file_path else None
+    if not path or not os.path.exists(path): return None
+    with open(path, "rb") as f:
+        return "data:image/webp;base64," + base64.b64encode(f.read()).decode()
+
+def missing_thumbs(conn):
+    # File hóa đơn (kể cả đã chuyển sang lưu trữ) còn trên đĩa mà chưa có ảnh
+    paths = {p for (p,) in conn.execute("SELECT DISTINCT file_path FROM invoices WHERE file_path IS NOT NULL")}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='archive_files'").fetchone():
+        paths.update(p for (p,) in conn.execute("SELECT DISTINCT file_path FROM archive_files"))
+    return sorted(p for p in paths if os.path.exists(p) and not has_thumbs(p))
+
+def backfill_thumbs(conn, pool=None, progress=None):
+    todo = missing_thumbs(conn)
+    results = pool.map(safe_make_thumbs, todo, chunksize=8) if pool else map(safe_make_thumbs, todo)
+    done, failed = 0, []
+    for n, (path, err) in enumerate(results, 1):
+        if err: failed.append((path, err))
+        else: done += 1
+        if progress: progress(n, len(todo))
+    return done, failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tạo ảnh thu nhỏ/xem trước cho hóa đơn đã lưu chưa có ảnh")
+    parser.add_argument("cmd", choices=["backfill"])
+    parser.add_argument("--db", default="invoice_app.db", help="Đường dẫn DB")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Số tiến trình render")
+    args = parser.parse_args()
+    db = open_database(args.db)
+    started = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool, db.connection() as conn:
+        done, failed = backfill_thumbs(conn, pool, progress=lambda n, total: print(f"\r{n}/{total}", end="", flush=True))
+    print(f"\nĐã tạo ảnh cho {done} file trong {time.time() - started:.1f}s, lỗi {len(failed)}")
+    for path, err in failed: print(f"  {path}: {err}")
+    db.close()
+    sys.exit(1 if failed else 0)
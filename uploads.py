@@ -0,0 +1,106 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+
+# ==========================================
+# FILE UPLOAD TẠM TRÊN ĐĨA (spool)
+# File upload được chép ra đĩa theo từng khối (vừa chép vừa băm SHA-256), session_state chỉ giữ handle nhỏ:
+#   {"path", "name", "size", "hash", "is_image"}
+# -> RAM mỗi session không phụ thuộc kích thước file; giới hạn dung lượng theo session và toàn server
+# File của session đã đóng (không ai dùng nữa) được dọn theo thời gian không dùng
+# ==========================================
+
+SPOOL_CHUNK = 1024 * 1024
+SESSION_BUDGET = 200 * 1024 * 1024
+GLOBAL_BUDGET = 2 * 1024 * 1024 * 1024
+# Handle được "chạm" mỗi lần rerun; file không ai chạm quá lâu coi như bị bỏ
+SPOOL_TTL = 6 * 3600
+SPOOL_CLEANUP_EVERY = 600
+SPOOL_SUFFIX = ".upload"
+
+class SpoolFull(Exception):
+    pass
+
+class UploadSpool:
+    def __init__(self, root, session_budget=SESSION_BUDGET, global_budget=GLOBAL_BUDGET, ttl=SPOOL_TTL):
+        self.root = root
+        self.session_budget = session_budget
+        self.global_budget = global_budget
+        self.ttl = ttl
+        # {đường dẫn: (session, số byte)}; file còn lại từ lần chạy trước không thuộc session nào, chờ dọn theo TTL
+        self.files = {}
+        self.lock = threading.Lock()
+        self.last_cleanup = 0
+        os.makedirs(root, exist_ok=True)
+        for name in os.listdir(root):
+            p = os.path.join(root, name)
+            try: self.files[p] = (None, os.path.getsize(p))
+            except OSError: pass
+
+    def usage(self, session=None):
+        with self.lock:
+            return sum(n for s, n in self.files.values() if session is None or s == session)
+
+    def save(self, session, src, name, size, is_image):
+        # src: file-like (UploadedFile); giữ chỗ theo size trước khi chép để 2 upload cùng lúc không vượt giới hạn
+        self.maybe_cleanup()
+        fd, path = tempfile.mkstemp(dir=self.root, suffix=SPOOL_SUFFIX)
+        with self.lock:
+            if sum(n for s, n in self.files.values() if s == session) + size > self.session_budget:
+                err = f"Vượt giới hạn {self.session_budget // 1024 // 1024} MB file tạm của phiên này, hãy lưu hoặc bỏ bớt file"
+            elif sum(n for _, n in self.files.values()) + size > self.global_budget:
+                err = "Máy chủ đang giữ quá nhiều file tạm, vui lòng thử lại sau"
+            else:
+                err = None; self.files[path] = (session, size)
+        if err:
+            os.close(fd); os.remove(path)
+            raise SpoolFull(err)
+        h, written = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                src.seek(0)
+                while chunk := src.read(SPOOL_CHUNK):
+                    h.update(chunk); f.write(chunk); written += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            self.release({"path": path})
+            raise
+        with self.lock: self.files[path] = (session, written)
+        return {"path": path, "name": name, "size": written, "hash": h.hexdigest(), "is_image": is_image}
+
+    def touch(self, handle):
+        # Gọi mỗi lần rerun còn dùng handle; False nếu file đã bị dọn
+        try: os.utime(handle["path"])
+        except FileNotFoundError:
+            with self.lock: self.files.pop(handle["path"], None)
+            return False
+        return True
+
+    def release(self, handle):
+        if not handle: return
+        with self.lock: self.files.pop(handle["path"], None)
+        try: os.remove(handle["path"])
+        except FileNotFoundError: pass
+
+    def maybe_cleanup(self):
+        if time.time() - self.last_cleanup < SPOOL_CLEANUP_EVERY: return
+        self.last_cleanup = time.time()
+        self.cleanup()
+
+    def cleanup(self):
+        # Xóa file không được chạm quá TTL (session đã đóng hoặc app khởi động lại), trả về (số file, số byte)
+        cutoff = time.time() - self.ttl
+        removed, freed = 0, 0
+        for name in os.listdir(self.root):
+            p = os.path.join(self.root, name)
+            try:
+                st = os.stat(p)
+                if st.st_mtime > cutoff: continue
+                os.remove(p)
+            except FileNotFoundError: pass
+            else: removed += 1; freed += st.st_size
+            with self.lock: self.files.pop(p, None)
+        return removed, freed
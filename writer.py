@@ -0,0 +1,195 @@
+import os
+import time
+import queue
+import signal
+import sqlite3
+import secrets
+import argparse
+import threading
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from db import open_database, run_statements, delete_all_invoices, insert_invoice, cache_lookup, cache_store
+from jobs import claim_job, save_job, release_jobs
+from branding import save_branding
+from metrics import store_metrics
+from reports import rebuild_project_summary
+from search import set_invoice_text
+
+# ==========================================
+# WRITER SERVICE: 1 TIẾN TRÌNH DUY NHẤT GHI VÀO SQLITE CHO NHIỀU TIẾN TRÌNH APP
+# Chạy nhiều tiến trình Streamlit (sau load balancer, cùng máy) chung invoice_app.db: mỗi tiến trình tự ghi thì tranh
+# khóa ghi, quá busy_timeout là "database is locked". Ở đây app gửi lệnh ghi (tên hàm trong WRITE_OPS + tham số)
+# qua Unix socket, writer gom các lệnh đang chờ thành 1 giao dịch (group commit, mỗi lệnh 1 SAVEPOINT: lệnh lỗi chỉ
+# hoàn tác phần của nó) và chỉ trả lời sau khi COMMIT xong -> app nhận kết quả = lệnh ghi đã nằm trên đĩa
+# Đọc vẫn đi thẳng vào DB (WAL snapshot). Chạy: python writer.py [--db invoice_app.db] [--socket .writer.sock]
+# rồi chạy app với biến môi trường INVOICE_WRITER_SOCKET=.writer.sock
+# Công cụ dòng lệnh (import, archive, backfill) vẫn ghi thẳng, chờ khóa theo busy_timeout; archive.py/VACUUM giữ khóa lâu
+# nên app không chạy khi có writer, chạy tay lúc vắng người dùng (VACUUM: dừng writer trước)
+# ==========================================
+
+WRITER_SOCKET = ".writer.sock"
+MAX_BATCH = 256
+# Client chờ writer (đang khởi động lại) tối đa bấy nhiêu giây trước khi báo lỗi
+CONNECT_WAIT = 10.0
+
+# Chỉ các hàm này được gọi qua socket; hàm nhận conn đầu tiên, chạy trong giao dịch của writer
+WRITE_OPS = {f.__name__: f for f in [run_statements, delete_all_invoices, insert_invoice, cache_lookup, cache_store, claim_job, save_job,
+                                     release_jobs, save_branding, store_metrics, rebuild_project_summary, set_invoice_text]}
+
+class WriterUnavailable(sqlite3.OperationalError):
+    pass
+
+def authkey_path(address):
+    return address + ".key"
+
+class WriterService:
+    def __init__(self, db_path, address=WRITER_SOCKET, max_batch=MAX_BATCH, commit_delay=0.0):
+        # Tạo bảng/migration trước khi nhận lệnh; 1 kết nối duy nhất dùng cho mọi lệnh ghi
+        self.db = open_database(db_path, pool_size=1)
+        self.address = address
+        self.max_batch = max_batch
+        # >0: chờ thêm chút để gom lô lớn hơn (đổi độ trễ lấy số lần fsync)
+        self.commit_delay = commit_delay
+        self.requests = queue.Queue()
+        self.stats = {"writes": 0, "errors": 0, "batches": 0, "max_batch": 0, "started": time.time()}
+        self.listener = None
+
+    def serve(self):
+        # Khóa xác thực ghi ra file chỉ user chạy writer đọc được: tiến trình khác user không gửi lệnh ghi được
+        key = secrets.token_bytes(32)
+        if os.path.exists(self.address): os.remove(self.address)
+        fd = os.open(authkey_path(self.address), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f: f.write(key)
+        self.listener = Listener(self.address, family="AF_UNIX", authkey=key)
+        committer = threading.Thread(target=self._commit_loop, name="writer-commit")
+        committer.start()
+        try:
+            while True:
+                try: conn = self.listener.accept()
+                except AuthenticationError: continue
+                except OSError: break
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+        finally:
+            # Dừng: ghi nốt các lệnh đã nhận rồi mới thoát
+            self.requests.put(None)
+            committer.join()
+            for p in (self.address, authkey_path(self.address)):
+                if os.path.exists(p): os.remove(p)
+            self.db.close()
+
+    def stop(self):
+        if self.listener: self.listener.close()
+
+    def _serve_client(self, conn):
+        # Mỗi kết nối gửi 1 lệnh và chờ trả lời rồi mới gửi lệnh tiếp; client muốn song song thì mở nhiều kết nối
+        try:
+            while True:
+                op, args, kwargs = conn.recv()
+                if op == "stats":
+                    conn.send(("ok", dict(self.stats, pending=self.requests.qsize()))); continue
+                req = {"op": op, "args": args, "kwargs": kwargs, "done": threading.Event(), "result": None}
+                self.requests.put(req)
+                req["done"].wait()
+                try: conn.send(req["result"])
+                except Exception as e:
+                    # Kết quả/lỗi không pickle được
+                    conn.send(("err", RuntimeError(f"{type(e).__name__}: {e}")))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _commit_loop(self):
+        with self.db.connection() as conn:
+            # Mỗi lô chỉ 1 lần fsync nên dùng được FULL: trả lời app = dữ liệu đã an toàn kể cả khi mất điện
+            conn.execute("PRAGMA synchronous=FULL")
+            while True:
+                batch = [self.requests.get()]
+                if self.commit_delay and batch[0]: time.sleep(self.commit_delay)
+                while len(batch) < self.max_batch and batch[-1]:
+                    try: batch.append(self.requests.get_nowait())
+                    except queue.Empty: break
+                reqs = [r for r in batch if r]
+                if reqs: self._commit(conn, reqs)
+                if not batch[-1]: return
+
+    def _commit(self, conn, batch):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for r in batch:
+                conn.execute("SAVEPOINT w")
+                try:
+                    r["result"] = ("ok", WRITE_OPS[r["op"]](conn, *r["args"], **r["kwargs"]))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO w")
+                    r["result"] = ("err", e if r["op"] in WRITE_OPS else KeyError(f"Lệnh ghi không hợp lệ: {r['op']}"))
+                conn.execute("RELEASE w")
+            conn.execute("COMMIT")
+        except Exception as e:
+            # BEGIN/COMMIT lỗi (đĩa đầy, DB bị công cụ khác giữ khóa quá busy_timeout...): cả lô không được ghi
+            if conn.in_transaction: conn.rollback()
+            for r in batch: r["result"] = ("err", e)
+        self.stats["batches"] += 1
+        self.stats["writes"] += len(batch)
+        self.stats["errors"] += sum(1 for r in batch if r["result"][0] == "err")
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        for r in batch: r["done"].set()
+
+class WriterClient:
+    # Gắn vào Database(writer=...): db.write(op, ...) -> call(op.__name__, ...); an toàn đa luồng (mỗi luồng mượn 1 kết nối)
+    def __init__(self, address=WRITER_SOCKET, connect_wait=CONNECT_WAIT):
+        self.address = address
+        self.connect_wait = connect_wait
+        self.idle = queue.LifoQueue()
+
+    def _connect(self):
+        deadline = time.time() + self.connect_wait
+        while True:
+            try:
+                with open(authkey_path(self.address), "rb") as f: key = f.read()
+                return Client(self.address, family="AF_UNIX", authkey=key)
+            except (OSError, AuthenticationError) as e:
+                if time.time() > deadline: raise WriterUnavailable(f"Không kết nối được writer {self.address}: {e}") from e
+                time.sleep(0.2)
+
+    def call(self, op, args=(), kwargs=None):
+        msg = (op, tuple(args), kwargs or {})
+        try:
+            conn = self.idle.get_nowait()
+            # Kết nối cũ có thể đã đứt (writer khởi động lại): lệnh chưa tới writer nên gửi lại qua kết nối mới
+            try: conn.send(msg)
+            except OSError:
+                conn.close(); conn = self._connect(); conn.send(msg)
+        except queue.Empty:
+            conn = self._connect(); conn.send(msg)
+        try:
+            status, value = conn.recv()
+        except (EOFError, OSError) as e:
+            conn.close()
+            # Không gửi lại: writer có thể đã commit trước khi mất kết nối
+            raise WriterUnavailable(f"Mất kết nối writer khi đang ghi: {e}") from e
+        self.idle.put(conn)
+        if status == "err": raise value
+        return value
+
+    def stats(self):
+        return self.call("stats")
+
+    def close(self):
+        while True:
+            try: self.idle.get_nowait().close()
+            except queue.Empty: break
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiến trình ghi duy nhất vào DB cho nhiều tiến trình app (Unix socket, group commit)")
+    parser.add_argument("--db", default="invoice_app.db", help="Đường dẫn DB")
+    parser.add_argument("--socket", default=WRITER_SOCKET, help="Đường dẫn Unix socket")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="Số lệnh ghi tối đa trong 1 giao dịch")
+    parser.add_argument("--commit-delay", type=float, default=0.0, help="Giây chờ gom thêm lệnh trước mỗi lần commit")
+    args = parser.parse_args()
+    service = WriterService(args.db, args.socket, args.max_batch, args.commit_delay)
+    signal.signal(signal.SIGTERM, lambda *_: service.stop())
+    signal.signal(signal.SIGINT, lambda *_: service.stop())
+    print(f"Writer đang chạy: {args.db} <- {args.socket}", flush=True)
+    service.serve()
+    s = service.stats
+    print(f"Đã dừng: {s['writes']} lệnh ghi trong {s['batches']} giao dịch (tối đa {s['max_batch']}/giao dịch), lỗi {s['errors']}")